@@ -0,0 +1,38 @@
+import unittest
+
+import numpy as np
+
+from standard import analysis_weight
+
+
+def _bimodal_weights(rng, mean_weak, mean_strong, n_pn=50, n_kc=2500):
+    """Log-normal weak and strong PN-KC weights, 7 strong per KC on average."""
+    w = np.exp(rng.normal(mean_weak, 1.5, (n_pn, n_kc)))
+    strong = rng.uniform(0, 1, (n_pn, n_kc)) < 7. / n_pn
+    w[strong] = np.exp(rng.normal(mean_strong, 0.5, strong.sum()))
+    return w
+
+
+class TestAnalysisWeight(unittest.TestCase):
+
+    def test_threshold_estimator(self):
+        rng = np.random.RandomState(0)
+        estimator = analysis_weight.ThresholdEstimator()
+        for mean_weak, mean_strong in [(-6, -1), (-7, -0.7), (-8, -0.4)]:
+            w = _bimodal_weights(rng, mean_weak, mean_strong)
+            thres_gmm, _ = analysis_weight.infer_threshold(w, estimator='gmm')
+            thres, res_fit = analysis_weight.infer_threshold(
+                w, estimator=estimator)
+            self.assertEqual(res_fit['n_modal'], 2)
+            np.testing.assert_allclose(thres, thres_gmm, rtol=0.05)
+
+        # Crossing at the first grid point where modal 2 dominates
+        x_plot = res_fit['x_plot']
+        diff = res_fit['pdfs'][0] < res_fit['pdfs'][1]
+        thres_grid = x_plot[np.where(diff)[0][0]]
+        self.assertLessEqual(np.log(thres), thres_grid)
+        self.assertGreater(np.log(thres), thres_grid - (x_plot[1] - x_plot[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -86,13 +86,19 @@ def plot_cond_by_n_kc():
     plt.xticks(np.log10(n_kcs), n_kcs)
     plt.ylabel('Log decrease in condition number')
     plt.xlabel('N_KC')
-    
-    
-n_kc_claws = np.arange(1, 50)
-conds = np.array([get_logcond(n_kc_claw=n) for n in n_kc_claws])
-
-plt.figure()
-plt.plot(n_kc_claws, conds, 'o-')
-plt.xticks(n_kc_claws)
-plt.xlabel('N_KC_claw')
-plt.show()
+
+
+def plot_cond_by_n_kc_claw():
+    n_kc_claws = np.arange(1, 50)
+    conds = np.array([get_logcond(n_kc_claw=n) for n in n_kc_claws])
+
+    plt.figure()
+    plt.plot(n_kc_claws, conds, 'o-')
+    plt.xticks(n_kc_claws)
+    plt.xlabel('N_KC_claw')
+
+
+if __name__ == '__main__':
+    plot_cond_by_n_kc_claw()
+    plt.show()
+
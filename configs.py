@@ -71,6 +71,24 @@ class input_ProtoConfig(BaseConfig):
 
         # Whether to have correlation between ORNs
         self.orn_corr = None
+        # Sampler of ORN activity, see task.get_input_sampler. None is
+        # uniform, or a dense gaussian copula ('mvn') if orn_corr is set.
+        # 'equicorr', 'lowrank' and 'block' sample correlated activity
+        # exactly in O(n_sample * N_ORN), 'hallem' fits Hallem-Carlson data
+        self.orn_sampler = None
+        # Number of latent factors of the 'lowrank' sampler
+        self.orn_corr_rank = None
+        # Number of correlated groups of ORNs of the 'block' sampler
+        self.orn_corr_n_block = None
+
+        # Storage format, None for one .npy file per array, or 'hdf5' for a
+        # single chunked data.h5 file
+        self.data_format = None
+        # Compression of HDF5 datasets, None or a h5py filter like 'gzip'
+        self.hdf5_compression = None
+        # If set, generate training odors in shards of this many odors, see
+        # task.save_proto_sharded
+        self.train_shard_size = None
 
 
 class InputAutoEncode(BaseConfig):
@@ -119,8 +137,43 @@ class FullConfig(BaseConfig):
         self.decay_steps = 1e8  # learning rate decay steps
         self.decay_rate = 1.  # learning rate decay rate, default to no decay
         self.max_epoch = 100
+        # train_loss and train_acc are logged as means over the batches of an
+        # epoch, see torchtrain.train
         self.batch_size = 256
         self.target_acc = None  # target accuracy
+        # Stop when validation loss has not improved by early_stop_min_delta
+        # for early_stop_patience epochs. None disables it
+        self.early_stop_patience = None
+        self.early_stop_min_delta = 0.
+        # Stop when the relative change of PN --> KC weights per epoch is
+        # below early_stop_weight_tol. None disables it
+        self.early_stop_weight_tol = None
+        # Validation interval doubles, up to eval_max_interval epochs, while
+        # the relative change of validation loss between evaluations is
+        # below eval_stable_tol. 1 evaluates every epoch
+        self.eval_max_interval = 1
+        self.eval_stable_tol = 0.01
+
+        # If True, sample fresh odors for every batch instead of loading
+        # data_dir, see torchtask.OdorStream. Dataset entries of
+        # input_ProtoConfig (N_CLASS, n_trueclass, relabel, orn_corr, ...)
+        # are then set on this config directly
+        self.stream_data = False
+        self.stream_seed = 0
+        # If True, read training data from disk in shuffled contiguous
+        # chunks instead of loading it in memory, see torchtask.iterate_chunks
+        self.train_from_disk = False
+        # If True, logged metrics are computed and saved in a worker process
+        # while training continues, see torchtrain.AsyncLogger
+        self.async_logging = False
+        # If True, training on cpu gathers batches from a memory-mapped
+        # dataset, shared with other processes training on the same
+        # dataset, see torchtask.iterate_shared
+        self.shared_data = False
+        # Save a checkpoint every checkpoint_every epochs, and resume from
+        # it if training is restarted with the same config, see
+        # torchtrain.train and torchtrain.config_hash. 0 disables checkpoints
+        self.checkpoint_every = 5
 
         # Overall architecture
         # If False, ORNs are already replicated in the dataset
@@ -232,6 +285,14 @@ class FullConfig(BaseConfig):
         self.kc_prune_weak_weights = False
         self.kc_prune_threshold = 0.02
 
+        # If True, sparse PN --> KC connections (sparse_pn2kc or
+        # correlated_sparse_mask) are stored per KC as indices and values,
+        # and connections remaining after pruning are converted to this
+        # format once every KC has at most sparse_pn2kc_max_inputs of them,
+        # see torchmodel.SparseLayer
+        self.sparse_pn2kc_layer = False
+        self.sparse_pn2kc_max_inputs = 15
+
         # Whether to do feedforward or recurrent inhibition on KC
         self.kc_ffinh = False
         self.kc_ffinh_coeff = 0
@@ -351,6 +412,11 @@ class MetaConfig(FullConfig):
         self.meta_norm = 'None'
         # if True, do not use second derivatives in meta-optimization (for speed)
         self.meta_stop_grad = False
+        # inner loop: 'second_order', 'first_order', 'truncated', or 'implicit'
+        # None is 'first_order' if meta_stop_grad, else 'second_order'
+        self.meta_inner_mode = None
+        # number of last inner updates backpropagated through, if truncated
+        self.meta_truncate_steps = 1
         # label type for the meta dataset
         self.label_type = 'one_hot'
         # saving / printing epoch interval
@@ -1,6 +1,4 @@
 import numpy as np
-from matplotlib import pyplot as plt
-from scipy.optimize import curve_fit
 
 from configs import input_ProtoConfig
 
@@ -42,6 +40,7 @@ def _make_hallem_dataset(file, N_ORNS_TOTAL = 50, arg_positive=True, arg_expand=
     return out
 
 def _simple_distribution_subplot(data, r, c, max, savename):
+    from matplotlib import pyplot as plt
     fig, ax = plt.subplots(r, c)
     for i in range(data.shape[1]):
         ix = np.unravel_index(i, (r,c))
@@ -49,33 +48,44 @@ def _simple_distribution_subplot(data, r, c, max, savename):
     plt.savefig(savename)
 
 def _covariance_image(data, savename):
+    from matplotlib import pyplot as plt
     plt.figure()
     plt.imshow(data, cmap='RdBu_r', interpolation='none')
     plt.colorbar()
     plt.savefig(savename)
 
 
-def _generate_from_hallem(config=None, size= 1000):
-    arg_positive = True
-    arg_expand = False
-
-    if config is None:
-        config = input_ProtoConfig()
-    odor_activation = _make_hallem_dataset(config.hallem_path, N_ORNS_TOTAL= config.N_ORN,
-                                           arg_positive=arg_positive, arg_expand=arg_expand)
+def _fit_hallem_lognormal(file):
+    """Fit a log-normal distribution to the Hallem-Carlson responses.
 
+    Returns:
+        means: np array (24,), mean of log(1 + response) of each ORN
+        covs: np array (24, 24), covariance of log(1 + response)
+        odor_activation: np array (110, 24), the responses
+    """
+    odor_activation = _make_hallem_dataset(file, arg_positive=True,
+                                           arg_expand=False)
     log_odor_activation = f(odor_activation, argInverse=False)
     means = np.mean(log_odor_activation, axis=0)
     covs = np.cov(log_odor_activation, rowvar=False)
+    return means, covs, odor_activation
+
+
+def _generate_from_hallem(config=None, size= 1000, plot=False):
+    if config is None:
+        config = input_ProtoConfig()
+    means, covs, odor_activation = _fit_hallem_lognormal(config.hallem_path)
     sampled = np.random.multivariate_normal(means, covs, size= size)
     fsampled = f(sampled, argInverse=True)
 
     realistic_max = np.max(odor_activation.flatten())
     fsampled[fsampled > realistic_max] = realistic_max
 
-    plt.figure()
-    plt.hist(np.sum(odor_activation, axis=1))
-    plt.savefig('hallem')
+    if plot:
+        from matplotlib import pyplot as plt
+        plt.figure()
+        plt.hist(np.sum(odor_activation, axis=1))
+        plt.savefig('hallem')
     # plt.figure()
     # plt.hist(np.sum(fsampled, axis=1))
     # plt.show()
@@ -88,4 +98,5 @@ def _generate_from_hallem(config=None, size= 1000):
     return sampled
 
 
-_generate_from_hallem()
\ No newline at end of file
+if __name__ == '__main__':
+    _generate_from_hallem(plot=True)
\ No newline at end of file
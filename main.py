@@ -8,14 +8,26 @@ python main.py --analyze experiment_name
 
 To train models quickly, run in command line
 python main.py --train experiment_name --testing
+
+To train models of an experiment that differ only in learning rate together
+in one process, run
+python main.py --train experiment_name --ensemble
+
+To train models of an experiment locally in 8 parallel processes, run
+python main.py --train experiment_name --n_workers 8
+
+To make datasets (e.g. relabel), using 8 processes, run
+python main.py --dataset relabel --n_workers 8
+
+Datasets that are up to date are skipped. To list stale and fresh datasets
+python main.py --dataset relabel --status
 """
 
 import platform
 import os
 import argparse
 
-from standard.experiment_utils import train_experiment, analyze_experiment
-from paper_datasets import make_dataset
+# Modules of each subcommand are imported when it runs, to keep startup fast
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-d', '--device', help='CUDA device number', default=0, type=int)
@@ -24,6 +36,11 @@ parser.add_argument('-a', '--analyze', nargs='+', help='Analyze experiments', de
 parser.add_argument('-data', '--dataset', nargs='+', help='Make datasets', default=[])
 parser.add_argument('-test', '--testing', help='For debugging', action='store_true')
 parser.add_argument('-n', '--n_pn', help='Number of olfactory receptors', default=None, type=int)
+parser.add_argument('-w', '--n_workers', help='Number of worker processes', default=1, type=int)
+parser.add_argument('--ensemble', help='Train models differing only in lr together', action='store_true')
+parser.add_argument('--force', help='Regenerate up-to-date datasets', action='store_true')
+parser.add_argument('--status', help='List stale and fresh datasets instead of making them', action='store_true')
+parser.add_argument('--migrate', nargs='+', help='Move epoch folders of models in paths to weight histories', default=[])
 args = parser.parse_args()
 
 for item in args.__dict__.items():
@@ -35,6 +52,7 @@ experiments2analyze = args.analyze
 datasets = args.dataset
 testing = args.testing
 n_pn = args.n_pn
+n_workers = args.n_workers
 use_cluster = 'columbia' in platform.node()  # on columbia cluster
 
 if 'core' in experiments2train:
@@ -54,12 +72,27 @@ if 'core' in experiments2train:
 if 'supplement' in experiments2train:
     experiments2train = []  # To be added
 
+if experiments2train:
+    from standard.experiment_utils import train_experiment
 for experiment in experiments2train:
     train_experiment(experiment, use_cluster=use_cluster, testing=testing,
-                     n_pn=n_pn)
+                     n_pn=n_pn, ensemble=args.ensemble, n_workers=n_workers)
 
+if experiments2analyze:
+    from standard.experiment_utils import analyze_experiment
 for experiment in experiments2analyze:
     analyze_experiment(experiment, n_pn=n_pn)
 
+if args.migrate:
+    import tools
+for path in args.migrate:
+    for modeldir in tools.get_modeldirs(path):
+        tools.migrate_epoch_folders(modeldir)
+
+if datasets:
+    from paper_datasets import make_dataset, print_dataset_status
 for dataset in datasets:
-    make_dataset(dataset)
+    if args.status:
+        print_dataset_status(dataset)
+    else:
+        make_dataset(dataset, n_workers=n_workers, force=args.force)
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds allowed for main.py --help, generous to avoid flaky failures
+HELP_TIME_BUDGET = 2.
+
+
+class TestMain(unittest.TestCase):
+
+    def test_help_startup_time(self):
+        start_time = time.time()
+        subprocess.run([sys.executable, 'main.py', '--help'], cwd=ROOT,
+                       check=True, stdout=subprocess.DEVNULL)
+        self.assertLess(time.time() - start_time, HELP_TIME_BUDGET)
+
+    def test_side_effect_free_imports(self):
+        code = ('import sys, settings, hallem; '
+                'print("matplotlib.pyplot" in sys.modules); '
+                'import analytical.conditionnumber')
+        start_time = time.time()
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT,
+                             check=True, stdout=subprocess.PIPE).stdout
+        self.assertLess(time.time() - start_time, HELP_TIME_BUDGET)
+        self.assertEqual(out.decode().strip(), 'False')
+
+if __name__ == '__main__':
+    unittest.main()
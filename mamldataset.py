@@ -11,6 +11,14 @@ import task
 
 
 class DataGenerator(object):
+    """Generate meta-batches of few-shot classification tasks.
+
+    Each task samples num_class classes, then num_samples_per_class odors
+    of each class twice, for the inner (lossa) and outer (lossb) updates.
+    Training classes are grouped once at construction, so a whole
+    meta-batch is sampled with a few array operations.
+    """
+
     def __init__(
             self,
             dataset,
@@ -19,6 +27,7 @@ class DataGenerator(object):
             num_samples_per_class=1,
             num_class=2,
             dim_output=2,
+            seed=None,
     ):
         train_x, train_y, val_x, val_y = task.load_data(dataset)
 
@@ -27,8 +36,17 @@ class DataGenerator(object):
         self.num_samples_per_class = num_samples_per_class
         self.num_class = num_class
         self.dim_output = dim_output
-
-        self.train_x = train_x
+        # Drawn from the global random state by default, so that seeding
+        # numpy still makes meta-batches reproducible
+        if seed is None:
+            seed = np.random.randint(2**31)
+        # One generator per split, so that meta-batches of a split do not
+        # depend on when the other split is sampled, e.g. by prefetch
+        seeds = np.random.SeedSequence(seed).generate_state(2)
+        self.rngs = {'train': np.random.RandomState(seeds[0]),
+                     'val': np.random.RandomState(seeds[1])}
+
+        self.train_x = train_x.astype(np.float32, copy=False)
         self.train_y = train_y
 
         if np.ndim(train_y) == 2: #hack for multi_class_one_hot
@@ -43,8 +61,14 @@ class DataGenerator(object):
             self.n_valence_class = None
 
         # dictionary mapping class to odor indices
-        unique_y = np.unique(class_y)
-        self.ind_dict = {y: np.where(class_y==y)[0] for y in unique_y}
+        order = np.argsort(class_y, kind='stable')
+        unique_y, class_start, class_count = np.unique(
+            class_y[order], return_index=True, return_counts=True)
+        self.ind_dict = {y: order[s:s+c] for y, s, c in
+                         zip(unique_y, class_start, class_count)}
+        self._class_order = order
+        self._class_start = class_start
+        self._class_count = class_count
 
         if np.ndim(train_y) == 2:
             self.metatrain_classes = unique_y
@@ -52,9 +76,52 @@ class DataGenerator(object):
         else:
             self.metatrain_classes = unique_y[:int(0.5 * len(unique_y))]
             self.metaval_classes = unique_y[int(0.5 * len(unique_y)):]
+        # Positions of the classes of each split in unique_y
+        self._split_classes = {
+            'train': np.searchsorted(unique_y, self.metatrain_classes),
+            'val': np.searchsorted(unique_y, self.metaval_classes)}
 
         if np.mod(num_class, dim_output) != 0:
             raise ValueError('Now only supporting num_class multiples of dim_output')
+        for name, classes in self._split_classes.items():
+            if len(classes) < num_class:
+                raise ValueError('Only {:d} {:s} classes, fewer than '
+                                 'num_class'.format(len(classes), name))
+            if np.min(class_count[classes]) < num_samples_per_class:
+                raise ValueError('Fewer than num_samples_per_class odors in '
+                                 'some {:s} classes'.format(name))
+
+        # relabel them
+        # TODO: what to do when n_class_per_batch different from dim_output?
+        new_labels = (list(range(self.dim_output)) *
+                      (self.num_class//self.dim_output))
+        # One-hot targets are the same for every task
+        targets = np.eye(self.dim_output, dtype=np.float32)[new_labels]
+        targets = np.repeat(targets, num_samples_per_class, axis=0)
+        self._targets = np.tile(targets, (2, 1))
+
+    @staticmethod
+    def _sample_without_replacement(counts, k, rng):
+        """Sample k distinct positions in range(count) for each count.
+
+        Positions are drawn independently and redrawn where they collide,
+        which is rare when k is small compared to the class size.
+        """
+        counts = counts.ravel()
+        pos = (rng.uniform(size=(counts.size, k))
+               * counts[:, None]).astype(int)
+        redraw = np.arange(counts.size)
+        for _ in range(10):
+            sorted_pos = np.sort(pos[redraw], axis=1)
+            collide = np.any(sorted_pos[:, 1:] == sorted_pos[:, :-1], axis=1)
+            redraw = redraw[collide]
+            if redraw.size == 0:
+                return pos
+            pos[redraw] = (rng.uniform(size=(redraw.size, k))
+                           * counts[redraw, None]).astype(int)
+        for i in redraw:
+            pos[i] = rng.choice(counts[i], k, replace=False)
+        return pos
 
     def generate(self, dataset_type='train'):
         """Generate one meta-batch.
@@ -63,70 +130,100 @@ class DataGenerator(object):
             dataset_type: str, 'train' or 'val'
 
         Returns:
-            inputs: array, (meta_batch_size, n_samples_per_class, dim_input)
-            outputs_head1: array, (meta_batch_size, n_samples_per_class, dim_output)
+            inputs: float32 array, (meta_batch_size, batch_size, dim_input)
+            outputs_head1: float32 array, (meta_batch_size, batch_size, dim_output)
         """
-        if dataset_type == 'train':
-            all_classes = self.metatrain_classes
-        elif dataset_type == 'val':
-            all_classes = self.metaval_classes
-        else:
+        if dataset_type not in self._split_classes:
             raise ValueError('Unknown dataset type: ' + str(dataset_type))
+        all_classes = self._split_classes[dataset_type]
+        rng = self.rngs[dataset_type]
 
         n_sample_per_class = self.num_samples_per_class
         n_class_per_batch = self.num_class
         assert n_sample_per_class * n_class_per_batch * 2 == self.batch_size
 
-        inputs = np.zeros([self.meta_bs, self.batch_size, self.train_x.shape[-1]])
-        outputs_head1 = np.zeros([self.meta_bs, self.batch_size, self.dim_output])
-        if self.n_valence_class is not None:
-            outputs_head2 = np.zeros([self.meta_bs, self.batch_size, self.n_valence_class])
-
-        for i in range(self.meta_bs):
-            # randomly select several classes to train on
-            classes = np.random.choice(
-                all_classes, size=n_class_per_batch, replace=False)
-            # relabel them
-            # new_labels = np.random.randint(0, n_valence, len(classes))
-            # TODO: what to do when n_class_per_batch different from dim_output?
-            new_labels = (list(range(self.dim_output)) *
-                          (self.num_class//self.dim_output))
-
-            # for each class, sample some odors
-            j = 0
-            for _ in range(2):  # repeat twice for lossa and lossb
-                for c, l in zip(classes, new_labels):
-                    ind = np.random.choice(
-                        self.ind_dict[c], n_sample_per_class, replace=False)
-                    inputs[i, j:j+n_sample_per_class, :] = self.train_x[ind, :]
-                    outputs_head1[i, j:j+n_sample_per_class, l] = 1.0  # one-hot
-
-                    if self.n_valence_class:
-                        outputs_head2[i,j:j+n_sample_per_class, self.valence_y[ind]] = 1.0
-                    j += n_sample_per_class
-
-        if self.n_valence_class is not None:
-            outputs_head = np.concatenate((outputs_head1, outputs_head2), axis=2)
-        else:
-            outputs_head = outputs_head1
-
-        # n_orn = 50
-        # noise = .01
-        # for i in range(self.meta_bs):
-        #     prototypes = np.random.uniform(0, 1, (n_class_per_batch, n_orn))
-        #
-        #     labels = np.random.random_integers(0, n_class_per_batch-1, self.batch_size)
-        #     odor_noise = np.random.uniform(0, noise, (self.batch_size, n_orn))
-        #     odor_base = prototypes[labels,:]
-        #     odors = odor_base + odor_noise
-        #
-        #     labels = task._get_labels(prototypes, odors, percent_generalization=100)
-        #     inputs[i,:,:] = odors
-        #     outputs_head1[i, np.arange(labels.size), labels] = 1
-        outputs_head = outputs_head1
-
+        # randomly select several classes to train on, for each task
+        keys = rng.uniform(size=(self.meta_bs, len(all_classes)))
+        classes = all_classes[
+            np.argsort(keys, axis=1)[:, :n_class_per_batch]]
+
+        # for each class, sample some odors, twice for lossa and lossb
+        classes = np.tile(classes[:, np.newaxis, :], (1, 2, 1))
+        pos = self._sample_without_replacement(
+            self._class_count[classes], n_sample_per_class, rng)
+        pos = pos.reshape(classes.shape + (n_sample_per_class,))
+        ind = self._class_order[
+            self._class_start[classes][..., np.newaxis] + pos]
+        ind = ind.reshape(self.meta_bs, self.batch_size)
+
+        inputs = self.train_x[ind]
+        outputs_head = np.broadcast_to(
+            self._targets, (self.meta_bs,) + self._targets.shape).copy()
         return inputs, outputs_head
 
+    def prefetch(self, dataset_type='train', n_batch=None, max_prefetch=2,
+                 device='cpu'):
+        """Iterate over meta-batches generated in a background thread.
+
+        Generation of the next meta-batches overlaps with the training step
+        on the current one. At most max_prefetch meta-batches wait in the
+        queue. Meta-batches of dataset_type should not be generated
+        elsewhere while iterating, the other split can.
+
+        Args:
+            dataset_type: str, 'train' or 'val'
+            n_batch: None or int, number of meta-batches, infinite if None
+            max_prefetch: int, size of the prefetch queue
+            device: str, device of the returned tensors
+
+        Yields:
+            inputs, outputs: float32 torch tensors, see generate
+        """
+        import queue
+        import threading
+        import torch
+
+        batches = queue.Queue(maxsize=max_prefetch)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _worker():
+            i = 0
+            try:
+                while n_batch is None or i < n_batch:
+                    inputs, outputs = self.generate(dataset_type)
+                    item = (torch.from_numpy(inputs).to(device),
+                            torch.from_numpy(outputs).to(device))
+                    if not _put(item):
+                        return
+                    i += 1
+            except Exception as e:
+                _put(e)
+                return
+            _put(None)
+
+        thread = threading.Thread(target=_worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
 
 def _generate_meta_proto():
     config = configs.MetaConfig()
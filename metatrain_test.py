@@ -0,0 +1,161 @@
+import unittest
+
+import configs
+
+
+def _import_metatrain(test):
+    try:
+        import torchmeta  # noqa: F401
+    except ImportError:
+        test.skipTest('torchmeta is not installed')
+    from temp_meta import metatrain
+    return metatrain
+
+
+def _make_problem(kc_norm_pre=None, n_task=4, split_size=8, n_kc=200,
+                  dtype=None):
+    """Model and one meta-batch of random tasks."""
+    import torch
+    import torch.nn.functional as F
+    from temp_meta import metamodel
+
+    torch.manual_seed(0)
+    # Dataset entries, e.g. N_ORN, are merged as in metatrain.train
+    config = configs.input_ProtoConfig()
+    config.update(configs.MetaConfig())
+    config.N_KC = n_kc
+    config.kc_dropout = False
+    config.kc_norm_pre = kc_norm_pre
+    model = metamodel.Model(config=config)
+    data_x = torch.rand(n_task, 2 * split_size, config.N_ORN)
+    labels = torch.randint(config.N_CLASS, (n_task, 2 * split_size))
+    data_t = F.one_hot(labels, config.N_CLASS).float()
+    update_lr = torch.ones(1) * config.meta_update_lr
+    if dtype is not None:
+        model.to(dtype=dtype)
+        data_x, data_t, update_lr = [
+            val.to(dtype=dtype) for val in [data_x, data_t, update_lr]]
+    return model, config, data_x, data_t, update_lr
+
+
+def _grads(model):
+    return {name: None if param.grad is None else param.grad.clone()
+            for name, param in model.named_parameters()}
+
+
+def _count_graph_nodes(tensor):
+    """Number of autograd nodes tensor depends on."""
+    seen = set()
+    nodes = [tensor.grad_fn]
+    while nodes:
+        node = nodes.pop()
+        if node is None or node in seen:
+            continue
+        seen.add(node)
+        nodes.extend(next_node for next_node, _ in node.next_functions)
+    return len(seen)
+
+
+class TestMetaTrain(unittest.TestCase):
+
+    def test_run_batched_matches_run_per_batch(self):
+        import numpy as np
+        import torch
+        metatrain = _import_metatrain(self)
+
+        for kc_norm_pre in [None, 'batch_norm']:
+            # Sums of float32 differ between the two, e.g. for layer1 grads
+            model, config, data_x, data_t, update_lr = _make_problem(
+                kc_norm_pre, dtype=torch.float64)
+            split_size = data_x.shape[1] // 2
+
+            model.zero_grad()
+            res_loop = metatrain.run_per_batch(
+                model, model.loss, split_size, data_x, data_t, update_lr,
+                max_update_lr=config.output_max_lr)
+            res_loop[-1].backward()
+            grads_loop = _grads(model)
+
+            model.zero_grad()
+            res_batched = metatrain.run_batched(
+                model, split_size, data_x, data_t, update_lr,
+                max_update_lr=config.output_max_lr)
+            res_batched[-1].backward()
+            grads_batched = _grads(model)
+
+            msg = 'kc_norm_pre={}'.format(kc_norm_pre)
+            # Averages over tasks are accumulated in float32
+            for val_loop, val_batched in zip(res_loop, res_batched):
+                np.testing.assert_allclose(
+                    val_loop.item(), val_batched.item(), rtol=1e-6,
+                    err_msg=msg)
+            self.assertEqual(grads_loop.keys(), grads_batched.keys())
+            for name, grad in grads_loop.items():
+                if grad is None:
+                    self.assertIsNone(grads_batched[name], msg + ' ' + name)
+                    continue
+                np.testing.assert_allclose(
+                    grad.numpy(), grads_batched[name].numpy(), rtol=1e-7,
+                    atol=1e-10, err_msg=msg + ' ' + name)
+
+    def test_inner_modes(self):
+        import numpy as np
+        metatrain = _import_metatrain(self)
+
+        model, config, data_x, data_t, update_lr = _make_problem()
+        split_size = data_x.shape[1] // 2
+        results = dict()
+        for mode, truncate_steps in [('second_order', 1), ('first_order', 1),
+                                     ('truncated', 3), ('implicit', 1)]:
+            model.zero_grad()
+            res = metatrain.run_batched(
+                model, split_size, data_x, data_t, update_lr,
+                num_inner_updates=3, max_update_lr=config.output_max_lr,
+                inner_mode=mode, truncate_steps=truncate_steps)
+            n_node = _count_graph_nodes(res[-1])
+            res[-1].backward()
+            self.assertTrue(np.isfinite(res[-1].item()), mode)
+            results[mode] = ([val.item() for val in res], _grads(model),
+                             n_node)
+
+        # Truncating at least all inner updates is second order
+        values, grads, _ = results['second_order']
+        np.testing.assert_allclose(results['truncated'][0], values, rtol=1e-6)
+        for name, grad in grads.items():
+            if grad is not None:
+                np.testing.assert_allclose(
+                    results['truncated'][1][name].numpy(), grad.numpy(),
+                    rtol=1e-5, atol=1e-7, err_msg=name)
+
+        # First order changes meta-gradients, not values, with a smaller graph
+        np.testing.assert_allclose(results['first_order'][0], values,
+                                   rtol=1e-6)
+        self.assertLess(results['first_order'][2],
+                        results['second_order'][2])
+
+    def test_get_inner_mode(self):
+        metatrain = _import_metatrain(self)
+
+        config = configs.MetaConfig()
+        self.assertEqual(metatrain._get_inner_mode(config),
+                         ('second_order', 1))
+        config.meta_stop_grad = True
+        self.assertEqual(metatrain._get_inner_mode(config),
+                         ('first_order', 1))
+        config.meta_inner_mode = 'truncated'
+        with self.assertRaises(ValueError):
+            metatrain._get_inner_mode(config)
+
+    def test_benchmark_inner_modes(self):
+        metatrain = _import_metatrain(self)
+
+        _, config, data_x, data_t, _ = _make_problem()
+        results = metatrain.benchmark_inner_modes(
+            config, n_iter=1, data=(data_x, data_t))
+        for mode, (step_time, peak_memory) in results.items():
+            self.assertGreater(step_time, 0, mode)
+            self.assertGreater(peak_memory, 0, mode)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -412,12 +412,12 @@ def evaluate_across_epochs(path, values=None, select_dict=None, dataset='val', m
 
     model_var = 'epoch'
     models = list()
-    epochs = len(tools.get_modeldirs(os.path.join(model_dir,'epoch')))
+    epochs = tools.get_epochs(model_dir)
 
     if mode == 'angle':
         raise NotImplementedError('Not implemented yet')
 
-    for model in range(epochs):
+    for model in epochs:
         results = evaluate_weight_perturb(
             values, model, model_dir, n_rep=n_rep, perturb_output=False, perturb_mode='multiplicative',
             dataset=dataset, epoch=model, multidirection=multidirection)
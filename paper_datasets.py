@@ -2,18 +2,39 @@
 
 Convention is to name a function
 def make_datasetname_dataset()
+
+Builders save datasets through _save_proto, so that the same builder can
+either run serially, or be collected into independent jobs that run in a
+process pool (see make_dataset).
 """
 
+import io
+from contextlib import redirect_stdout
+from copy import deepcopy
+
 import configs
 import task
+import tools
 
 seed = 0
 
+# When not None, _save_proto queues jobs here instead of saving
+_jobs = None
+
+
+def _save_proto(config, seed=0, folder_name=None):
+    """Save a dataset, or queue it when collecting jobs."""
+    if _jobs is None:
+        task.save_proto(config=config, seed=seed, folder_name=folder_name)
+    else:
+        # Builders modify config in place between calls
+        _jobs.append((deepcopy(config), seed, folder_name))
+
 
 def make_standard_dataset():
     """Standard dataset."""
     task_config = task.input_ProtoConfig()
-    task.save_proto(config=task_config, seed=0, folder_name='standard')
+    _save_proto(config=task_config, seed=0, folder_name='standard')
 
 
 def make_primordial_dataset():
@@ -23,7 +44,7 @@ def make_primordial_dataset():
     config.has_special_odors = True
     config.n_class_valence = 3
     config.n_trueclass = 1000
-    task.save_proto(config, seed=seed, folder_name='primordial')
+    _save_proto(config, seed=seed, folder_name='primordial')
 
 
 def make_relabel_dataset(mode='large'):
@@ -44,7 +65,7 @@ def make_relabel_dataset(mode='large'):
         config.n_trueclass = i
         config.relabel = True
         fn = 'relabel_' + str(config.n_trueclass) + '_' + str(config.N_CLASS)
-        task.save_proto(config, seed=seed, folder_name=fn)
+        _save_proto(config, seed=seed, folder_name=fn)
         print('Done Relabel Dataset: ' + str(i))
 
 
@@ -56,8 +77,8 @@ def make_relabel_vary_or_dataset():
         task_config.relabel = True
         task_config.N_CLASS = 100
         task_config.n_trueclass = 200
-        task.save_proto(config=task_config, seed=0,
-                        folder_name='relabel_orn'+str(n_or))
+        _save_proto(config=task_config, seed=0,
+                    folder_name='relabel_orn'+str(n_or))
         print('Done Relabel Vary OR Dataset: ' + str(n_or))
 
 
@@ -70,8 +91,8 @@ def make_relabel_corr_vary_or_dataset():
         task_config.N_CLASS = 100
         task_config.n_trueclass = 200
         task_config.orn_corr = 0.1
-        task.save_proto(config=task_config, seed=0,
-                        folder_name='relabel_corr_orn'+str(n_or))
+        _save_proto(config=task_config, seed=0,
+                    folder_name='relabel_corr_orn'+str(n_or))
         print('Done Relabel Corr Vary OR Dataset: ' + str(n_or))
 
 
@@ -80,7 +101,7 @@ def make_concentration_dataset():
     config = configs.input_ProtoConfig()
     config.N_CLASS = 100
     config.vary_concentration = True
-    task.save_proto(config, seed=seed, folder_name='concentration')
+    _save_proto(config, seed=seed, folder_name='concentration')
     print('Done Concentration Dataset')
 
 
@@ -90,7 +111,7 @@ def make_mask_row_dataset():
     config.N_CLASS = 100
     for i in [.2, .4, .6, .8, 1]:
         config.spread_orn_activity = (True, i)
-        task.save_proto(config, seed=seed, folder_name='mask_row_' + str(i))
+        _save_proto(config, seed=seed, folder_name='mask_row_' + str(i))
     print('Done Mask Dataset')
 
 
@@ -103,7 +124,7 @@ def make_concentration_spread_dataset():
     for spread in [0, .3, .6, .9]:
         config.spread_orn_activity = spread
         fn = 'concentration_spread_{:0.2f}'.format(spread)
-        task.save_proto(config, seed=seed, folder_name=fn)
+        _save_proto(config, seed=seed, folder_name=fn)
     print('Done Concentration_Spread Dataset')
 
 
@@ -121,7 +142,7 @@ def make_concentration_relabel_spread_dataset():
     for spread in [0, .3, .6, .9]:
         config.spread_orn_activity = spread
         fn = 'concentration_relabel_spread_{:0.2f}'.format(spread)
-        task.save_proto(config, seed=seed, folder_name=fn)
+        _save_proto(config, seed=seed, folder_name=fn)
     print('Done Concentration_Spread Dataset')
 
 
@@ -133,7 +154,7 @@ def make_combinatorial_dataset():
     config.combinatorial_density = .2
     config.label_type = 'combinatorial'
     fn = 'combinatorial_' + str(config.N_CLASS) + '_' + str(config.combinatorial_density)
-    task.save_proto(config, seed=seed, folder_name=fn)
+    _save_proto(config, seed=seed, folder_name=fn)
 
 
 def make_small_training_set_dataset():
@@ -143,7 +164,7 @@ def make_small_training_set_dataset():
     for i in [100, 1000, 10000, 100000, 1000000]:
         config.n_train = i
         fn = 'small_training_set_' + str(i)
-        task.save_proto(config=config, seed=0, folder_name=fn)
+        _save_proto(config=config, seed=0, folder_name=fn)
         print('Done small training dataset: ' + str(i))
 
 
@@ -153,7 +174,7 @@ def make_multihead_dataset():
     task_config.label_type = 'multi_head_sparse'
     task_config.has_special_odors = True
     task_config.n_proto_valence = 5
-    task.save_proto(config=task_config, seed=0, folder_name='multihead')
+    _save_proto(config=task_config, seed=0, folder_name='multihead')
 
 
 def make_multihead_relabel_dataset():
@@ -170,8 +191,8 @@ def make_multihead_relabel_dataset():
     task_config.N_CLASS = 100
     task_config.n_trueclass = 200
 
-    task.save_proto(config=task_config, seed=0,
-                    folder_name='multihead_relabel')
+    _save_proto(config=task_config, seed=0,
+                folder_name='multihead_relabel')
 
 
 def make_multihead_relabel_no_special_odors_dataset():
@@ -188,8 +209,8 @@ def make_multihead_relabel_no_special_odors_dataset():
     task_config.N_CLASS = 100
     task_config.n_trueclass = 200
 
-    task.save_proto(config=task_config, seed=0,
-                    folder_name='multihead_relabel_no_special_odors')
+    _save_proto(config=task_config, seed=0,
+                folder_name='multihead_relabel_no_special_odors')
 
 
 def make_vary_or_dataset():
@@ -197,7 +218,7 @@ def make_vary_or_dataset():
     task_config = task.input_ProtoConfig()
     for n_or in [25, 35, 50, 75, 100, 150, 200]:
         task_config.N_ORN = n_or
-        task.save_proto(config=task_config, seed=0, folder_name='orn'+str(n_or))
+        _save_proto(config=task_config, seed=0, folder_name='orn'+str(n_or))
 
 
 def make_orncorr_dataset():
@@ -206,7 +227,7 @@ def make_orncorr_dataset():
     for orn_corr in [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
         task_config.orn_corr = orn_corr
         fn = 'orn_corr_{:0.2f}'.format(orn_corr)
-        task.save_proto(config=task_config, seed=0, folder_name=fn)
+        _save_proto(config=task_config, seed=0, folder_name=fn)
         print('Done orn_corr training dataset: ', orn_corr)
 
 
@@ -219,7 +240,7 @@ def make_orncorr_relabel_dataset():
         task_config.N_CLASS = 100
         task_config.n_trueclass = 200
         fn = 'orn_corr_relabel_{:0.2f}'.format(orn_corr)
-        task.save_proto(config=task_config, seed=0, folder_name=fn)
+        _save_proto(config=task_config, seed=0, folder_name=fn)
         print('Done orn_corr_relabel training dataset: ', orn_corr)
 
 
@@ -230,9 +251,51 @@ def make_multi_or_dataset():
     for n_or_per_orn in [0, 50]:
         task_config.n_or_per_orn = n_or_per_orn
         fn = 'n_or_per_orn'+str(n_or_per_orn)
-        task.save_proto(config=task_config, seed=0, folder_name=fn)
+        _save_proto(config=task_config, seed=0, folder_name=fn)
 
 
-def make_dataset(dataset_name):
+def get_dataset_jobs(dataset_name):
+    """Return the (config, seed, folder_name) jobs of a dataset builder."""
+    global _jobs
     func_name = 'make_' + dataset_name + '_dataset'
-    globals()[func_name]()  # call function by the name func_name
+    _jobs = []
+    try:
+        # Builders print progress as if datasets were saved, silence it
+        with redirect_stdout(io.StringIO()):
+            globals()[func_name]()
+        jobs = _jobs
+    finally:
+        _jobs = None
+    return jobs
+
+
+def make_dataset(dataset_name, n_workers=1, force=False):
+    """Make datasets by name.
+
+    Args:
+        dataset_name: str, calls make_[dataset_name]_dataset
+        n_workers: int, if > 1, save the datasets of a sweep in parallel
+            worker processes, each limited to a single BLAS thread
+        force: bool, if True, regenerate datasets that are up to date
+    """
+    if n_workers <= 1 and not force:
+        func_name = 'make_' + dataset_name + '_dataset'
+        globals()[func_name]()  # call function by the name func_name
+        return
+
+    jobs = [job + (force,) for job in get_dataset_jobs(dataset_name)]
+    if n_workers <= 1:
+        for job in jobs:
+            task.save_proto(*job)
+        return
+
+    print('Making {:d} datasets for {:s} with {:d} workers'.format(
+        len(jobs), dataset_name, n_workers))
+    tools.run_parallel(task.save_proto, jobs, n_workers=n_workers)
+
+
+def print_dataset_status(dataset_name):
+    """Print which datasets of a builder are up to date."""
+    for config, seed, folder_name in get_dataset_jobs(dataset_name):
+        fresh, folder_path = task.is_proto_fresh(config, seed, folder_name)
+        print('{:s}  {:s}'.format('fresh' if fresh else 'stale', folder_path))
@@ -1,21 +1,44 @@
-"""User specific settings."""
+"""User specific settings.
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-
-mpl.rcParams['font.size'] = 7
-mpl.rcParams['pdf.fonttype'] = 42
-mpl.rcParams['ps.fonttype'] = 42
-mpl.rcParams['font.family'] = 'arial'
-mpl.rcParams['mathtext.fontset'] = 'stix'
-
-seqcmap = mpl.cm.cool_r
-try:
-    import seaborn as sns
-    plt.rcParams['axes.prop_cycle'] = plt.cycler(color=sns.color_palette('deep'))
-    # seqcmap = sns.color_palette("crest_r", as_cmap=True)
-except ImportError as e:
-    print('Seaborn not available, default to matplotlib color scheme')
+Importing this module is cheap. Plotting modules call configure_plots to
+apply the matplotlib style.
+"""
 
 use_torch = True
 cluster_path = '/share/ctn/users/gy2259/olfaction_evolution'
+
+_plots_configured = False
+
+
+def configure_plots():
+    """Apply the matplotlib style, once."""
+    global _plots_configured
+    if _plots_configured:
+        return
+    _plots_configured = True
+
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+
+    mpl.rcParams['font.size'] = 7
+    mpl.rcParams['pdf.fonttype'] = 42
+    mpl.rcParams['ps.fonttype'] = 42
+    mpl.rcParams['font.family'] = 'arial'
+    mpl.rcParams['mathtext.fontset'] = 'stix'
+
+    try:
+        import seaborn as sns
+        plt.rcParams['axes.prop_cycle'] = plt.cycler(color=sns.color_palette('deep'))
+        # seqcmap = sns.color_palette("crest_r", as_cmap=True)
+    except ImportError as e:
+        print('Seaborn not available, default to matplotlib color scheme')
+
+
+def __getattr__(name):
+    # Colormaps need matplotlib, load them on first use
+    if name == 'seqcmap':
+        import matplotlib as mpl
+        configure_plots()
+        return mpl.cm.cool_r
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
@@ -32,7 +32,8 @@ def load_activity_tf(save_path, lesion_kwargs=None):
     config.label_type = 'sparse'
 
     # Load dataset
-    train_x, train_y, val_x, val_y = task.load_data(config.data_dir)
+    val_x, val_y = task.load_data(config.data_dir, splits=('val',),
+                                  mmap_mode='r')
 
     tf.reset_default_graph()
     if config.model == 'full':
@@ -77,7 +78,8 @@ def load_activity_torch(save_path, lesion_kwargs=None):
     config = tools.load_config(save_path)
 
     # Load dataset
-    train_x, train_y, val_x, val_y = task.load_data(config.data_dir)
+    val_x, val_y = task.load_data(config.data_dir, splits=('val',),
+                                  mmap_mode='r')
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     with torch.no_grad():
@@ -91,8 +93,8 @@ def load_activity_torch(save_path, lesion_kwargs=None):
                 model.lesion_units(key, val)
 
         # validation
-        val_data = torch.from_numpy(val_x).float().to(device)
-        val_target = torch.from_numpy(val_y).long().to(device)
+        val_data = torch.from_numpy(np.array(val_x)).float().to(device)
+        val_target = torch.from_numpy(np.array(val_y)).long().to(device)
 
         model.eval()
         results = model(val_data, val_target)
@@ -19,6 +19,8 @@ import standard.analysis_weight as analysis_weight
 from tools import save_fig
 import settings
 
+settings.configure_plots()
+
 
 LABELS = ['Input degree', 'Conn. to valence', 'Conn. to identity']
 TICKS = [(1, 7, 15), None, None]
@@ -518,7 +520,8 @@ def lesion_analysis_tf(config, units=None):
     tf.reset_default_graph()
 
     # Load dataset
-    train_x, train_y, val_x, val_y = task.load_data(config.data_dir)
+    val_x, val_y = task.load_data(config.data_dir, splits=('val',),
+                                  mmap_mode='r')
 
     # Build validation model
     val_x_ph = tf.placeholder(val_x.dtype, val_x.shape)
@@ -89,11 +89,14 @@ def correlation_across_epochs(save_path, legend = None, arg = 'weight'):
     ys = []
     for i, d in enumerate(dirs):
         list_of_corr_coef = []
-        epoch_dirs = tools.get_modeldirs(os.path.join(d,'epoch'))
-        for epoch_dir in epoch_dirs:
-            if arg == 'weight':
-                data = tools.load_pickles(epoch_dir, 'w_orn')[0]
-            elif arg == 'activity':
+        if arg == 'weight':
+            for data in tools.load_pickles(os.path.join(d, 'epoch'), 'w_orn'):
+                list_of_corr_coef.append(_correlation(data))
+            ys.append(list_of_corr_coef)
+            continue
+        for epoch in tools.get_epochs(d):
+            epoch_dir = os.path.join(d, 'epoch', str(epoch).zfill(4))
+            if arg == 'activity':
                 glo_in, glo_out, kc_out, results = _load_epoch_activity(d, epoch_dir)
                 data = glo_out
             else:
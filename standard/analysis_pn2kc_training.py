@@ -37,13 +37,17 @@ def _set_colormap(nbins):
 def compute_sparsity(d, epoch, dynamic_thres=False, visualize=False,
                      thres=THRES):
     print('compute sparsity needs to be replaced')
-    wglos = tools.load_pickles(os.path.join(d, 'epoch'), 'w_glo')
-    w = wglos[epoch]
+    w = tools.load_epoch_pickle(d, epoch)['w_glo']
     sparsity, thres = _compute_sparsity(w, dynamic_thres, visualize, thres)
     return sparsity
 
 
-def _compute_sparsity(w, dynamic_thres=False, visualize=False, thres=THRES):
+def _compute_sparsity(w, dynamic_thres=False, visualize=False, thres=THRES,
+                      estimator=None):
+    """Number of connections above threshold of each neuron.
+
+    estimator is passed to infer_threshold, reuse one to warm-start.
+    """
     w[np.isnan(w)] = 0
 
     # dynamically infer threshold after training
@@ -53,7 +57,8 @@ def _compute_sparsity(w, dynamic_thres=False, visualize=False, thres=THRES):
         thres = None
     else:
         thres = dynamic_thres
-    thres, _ = infer_threshold(w, visualize=visualize, force_thres=thres)
+    thres, _ = infer_threshold(w, visualize=visualize, force_thres=thres,
+                               estimator=estimator)
     if dynamic_thres:
         print('dynamic thres = {:0.5f}'.format(thres))
     else:
@@ -67,7 +72,11 @@ def plot_sparsity(modeldir, epoch=None, xrange=50, plot=True):
     model_name = tools.get_model_name(modeldir)
     config = tools.load_config(modeldir)
     if epoch is not None and epoch != -1:
-        modeldir = tools.get_modeldirs(os.path.join(modeldir, 'epoch'))[epoch]
+        w_glo = tools.load_epoch_pickle(modeldir, epoch)['w_glo']
+        log = dict()
+    else:
+        w_glo = None
+        log = tools.load_log(modeldir)
 
     if (('kc_prune_weak_weights' in dir(config) and
          config.kc_prune_weak_weights)
@@ -77,9 +86,9 @@ def plot_sparsity(modeldir, epoch=None, xrange=50, plot=True):
     else:
         prune = False
 
-    log = tools.load_log(modeldir)
     if 'sparsity_inferred' not in log:
-        w_glo = tools.load_pickle(modeldir)['w_glo']
+        if w_glo is None:
+            w_glo = tools.load_pickle(modeldir)['w_glo']
         if prune:
             sparsity, thres_inferred = _compute_sparsity(
                 w_glo, dynamic_thres=False, thres=config.kc_prune_threshold)
@@ -197,9 +206,9 @@ def plot_distribution(modeldir, epoch=None, xrange=1.0, **kwargs):
     model_name = tools.get_model_name(modeldir)
     config = tools.load_config(modeldir)
     if epoch is not None:
-        modeldir = tools.get_modeldirs(os.path.join(modeldir, 'epoch'))[epoch]
-
-    w = tools.load_pickles(modeldir, 'w_glo')[0]
+        w = tools.load_epoch_pickle(modeldir, epoch)['w_glo']
+    else:
+        w = tools.load_pickles(modeldir, 'w_glo')[0]
     w[np.isnan(w)] = 0
     distribution = w.flatten()
 
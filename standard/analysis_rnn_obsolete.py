@@ -11,6 +11,8 @@ import tools
 import standard.analysis_pn2kc_training
 import settings
 
+settings.configure_plots()
+
 use_torch = settings.use_torch
 
 def _easy_weights(w_plot, x_label, y_label, dir_ix, save_path, xticks=None, extra_str ='', vlim = None):
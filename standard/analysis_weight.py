@@ -69,8 +69,149 @@ def fit_multimodal(x, max_n_modal=2, verbose=False):
     return x_plot, np.array(pdfs), clf, n_modal
 
 
+def _normal_pdf(x, mean, var):
+    return np.exp(-(x - mean)**2 / (2 * var)) / np.sqrt(2 * np.pi * var)
+
+
+class ThresholdEstimator(object):
+    """Fit 1 and 2 gaussian mixtures to log-weights, and find the threshold.
+
+    A fast replacement of fit_multimodal for infer_threshold. The data is
+    binned once in a histogram of n_bins between its min and max, and EM
+    runs on the bin centers weighted by counts, so the cost of EM does not
+    depend on the number of weights. The mixture is chosen by BIC as in
+    fit_multimodal, and the crossing of the two weighted pdfs is solved in
+    closed form.
+
+    The 2-component fit starts from the previous solution when there is
+    one, so refitting weights of successive epochs takes a few iterations.
+
+    Torch tensors are binned on their device with torch.histc, only the
+    histogram is copied to cpu.
+
+    Args:
+        n_bins: int, number of histogram bins
+        max_iter: int, maximum number of EM iterations
+        tol: float, tolerance on the mean log-likelihood
+    """
+
+    def __init__(self, n_bins=1000, max_iter=100, tol=1e-3):
+        self.n_bins = n_bins
+        self.max_iter = max_iter
+        self.tol = tol
+        self.params = None  # weights, means, variances of last 2-modal fit
+
+    def histogram(self, x):
+        """Histogram of data x, np array or torch tensor.
+
+        Returns:
+            centers: np array (n_bins,)
+            counts: np array (n_bins,)
+            bin_width: float
+        """
+        if isinstance(x, np.ndarray):
+            x_min, x_max = x.min(), x.max()
+            counts, edges = np.histogram(x, bins=self.n_bins,
+                                         range=(x_min, x_max))
+        else:
+            x_min, x_max = x.min().item(), x.max().item()
+            counts = x.histc(bins=self.n_bins, min=x_min, max=x_max)
+            counts = counts.cpu().numpy()
+            edges = np.linspace(x_min, x_max, self.n_bins + 1)
+        centers = (edges[1:] + edges[:-1]) / 2
+        bin_width = max(edges[1] - edges[0], 1e-12)
+        return centers, counts.astype(np.float64), bin_width
+
+    def _em(self, centers, counts, bin_width, weights, means, variances):
+        """Run EM on a histogram, return weights, means, variances, loglik."""
+        n = counts.sum()
+        # Spread of values within a bin, Sheppard's correction
+        min_var = bin_width**2 / 12 + 1e-6
+        loglik_old = -np.inf
+        for _ in range(self.max_iter):
+            dens = weights[:, np.newaxis] * _normal_pdf(
+                centers, means[:, np.newaxis], variances[:, np.newaxis])
+            total = np.maximum(dens.sum(axis=0), 1e-300)
+            loglik = np.sum(counts * np.log(total)) / n
+            resp = dens / total * counts  # (n_modal, n_bins)
+            nk = resp.sum(axis=1) + 1e-10
+            weights = nk / n
+            means = resp.dot(centers) / nk
+            variances = (resp.dot(centers**2) / nk - means**2
+                         + bin_width**2 / 12)
+            variances = np.maximum(variances, min_var)
+            if abs(loglik - loglik_old) < self.tol:
+                break
+            loglik_old = loglik
+        dens = weights[:, np.newaxis] * _normal_pdf(
+            centers, means[:, np.newaxis], variances[:, np.newaxis])
+        loglik = np.sum(counts * np.log(np.maximum(dens.sum(axis=0), 1e-300)))
+        return weights, means, variances, loglik
+
+    def fit(self, x):
+        """Fit mixtures to data x, np array or torch tensor.
+
+        Returns:
+            weights, means, variances: np arrays of the mixture chosen by
+                BIC, sorted by mean
+        """
+        centers, counts, bin_width = self.histogram(x)
+        n = counts.sum()
+        fits = []
+
+        mean = counts.dot(centers) / n
+        var = max(counts.dot((centers - mean)**2) / n + bin_width**2 / 12,
+                  1e-6)
+        fits.append(self._em(centers, counts, bin_width, np.array([1.]),
+                             np.array([mean]), np.array([var])))
+
+        if self.params is not None:
+            weights, means, variances = self.params
+        else:
+            weights = np.array([.9, .1])
+            means = np.array([-5., 0.])
+            variances = np.array([var, var])
+        fits.append(self._em(centers, counts, bin_width, weights, means,
+                             variances))
+        self.params = fits[1][:3]
+
+        # Number of parameters of 1-D mixtures, as in GaussianMixture.bic
+        bics = [-2 * fit[3] + (3 * k - 1) * np.log(n)
+                for k, fit in zip([1, 2], fits)]
+        weights, means, variances, _ = fits[int(np.argmin(bics))]
+        ind_sort = np.argsort(means)
+        return weights[ind_sort], means[ind_sort], variances[ind_sort]
+
+    @staticmethod
+    def crossing(weights, means, variances, x_min, x_max):
+        """First x in [x_min, x_max] where modal 2 exceeds modal 1.
+
+        Returns:
+            x or None if modal 2 never exceeds modal 1 in the range
+        """
+        # log(w1 pdf1) - log(w0 pdf0) = a x^2 + b x + c
+        a = 1 / (2 * variances[0]) - 1 / (2 * variances[1])
+        b = means[1] / variances[1] - means[0] / variances[0]
+        c = (np.log(weights[1]) - np.log(weights[0])
+             - np.log(variances[1]) / 2 + np.log(variances[0]) / 2
+             - means[1]**2 / (2 * variances[1])
+             + means[0]**2 / (2 * variances[0]))
+
+        def g(x):
+            return a * x**2 + b * x + c
+
+        if g(x_min) > 0:
+            return x_min
+        roots = np.roots([a, b, c]) if a != 0 else np.roots([b, c])
+        roots = np.sort(np.real(roots[np.isreal(roots)]))
+        for root in roots:
+            if x_min < root <= x_max and 2 * a * root + b > 0:
+                return root
+        return None
+
+
 def infer_threshold(x, use_logx=True, visualize=False, force_thres=None,
-                    downsample=True):
+                    downsample=True, estimator=None):
 
     """Infers the threshold of a bi-modal distribution.
 
@@ -79,6 +220,10 @@ def infer_threshold(x, use_logx=True, visualize=False, force_thres=None,
     Args:
         x: an array containing the values to be fitted
         use_logx: bool, if True, fit log-input
+        estimator: None, ThresholdEstimator, or 'gmm'. If None, a new
+            ThresholdEstimator is used. Reuse an estimator to warm-start from
+            its previous fit. 'gmm' fits sklearn GaussianMixture on data
+            downsampled to 1e5 values, see fit_multimodal
 
     Returns:
         thres: a scalar threshold that separates the two gaussians
@@ -88,27 +233,53 @@ def infer_threshold(x, use_logx=True, visualize=False, force_thres=None,
     # weak connections should be around median, where strong should be around max
     res_fit = {}
 
-    x = np.array(x)
-    ratio = np.max(x, axis=0) / np.median(x, axis=0)
+    use_gmm = isinstance(estimator, str) and estimator == 'gmm'
+    # Torch tensors are processed on their device, except for 'gmm'
+    use_torch = hasattr(x, 'detach') and not use_gmm
+    if use_torch:
+        x = x.detach()
+        ratio = x.max(dim=0)[0] / x.quantile(0.5, dim=0)
+    else:
+        x = np.array(x.cpu() if hasattr(x, 'detach') else x)
+        ratio = np.max(x, axis=0) / np.median(x, axis=0)
     # heuristic that works well for N=50-500, can plot hist of ratio
     ind = ratio > 15
-    if np.sum(ind) > 0:
+    if ind.sum() > 0:
         x = x[:, ind]  # select expansion layer neurons
 
     x = x.flatten()
 
-    if downsample:
+    if downsample and use_gmm:
         if len(x) > 1e5:
             x = np.random.choice(x, size=(int(1e5),))
 
     if use_logx:
-        x = np.log(x + 1e-10)
+        x = x.add(1e-10).log() if use_torch else np.log(x + 1e-10)
 
     if force_thres is not None:
         thres_ = np.log(force_thres) if use_logx else force_thres
     else:
         thres_not_found = False
-        x_plot, pdfs, clf, n_modal = fit_multimodal(x)
+        if use_gmm:
+            x_plot, pdfs, clf, n_modal = fit_multimodal(x)
+            crossing = None
+            if n_modal >= 2:
+                diff = pdfs[0] < np.sum(pdfs[1:], axis=0)
+                ind_diff = np.where(diff)[0]
+                if len(ind_diff) > 0:
+                    crossing = x_plot[ind_diff[0]]
+        else:
+            if estimator is None:
+                estimator = ThresholdEstimator()
+            weights, means, variances = estimator.fit(x)
+            n_modal = len(means)
+            x_plot = np.linspace(float(x.min()), float(x.max()), 1000)
+            pdfs = np.array([w * _normal_pdf(x_plot, m, v) for w, m, v
+                             in zip(weights, means, variances)])
+            crossing = None
+            if n_modal >= 2:
+                crossing = estimator.crossing(weights, means, variances,
+                                              x_plot[0], x_plot[-1])
         res_fit['x_plot'] = x_plot
         res_fit['pdfs'] = pdfs
         res_fit['n_modal'] = n_modal
@@ -117,13 +288,11 @@ def infer_threshold(x, use_logx=True, visualize=False, force_thres=None,
             print('Only 1 modal found')
             thres_not_found = True
         else:
-            diff = pdfs[0] < np.sum(pdfs[1:], axis=0)
-            ind_diff = np.where(diff)[0]
-            if len(ind_diff) == 0:
+            if crossing is None:
                 thres_not_found = True
                 print('Unable to find proper threshold, revert to default')
             else:
-                thres_ = x_plot[ind_diff[0]]
+                thres_ = crossing
                 thres = np.exp(thres_) if use_logx else thres_
                 # empirical value, typical threshold higher than 1e-1
                 if thres < 1e-4:
@@ -136,6 +305,8 @@ def infer_threshold(x, use_logx=True, visualize=False, force_thres=None,
     thres = np.exp(thres_) if use_logx else thres_
 
     if visualize:
+        if use_torch:
+            x = x.cpu().numpy()
         bins = np.linspace(x.min(), x.max(), 100)
         fig = plt.figure(figsize=(3, 3))
         ax = fig.add_axes([0.2, 0.2, 0.7, 0.7])
@@ -8,19 +8,27 @@ from configs import FullConfig, SingleLayerConfig
 from tools import vary_config
 import tools
 
-try:
-    import standard.analysis as sa
-    import standard.analysis_pn2kc_training as analysis_pn2kc_training
-    import standard.analysis_pn2kc_random as analysis_pn2kc_random
-    import standard.analysis_orn2pn as analysis_orn2pn
-    import standard.analysis_activity as analysis_activity
-    import standard.analysis_multihead as analysis_multihead
-    import standard.analysis_metalearn as analysis_metalearn
-    import analytical.numerical_test as numerical_test
-    import analytical.analyze_simulation_results as analyze_simulation_results
-    import standard.analysis_nonnegative as analysis_nonnegative
-except ImportError as e:
-    print(e)
+
+def _import_analysis():
+    """Import analysis modules, only needed by analysis functions."""
+    global sa, analysis_pn2kc_training, analysis_pn2kc_random, \
+        analysis_orn2pn, analysis_activity, analysis_multihead, \
+        analysis_metalearn, numerical_test, analyze_simulation_results, \
+        analysis_nonnegative
+    try:
+        import standard.analysis as sa
+        import standard.analysis_pn2kc_training as analysis_pn2kc_training
+        import standard.analysis_pn2kc_random as analysis_pn2kc_random
+        import standard.analysis_orn2pn as analysis_orn2pn
+        import standard.analysis_activity as analysis_activity
+        import standard.analysis_multihead as analysis_multihead
+        import standard.analysis_metalearn as analysis_metalearn
+        import analytical.numerical_test as numerical_test
+        import analytical.analyze_simulation_results as analyze_simulation_results
+        import standard.analysis_nonnegative as analysis_nonnegative
+    except ImportError as e:
+        print(e)
+
 
 testing_epochs = 12
 
@@ -15,16 +15,21 @@ from tools import vary_config
 import tools
 import settings
 
-try:
-    import standard.analysis as sa
-    import standard.analysis_pn2kc_training as analysis_pn2kc_training
-    import standard.analysis_pn2kc_random as analysis_pn2kc_random
-    import standard.analysis_orn2pn as analysis_orn2pn
-    import standard.analysis_rnn as analysis_rnn
-    import standard.analysis_activity as analysis_activity
-    import standard.analysis_multihead as analysis_multihead
-except ImportError as e:
-    print(e)
+
+def _import_analysis():
+    """Import analysis modules, only needed by analysis functions."""
+    global sa, analysis_pn2kc_training, analysis_pn2kc_random, \
+        analysis_orn2pn, analysis_rnn, analysis_activity, analysis_multihead
+    try:
+        import standard.analysis as sa
+        import standard.analysis_pn2kc_training as analysis_pn2kc_training
+        import standard.analysis_pn2kc_random as analysis_pn2kc_random
+        import standard.analysis_orn2pn as analysis_orn2pn
+        import standard.analysis_rnn as analysis_rnn
+        import standard.analysis_activity as analysis_activity
+        import standard.analysis_multihead as analysis_multihead
+    except ImportError as e:
+        print(e)
 
 
 use_torch = settings.use_torch
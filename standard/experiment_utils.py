@@ -123,8 +123,74 @@ def cluster_train(config, path):
     subprocess.call(['sbatch', jobfile])
 
 
+def _init_train_worker(n_threads):
+    """Cap the torch thread pools of a training worker."""
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    if use_torch:
+        import torch
+        torch.set_num_threads(n_threads)
+        torch.set_num_interop_threads(1)
+
+
+def parallel_local_train(configs, path=None, n_workers=None):
+    """Train models locally in a pool of worker processes.
+
+    Cores are split evenly between workers, and every worker caps its torch
+    and BLAS thread pools to its share. Workers read the training data from
+    a memory-mapped dataset, shared through the page cache, see
+    configs.shared_data. Jobs are started from the largest model, using
+    N_KC as cost estimate, and utilization is reported at the end.
+
+    Args:
+        configs: list of configs
+        path: str, path to save models
+        n_workers: None or int, number of worker processes. Default is
+            one worker per config, up to the number of cores
+    """
+    n_cpu = os.cpu_count()
+    if n_workers is None:
+        n_workers = min(len(configs), n_cpu)
+    n_threads = max(1, n_cpu // n_workers)
+    print('Training {:d} models with {:d} workers, {:d} threads each'.format(
+        len(configs), n_workers, n_threads))
+
+    for config in configs:
+        config.shared_data = True
+    costs = [getattr(config, 'N_KC', 0) for config in configs]
+    jobs = [(config, path) for config in configs]
+    tools.run_parallel(local_train, jobs, n_workers=n_workers,
+                       n_threads=n_threads, initializer=_init_train_worker,
+                       initargs=(n_threads,), costs=costs)
+
+
+def local_train_ensembles(configs, path=None):
+    """Train models locally, together when they only differ in MEMBER_KEYS.
+
+    See torchensemble.train_ensemble and torchensemble.MEMBER_KEYS, e.g. lr.
+    Meta-training configs and models other than full models are trained
+    one by one.
+    """
+    import torchensemble
+
+    if path is None:
+        path = './'
+
+    train_configs = []
+    for config in configs:
+        if 'meta_lr' in dir(config) or config.model != 'full':
+            local_train(config, path=path)
+        else:
+            config.save_path = os.path.join(
+                path, 'files', config.experiment_name, config.model_name)
+            train_configs.append(config)
+
+    for group in torchensemble.group_ensembles(train_configs):
+        torchensemble.train_ensemble(group)
+
+
 def train_experiment(experiment, use_cluster=False, path=None,
-                     testing=False, n_pn=None, **kwargs):
+                     testing=False, n_pn=None, ensemble=False, n_workers=1,
+                     **kwargs):
     """Train model across platforms given experiment name.
 
     Args:
@@ -134,6 +200,10 @@ def train_experiment(experiment, use_cluster=False, path=None,
         path: str, path to save models and config
         train_arg: None or str
         testing: bool, whether to test run
+        ensemble: bool, if True, locally train compatible models together,
+            see local_train_ensembles. Requires torch
+        n_workers: int, if > 1, locally train models in parallel worker
+            processes, see parallel_local_train
     """
     if path is None:
         # Default path
@@ -169,6 +239,15 @@ def train_experiment(experiment, use_cluster=False, path=None,
         if testing:
             config.max_epoch = 2
 
+    if ensemble and not use_cluster and use_torch:
+        local_train_ensembles(configs, path=path)
+        return
+
+    if n_workers > 1 and not use_cluster:
+        parallel_local_train(configs, path=path, n_workers=n_workers)
+        return
+
+    for config in configs:
         if use_cluster:
             cluster_train(config, path=path)
         else:
@@ -183,6 +262,7 @@ def analyze_experiment(experiment, n_pn=None):
     experiment_found = False
     for experiment_file in experiment_files:
         if (experiment + '_analysis') in dir(experiment_file):
+            experiment_file._import_analysis()
             if n_pn is None:
                 getattr(experiment_file, experiment + '_analysis')(path)
             else:
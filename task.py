@@ -1,5 +1,7 @@
 import os
+import json
 import shutil
+import hashlib
 
 import numpy as np
 import scipy.stats as stats
@@ -9,19 +11,323 @@ import tools
 from configs import input_ProtoConfig, InputAutoEncode
 
 
-def _get_labels(prototypes, odors, percent_generalization, weights=None):
-    dist = euclidean_distances(prototypes, odors)
-    if percent_generalization < 100:
-        highest_match = np.min(dist, axis=0)
-        threshold = np.percentile(highest_match.flatten(), percent_generalization)
-        default_class = (1e-6+threshold) * np.ones((1, dist.shape[1]))
-        dist = np.vstack((default_class, dist))
+# Number of odors labeled at once by _get_labels, bounds peak memory
+LABEL_BLOCK_SIZE = 8192
+
+# Increase whenever a change to the generator changes the saved datasets,
+# so that cached datasets are regenerated
+GENERATOR_VERSION = 1
+
+# Dataset file and rows per chunk of datasets saved in HDF5
+HDF5_FILE = 'data.h5'
+HDF5_CHUNK_ROWS = 4096
+
+
+def _argmin_with_margin(scores, tol):
+    """Argmin over axis 0, and whether the runner-up is within tol.
+
+    scores is modified in place.
+    """
+    cols = np.arange(scores.shape[1])
+    ind = np.argmin(scores, axis=0)
+    best = scores[ind, cols]
+    scores[ind, cols] = np.inf
+    second = np.min(scores, axis=0)
+    return ind, (second - best) <= tol
+
 
+def _get_labels(prototypes, odors, percent_generalization, weights=None,
+                block_size=LABEL_BLOCK_SIZE, threshold=None):
+    """Label each odor by its nearest prototype.
+
+    Distances are computed in blocks of odors with a float32 GEMM, keeping
+    only the running argmin for each odor, so peak memory scales with
+    n_proto * block_size instead of n_proto * n_odor. Odors whose two best
+    candidates are too close to be ranked in float32 are recomputed in
+    float64, so labels match the full float64 distance matrix.
+
+    Args:
+        prototypes: np array (n_proto, n_orn)
+        odors: np array (n_odor, n_orn)
+        percent_generalization: float, if below 100, odors farther from all
+            prototypes than this percentile of nearest distances get the
+            default label 0, and prototype labels start at 1
+        weights: None or non-negative np array (n_label,), rescales the
+            distance to each label (including the default one)
+        block_size: int, number of odors labeled at once
+        threshold: None or float, distance beyond which odors get the
+            default label. If None, set from percent_generalization
+
+    Returns:
+        labels: np array (n_odor,)
+    """
+    prototypes = np.asarray(prototypes, dtype=np.float64)
+    n_proto, n_dim = prototypes.shape
+    n_odor = odors.shape[0]
+    has_default = percent_generalization < 100
+
+    proto_weights = None
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64).flatten()
+        assert weights.shape[0] == n_proto + int(has_default), \
+            'not the same dimension'
+        proto_weights = weights[int(has_default):]
+
+    proto_sq = np.einsum('ij,ij->i', prototypes, prototypes)
+    prototypes32 = prototypes.astype(np.float32)
+    proto_sq32 = proto_sq.astype(np.float32)
+    # Worst-case float32 error of the squared distances, relative to the
+    # squared norms entering the GEMM
+    rel_tol = 4 * n_dim * np.finfo(np.float32).eps
+    max_scale = 1. if proto_weights is None else np.max(proto_weights) ** 2
+
+    ind_nearest = np.empty(n_odor, dtype=np.int64)
+    ind_weighted = np.empty(n_odor, dtype=np.int64)
+    for start in range(0, n_odor, block_size):
+        x = np.asarray(odors[start:start+block_size], dtype=np.float64)
+        x_sq = np.einsum('ij,ij->i', x, x)
+        sq = np.dot(prototypes32, x.astype(np.float32).T)
+        sq *= -2
+        sq += proto_sq32[:, np.newaxis]
+        sq += x_sq.astype(np.float32)[np.newaxis, :]
+        tol = rel_tol * (np.max(proto_sq) + x_sq)
+
+        if proto_weights is not None:
+            scores = sq * (proto_weights ** 2).astype(np.float32)[:, np.newaxis]
+            ind_w, ambiguous_w = _argmin_with_margin(scores, tol * max_scale)
+        ind, ambiguous = _argmin_with_margin(sq, tol)
+        if proto_weights is None:
+            ind_w, ambiguous_w = ind, ambiguous
+
+        recompute = np.where(ambiguous | ambiguous_w)[0]
+        if len(recompute) > 0:
+            x_re = x[recompute]
+            dist = (proto_sq[:, np.newaxis] + x_sq[recompute][np.newaxis, :]
+                    - 2 * np.dot(prototypes, x_re.T))
+            dist = np.sqrt(np.maximum(dist, 0))
+            ind[recompute] = np.argmin(dist, axis=0)
+            if proto_weights is not None:
+                dist = proto_weights[:, np.newaxis] * dist
+                ind_w[recompute] = np.argmin(dist, axis=0)
+
+        ind_nearest[start:start+block_size] = ind
+        ind_weighted[start:start+block_size] = ind_w
+
+    if not has_default:
+        return ind_weighted
+
+    def _dist_to(ind):
+        dist = np.empty(n_odor)
+        for start in range(0, n_odor, block_size):
+            x = np.asarray(odors[start:start+block_size], dtype=np.float64)
+            p = prototypes[ind[start:start+block_size]]
+            d = (proto_sq[ind[start:start+block_size]]
+                 + np.einsum('ij,ij->i', x, x)
+                 - 2 * np.einsum('ij,ij->i', p, x))
+            dist[start:start+block_size] = np.sqrt(np.maximum(d, 0))
+        return dist
+
+    highest_match = _dist_to(ind_nearest)
+    if threshold is None:
+        threshold = np.percentile(highest_match, percent_generalization)
+    default_dist = 1e-6 + threshold
+    match_dist = (highest_match if proto_weights is None
+                  else proto_weights[ind_weighted] * _dist_to(ind_weighted))
     if weights is not None:
-        assert dist.shape[0] == weights.shape[0], 'not the same dimension'
-        weights = np.repeat(weights.reshape(-1,1), dist.shape[1], axis=1)
-        dist = weights * dist
-    return np.argmin(dist, axis=0)
+        default_dist = weights[0] * default_dist
+    # Ties go to the default class, as in argmin over [default; prototypes]
+    return np.where(default_dist <= match_dist, 0, ind_weighted + 1)
+
+
+def _get_rng(rng):
+    """Return a RandomState from None, an int seed or a RandomState."""
+    if isinstance(rng, np.random.RandomState):
+        return rng
+    return np.random.RandomState(rng)
+
+
+def _uniform_like(x, size, rng):
+    """Uniform [0, 1) samples with the backend, device and dtype of x.
+
+    Torch samples are drawn from a generator seeded by rng.
+    """
+    if isinstance(x, np.ndarray):
+        return rng.uniform(0, 1, size)
+    import torch
+    generator = torch.Generator(device=x.device)
+    generator.manual_seed(int(rng.randint(2**31)))
+    return torch.rand(size, generator=generator, device=x.device,
+                      dtype=x.dtype)
+
+
+def _as_array_like(x, a):
+    """Convert numpy array a to the backend, device and dtype of x."""
+    if isinstance(x, np.ndarray):
+        return a
+    import torch
+    return torch.as_tensor(a, dtype=x.dtype, device=x.device)
+
+
+class MaskRow(object):
+    """Only keep a random number of ORNs active for each odor.
+
+    The number of active ORNs is drawn from a bimodal set of values, then
+    the active ORNs are the ones with the smallest random keys.
+
+    Args:
+        spread: varies from [0, 1). 0 means no spread, 1 means maximum spread.
+    """
+
+    def __init__(self, spread):
+        assert spread >= 0 and spread < 1, 'spread is not within range of [0, 1)'
+        self.spread = spread
+
+    def __call__(self, x, rng=None):
+        rng = _get_rng(rng)
+        n_samples, n_orn = x.shape
+        mask_degree = np.round(n_orn * (1 - self.spread) / 2).astype(int)
+        # Small number of ORNs active
+        list_of_numbers = list(range(1, mask_degree))
+        # Large number of ORNs active
+        list_of_numbers = list_of_numbers + list(range(n_orn - mask_degree, n_orn))
+
+        # For each sample odor, how many ORNs will be active
+        n_orn_active = rng.choice(list_of_numbers, size=n_samples, replace=True)
+        keys = _uniform_like(x, (n_samples, n_orn), rng)
+        # The n-th smallest key of each odor
+        if isinstance(x, np.ndarray):
+            kth_keys = np.sort(keys, axis=1)[np.arange(n_samples),
+                                             n_orn_active - 1][:, np.newaxis]
+        else:
+            ind = _as_array_like(x, n_orn_active - 1).long().unsqueeze(1)
+            kth_keys = keys.sort(dim=1)[0].gather(1, ind)
+        return x * (keys <= kth_keys)
+
+
+class MaskColumn(object):
+    """Each ORN responds to an odor with its own probability.
+
+    Args:
+        probs: array (n_orn,), response probability of each ORN
+    """
+
+    def __init__(self, probs):
+        self.probs = np.asarray(probs)
+
+    @classmethod
+    def from_spread(cls, n_orn, spread, rng):
+        """Draw bimodal response probabilities.
+
+        Args:
+            spread: varies from [0, 1). 0 means no spread, 1 means maximum spread.
+        """
+        assert spread >= 0 and spread < 1, 'spread is not between the values of [0,1)'
+        mask_degree = (1 - spread) / 2
+        low, high = mask_degree, 1 - mask_degree
+        low_samples = rng.uniform(0, low, n_orn)
+        high_samples = rng.uniform(high, 1, n_orn)
+        samples = np.concatenate((low_samples, high_samples))
+        probs = rng.choice(samples, size=n_orn, replace=False)
+        return cls(probs)
+
+    def __call__(self, x, rng=None):
+        rng = _get_rng(rng)
+        n_samples, n_orn = x.shape
+        # Drawn ORN by ORN, as samples were drawn before vectorization
+        samples = _uniform_like(x, (n_orn, n_samples), rng).T
+        return x * (samples < _as_array_like(x, self.probs))
+
+
+class SpreadActivity(object):
+    """Scale the total activity of each odor by a random factor.
+
+    Args:
+        spread: varies from [0, 1). 0 means no spread, 1 means maximum spread.
+    """
+
+    def __init__(self, spread):
+        assert spread >= 0 and spread < 1, 'spread is not within range of [0, 1)'
+        self.spread = spread
+
+    def __call__(self, x, rng=None):
+        if self.spread == 0:
+            return x
+        rng = _get_rng(rng)
+        spread_low = 1 - self.spread
+        spread_high = 1 + self.spread
+        n_samples = x.shape[0]
+        scale_factors = rng.beta(1-self.spread, 1-self.spread, n_samples)
+        scale_factors = spread_low + scale_factors * (spread_high - spread_low)
+        return x * _as_array_like(x, scale_factors.reshape(-1, 1))
+
+
+class MixOR(object):
+    """Each ORN expresses n_or_per_orn ORs with equal weights.
+
+    Args:
+        n_orn: int, number of ORN types
+        n_or_per_orn: int, number of ORs expressed by each ORN
+        mode: 'circulant' mixes neighboring ORs, 'random' mixes random ORs
+        rng: RandomState, required for mode 'random'
+    """
+
+    def __init__(self, n_orn, n_or_per_orn, mode='circulant', rng=None):
+        if mode == 'random':
+            # Randoml mix OR per ORN
+            mask = np.zeros((n_orn, n_orn))
+            mask[:n_or_per_orn] = 1./n_or_per_orn
+            for i in range(n_orn):
+                rng.shuffle(mask[:, i])  # shuffling in-place
+        else:
+            from scipy.linalg import circulant
+            tmp = np.zeros(n_orn)
+            tmp[:n_or_per_orn] = 1./n_or_per_orn
+            mask = circulant(tmp)
+        self.mask = mask
+
+    def __call__(self, x, rng=None):
+        if isinstance(x, np.ndarray):
+            return np.dot(x, self.mask)
+        return x @ _as_array_like(x, self.mask)
+
+
+class Compose(object):
+    """Apply ORN transforms in order.
+
+    Every transform takes (n_samples, n_orn) numpy arrays or torch tensors,
+    and is vectorized over samples, so the same pipeline can be applied
+    when building a dataset or to every batch during training.
+    """
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x, rng=None):
+        rng = _get_rng(rng)
+        for transform in self.transforms:
+            x = transform(x, rng)
+        return x
+
+
+def get_orn_transforms(config, rng):
+    """Return the ORN transforms applied before labeling odors.
+
+    Args:
+        config: input_ProtoConfig
+        rng: RandomState, used to draw the ORN response probabilities
+
+    Returns:
+        transform: Compose
+    """
+    transforms = []
+    if config.mask_orn_activation_row[0]:
+        transforms.append(MaskRow(config.mask_orn_activation_row[1]))
+    if config.mask_orn_activation_column[0]:
+        transforms.append(MaskColumn.from_spread(
+            config.N_ORN, config.mask_orn_activation_column[1], rng))
+    if config.is_spread_orn_activity:
+        transforms.append(SpreadActivity(config.spread_orn_activity))
+    return Compose(transforms)
 
 
 def _spread_orn_activity(prototypes, spread=0, rng=None):
@@ -30,20 +336,7 @@ def _spread_orn_activity(prototypes, spread=0, rng=None):
     :param spread: varies from [0, 1). 0 means no spread, 1 means maximum spread.
     :return:
     '''
-    assert spread >= 0 and spread < 1, 'spread is not within range of [0, 1)'
-    if spread == 0:
-        return prototypes
-
-    if rng is None:
-        rng = np.random.RandomState()
-
-    spread_low = 1 - spread
-    spread_high = 1 + spread
-    n_samples = prototypes.shape[0]
-    scale_factors = rng.beta(1-spread, 1-spread, n_samples)
-    scale_factors = spread_low + scale_factors * (spread_high - spread_low)
-    out = prototypes * scale_factors.reshape(-1, 1)
-    return out
+    return SpreadActivity(spread)(prototypes, rng)
 
 
 def _mask_orn_activation_row(prototypes, spread=None, rng=None):
@@ -52,42 +345,16 @@ def _mask_orn_activation_row(prototypes, spread=None, rng=None):
     :param spread: varies from [0, 1). 0 means no spread, 1 means maximum spread.
     :return:
     '''
-    assert spread >= 0 and spread < 1, 'spread is not within range of [0, 1)'
-    if rng is None:
-        rng = np.random.RandomState()
-    n_samples, n_orn = prototypes.shape
-    mask_degree = np.round(n_orn * (1 - spread) / 2).astype(int)
-    # Small number of ORNs active
-    list_of_numbers = list(range(1, mask_degree))
-    # Large number of ORNs active
-    list_of_numbers = list_of_numbers + list(range(n_orn - mask_degree, n_orn))
-    print(list_of_numbers)
-
-    # For each sample odor, how many ORNs will be active
-    n_orn_active = rng.choice(list_of_numbers, size=n_samples, replace=True)
-    mask = np.zeros_like(prototypes, dtype=int)
-    for i in range(n_samples):
-        mask[i, :n_orn_active[i]] = 1  # set only this number of ORNs active
-        rng.shuffle(mask[i, :])
-    out = np.multiply(prototypes, mask)
-    return out
+    return MaskRow(spread)(prototypes, rng)
 
 
 def _mask_orn_activation_column(prototypes, probs, rng=None):
     '''
     :param prototypes:
-    :param spread:  varies from [0, 1). 0 means no spread, 1 means maximum spread.
+    :param probs: response probability of each ORN
     :return:
     '''
-    if rng is None:
-        rng = np.random.RandomState()
-    n_samples = prototypes.shape[0]
-    n_orn = prototypes.shape[1]
-    mask = np.zeros_like(prototypes)
-    for i in range(n_orn):
-        mask[:,i] = rng.uniform(0, 1, n_samples) < probs[i]
-    out = np.multiply(prototypes, mask)
-    return out
+    return MaskColumn(probs)(prototypes, rng)
 
 
 def _relabel(train_labels, val_labels, n_pre, n_post, rng=None, random=False):
@@ -117,8 +384,8 @@ def _relabel(train_labels, val_labels, n_pre, n_post, rng=None, random=False):
         labelmap = np.tile(np.arange(n_post), int(np.ceil(n_pre/n_post)))
         labelmap = labelmap[:n_pre]
 
-    new_train_labels = np.array([labelmap[l] for l in train_labels])
-    new_val_labels = np.array([labelmap[l] for l in val_labels])
+    new_train_labels = labelmap[np.asarray(train_labels)]
+    new_val_labels = labelmap[np.asarray(val_labels)]
     return new_train_labels, new_val_labels
 
 
@@ -142,6 +409,40 @@ def _generate_combinatorial_label(n_class, n_comb_class, density, rng):
 def _convert_to_combinatorial_label(labels, label_to_combinatorial_encoding):
     return label_to_combinatorial_encoding[labels, :]
 
+
+def encode_labels(labels, label_key):
+    """Convert class ids to targets.
+
+    Datasets with one-hot, combinatorial or multi-head labels store class
+    ids and a label key, targets are materialized when needed, e.g. for
+    each batch.
+
+    Args:
+        labels: np array or torch tensor of class ids (n_sample,)
+        label_key: None or array (n_class, ...) of the same type as labels,
+            target of each class
+
+    Returns:
+        targets: label_key[labels], or labels if label_key is None
+    """
+    if label_key is None:
+        return labels
+    return label_key[labels]
+
+
+def load_label_key(data_dir):
+    """Load the label key of a dataset, None if targets are the labels."""
+    file_path = os.path.join(data_dir, 'label_key.npy')
+    if os.path.isfile(file_path):
+        return np.load(file_path)
+    file_path = os.path.join(data_dir, HDF5_FILE)
+    if os.path.isfile(file_path):
+        import h5py
+        with h5py.File(file_path, 'r') as f:
+            if 'label_key' in f:
+                return f['label_key'][()]
+    return None
+
 def junk_code():
     # def add_bias(matrix, bias):
     #     """Add correlated bias."""
@@ -168,6 +469,162 @@ def _normalize(x):
     return x
 
 
+def _copula_corr(corr):
+    """Gaussian correlation giving a uniform-marginal correlation of corr."""
+    return 2 * np.sin(corr * np.pi / 6)
+
+
+class UniformSampler(object):
+    """Independent uniform (0, 1) activity."""
+
+    def __init__(self, dim, rng=None, **kwargs):
+        self.dim = dim
+
+    def __call__(self, n_sample, rng):
+        return rng.uniform(0, 1, (n_sample, self.dim))
+
+
+class MVNSampler(object):
+    """Equicorrelated uniform marginals from a dense gaussian copula.
+
+    Factorizes the dim x dim covariance at every call. Kept to reproduce
+    datasets generated with orn_corr before the structured samplers.
+    """
+
+    def __init__(self, dim, rng=None, corr=0, **kwargs):
+        self.dim = dim
+        self.cov = np.ones((dim, dim)) * _copula_corr(corr)
+        np.fill_diagonal(self.cov, 1)
+
+    def __call__(self, n_sample, rng):
+        Y = rng.multivariate_normal(np.zeros(self.dim), self.cov, n_sample)
+        return stats.norm.cdf(Y)
+
+
+class FactorSampler(object):
+    """Uniform marginals from a gaussian copula with factor structure.
+
+    Gaussian activity is Z L^T + sqrt(1 - rho) E, with latent factors
+    Z (n_sample, n_factor), loadings L (dim, n_factor) whose rows have a
+    squared norm of rho, and independent noise E. This is exact and costs
+    O(n_sample * dim * n_factor), without factorizing a covariance.
+
+    Args:
+        dim: int, number of ORNs
+        loadings: np array (dim, n_factor)
+    """
+
+    def __init__(self, dim, loadings):
+        self.dim = dim
+        self.loadings = loadings
+        self.noise_std = np.sqrt(1 - np.sum(loadings ** 2, axis=1))
+
+    def __call__(self, n_sample, rng):
+        Y = rng.standard_normal((n_sample, self.dim)) * self.noise_std
+        Y += np.dot(rng.standard_normal((n_sample, self.loadings.shape[1])),
+                    self.loadings.T)
+        return stats.norm.cdf(Y)
+
+
+class EquicorrSampler(FactorSampler):
+    """Equicorrelated uniform marginals from one shared latent factor.
+
+    Same distribution as MVNSampler.
+    """
+
+    def __init__(self, dim, rng=None, corr=0, **kwargs):
+        rho = _copula_corr(corr)
+        assert rho >= 0, 'equicorrelation must be non-negative'
+        super().__init__(dim, np.sqrt(rho) * np.ones((dim, 1)))
+
+
+class LowRankSampler(FactorSampler):
+    """Correlation from rank random factors plus independent noise.
+
+    The loadings of each ORN are random directions, scaled so that the
+    correlation of ORNs with parallel loadings matches corr.
+    """
+
+    def __init__(self, dim, rng=None, corr=0, rank=1, **kwargs):
+        rho = _copula_corr(corr)
+        loadings = rng.standard_normal((dim, rank))
+        loadings /= np.linalg.norm(loadings, axis=1, keepdims=True)
+        super().__init__(dim, np.sqrt(rho) * loadings)
+
+
+class BlockSampler(FactorSampler):
+    """Equicorrelation within n_block contiguous groups of ORNs."""
+
+    def __init__(self, dim, rng=None, corr=0, n_block=1, **kwargs):
+        rho = _copula_corr(corr)
+        loadings = np.zeros((dim, n_block))
+        for i, ind in enumerate(np.array_split(np.arange(dim), n_block)):
+            loadings[ind, i] = np.sqrt(rho)
+        super().__init__(dim, loadings)
+
+
+class HallemSampler(object):
+    """Log-normal activity fit to the Hallem-Carlson ORN responses.
+
+    Each of the dim ORNs is one of the 24 recorded ORNs, drawn at random if
+    dim != 24. Activity is scaled so that the largest recorded response
+    is 1.
+    """
+
+    def __init__(self, dim, rng=None, hallem_path=None, **kwargs):
+        from hallem import _fit_hallem_lognormal
+        means, covs, odor_activation = _fit_hallem_lognormal(hallem_path)
+        n_recorded = len(means)
+        if dim == n_recorded:
+            ind = np.arange(dim)
+        else:
+            ind = rng.choice(n_recorded, size=dim, replace=dim > n_recorded)
+        self.means = means
+        self.chol = np.linalg.cholesky(covs)
+        self.ind = ind
+        self.max_activation = np.max(odor_activation)
+
+    def __call__(self, n_sample, rng):
+        Y = self.means + np.dot(
+            rng.standard_normal((n_sample, len(self.means))), self.chol.T)
+        Y = np.clip(np.exp(Y[:, self.ind]) - 1, 0, self.max_activation)
+        return Y / self.max_activation
+
+
+_INPUT_SAMPLERS = {
+    'uniform': UniformSampler,
+    'mvn': MVNSampler,
+    'equicorr': EquicorrSampler,
+    'lowrank': LowRankSampler,
+    'block': BlockSampler,
+    'hallem': HallemSampler,
+}
+
+
+def get_input_sampler(name, dim, rng, corr=None, **kwargs):
+    """Return a sampler of ORN activity by name.
+
+    Args:
+        name: None or str, one of _INPUT_SAMPLERS. None defaults to
+            'uniform', or 'mvn' if corr is not None
+        dim: int, number of ORNs
+        rng: RandomState, used by samplers with random structure
+        corr: None or float, correlation of uniform marginals
+        kwargs: sampler specific arguments, rank for 'lowrank', n_block for
+            'block', hallem_path for 'hallem'
+
+    Returns:
+        sampler: callable, sampler(n_sample, rng) returns (n_sample, dim)
+    """
+    if name is None:
+        name = 'uniform' if corr is None else 'mvn'
+    if name not in _INPUT_SAMPLERS:
+        raise ValueError('Unknown input sampler: ' + str(name))
+    if corr is None:
+        corr = 0
+    return _INPUT_SAMPLERS[name](dim, rng=rng, corr=corr, **kwargs)
+
+
 def _sample_input(n_sample, dim, rng, corr=None):
     """Sample inputs, default uniform.
 
@@ -183,15 +640,15 @@ def _sample_input(n_sample, dim, rng, corr=None):
     Return:
         Y: numpy array, (n_sample, dim)
     """
-    if corr is not None:
-        mean = np.zeros(dim)
-        cov = np.ones((dim, dim)) * 2 * np.sin(corr * np.pi / 6)
-        np.fill_diagonal(cov, 1)
-        Y = rng.multivariate_normal(mean, cov, n_sample)
-        Y = stats.norm.cdf(Y)
-    else:
-        Y = rng.uniform(0, 1, (n_sample, dim))
-    return Y
+    return get_input_sampler(None, dim, rng, corr=corr)(n_sample, rng)
+
+
+def _get_sampler_kwargs(config):
+    """Sampler specific arguments from an input_ProtoConfig."""
+    kwargs = {'rank': getattr(config, 'orn_corr_rank', None),
+              'n_block': getattr(config, 'orn_corr_n_block', None),
+              'hallem_path': getattr(config, 'hallem_path', None)}
+    return {k: v for k, v in kwargs.items() if v is not None}
 
 
 def _generate_proto_threshold(
@@ -218,6 +675,9 @@ def _generate_proto_threshold(
         special_odor_activation=0,
         n_or_per_orn=1,
         orn_corr=None,
+        orn_sampler=None,
+        orn_sampler_kwargs=None,
+        return_label_key=False,
         seed=0):
     """Activate all ORNs randomly.
 
@@ -247,6 +707,12 @@ def _generate_proto_threshold(
         n_proto_valence: int, the number of valence class
         orn_corr: None or float between 0 or 1, the correlation between
             activity of different ORNs
+        orn_sampler: None or str, name of the ORN activity sampler, see
+            get_input_sampler
+        orn_sampler_kwargs: None or dict, sampler specific arguments
+        return_label_key: bool. if True, labels are returned as class ids
+            along with the label key mapping them to targets, see
+            encode_labels
         seed: int, random seed to generate the dataset
 
     Returns:
@@ -254,6 +720,8 @@ def _generate_proto_threshold(
         train_labels: np array (n_train, n_class)
         val_odors: np array (n_val, n_orn)
         val_labels: np array (n_val, n_class)
+        prototypes: np array (n_proto, n_orn)
+        label_key: None or np array (n_class, ...), if return_label_key
     """
     rng = np.random.RandomState(seed)
     multi_head = label_type == 'multi_head_sparse'
@@ -314,9 +782,11 @@ def _generate_proto_threshold(
         if orn_corr is not None:
             raise ValueError('orn_corr not None not supported for multi_head')
     else:
-        prototypes = _sample_input(n_proto, n_orn, rng=rng, corr=orn_corr)
-        train_odors = _sample_input(n_train, n_orn, rng=rng, corr=orn_corr)
-        val_odors = _sample_input(n_val, n_orn, rng=rng, corr=orn_corr)
+        sampler = get_input_sampler(orn_sampler, n_orn, rng, corr=orn_corr,
+                                    **(orn_sampler_kwargs or {}))
+        prototypes = sampler(n_proto, rng)
+        train_odors = sampler(n_train, rng)
+        val_odors = sampler(n_val, rng)
 
         prototypes *= max_activation
         train_odors *= max_activation
@@ -327,32 +797,25 @@ def _generate_proto_threshold(
 
     if mask_orn_activation_row[0]:
         print('mask_row')
-        mask_degree = mask_orn_activation_row[1]
-        prototypes = _mask_orn_activation_row(prototypes, spread=mask_degree)
-        train_odors = _mask_orn_activation_row(train_odors, spread=mask_degree)
-        val_odors = _mask_orn_activation_row(val_odors, spread=mask_degree)
+        mask_row = MaskRow(mask_orn_activation_row[1])
+        prototypes = mask_row(prototypes, rng)
+        train_odors = mask_row(train_odors, rng)
+        val_odors = mask_row(val_odors, rng)
 
     if mask_orn_activation_column[0]:
         print('mask_col')
-        spread = mask_orn_activation_column[1]
-        assert spread >= 0 and spread < 1, 'spread is not between the values of [0,1)'
-        mask_degree = (1 - spread) / 2
-        low, high = mask_degree, 1 - mask_degree
-        low_samples = rng.uniform(0, low, n_orn)
-        high_samples = rng.uniform(high, 1, n_orn)
-        samples = np.concatenate((low_samples, high_samples))
-        probs = rng.choice(samples, size=n_orn, replace=False)
-
-        prototypes = _mask_orn_activation_column(prototypes, probs, rng=rng)
-        train_odors = _mask_orn_activation_column(train_odors, probs, rng=rng)
-        val_odors = _mask_orn_activation_column(val_odors, probs, rng=rng)
+        mask_column = MaskColumn.from_spread(
+            n_orn, mask_orn_activation_column[1], rng)
+        prototypes = mask_column(prototypes, rng)
+        train_odors = mask_column(train_odors, rng)
+        val_odors = mask_column(val_odors, rng)
 
     if is_spread_orn_activity:
         print('mean')
-        spread = spread_orn_activity
-        prototypes = _spread_orn_activity(prototypes, spread, rng=rng)
-        train_odors = _spread_orn_activity(train_odors, spread, rng=rng)
-        val_odors = _spread_orn_activity(val_odors, spread, rng=rng)
+        spread = SpreadActivity(spread_orn_activity)
+        prototypes = spread(prototypes, rng)
+        train_odors = spread(train_odors, rng)
+        val_odors = spread(val_odors, rng)
 
     train_odors = train_odors.astype(np.float32)
     val_odors = val_odors.astype(np.float32)
@@ -418,19 +881,17 @@ def _generate_proto_threshold(
 
     assert train_odors.dtype == np.float32
 
-    # Convert labels
+    # Targets are label_key[labels], None if targets are the labels
+    label_key = None
     if label_type == 'combinatorial':
-        key = _generate_combinatorial_label(
+        label_key = _generate_combinatorial_label(
             n_class, n_combinatorial_classes,
             combinatorial_density, rng)
-        train_labels = _convert_to_combinatorial_label(train_labels, key)
-        val_labels = _convert_to_combinatorial_label(val_labels, key)
 
-        plt.imshow(key)
+        plt.imshow(label_key)
         plt.show()
     elif label_type == 'one_hot':
-        train_labels = _convert_one_hot_label(train_labels, n_class)
-        val_labels = _convert_one_hot_label(val_labels, n_class)
+        label_key = np.eye(n_class)
     elif label_type == 'sparse':
         pass
     elif label_type == 'multi_head_sparse':
@@ -439,23 +900,26 @@ def _generate_proto_threshold(
             print('no special odors')
             good_ix = int(.1 * n_class)
             bad_ix = int(good_ix * 2)
-            train_labels_valence = np.zeros_like(train_labels)
-            train_labels_valence[(0<=train_labels)*(train_labels< good_ix)] = 1
-            train_labels_valence[(good_ix <= train_labels) * (train_labels < bad_ix)] = 2
-            val_labels_valence = np.zeros_like(val_labels)
-            val_labels_valence[(0 <= val_labels) * (val_labels < good_ix)] = 1
-            val_labels_valence[(good_ix <= val_labels) * (val_labels < bad_ix)] = 2
+            # Valence is a function of the class, stored in the label key
+            valence = np.zeros(n_class, dtype=int)
+            valence[:good_ix] = 1
+            valence[good_ix:bad_ix] = 2
+            label_key = np.stack([np.arange(n_class), valence]).T
             #
             # innate_generalization = 100
             # prototypes_valence = rng.uniform(0, max_activation, (n_proto_valence-1, n_orn))
             # train_labels_valence = _get_labels(prototypes_valence, train_odors_forlabels, innate_generalization)
             # val_labels_valence = _get_labels(prototypes_valence, val_odors_forlabels, innate_generalization)
-
-        train_labels = np.stack([train_labels, train_labels_valence]).T
-        val_labels = np.stack([val_labels, val_labels_valence]).T
+        else:
+            train_labels = np.stack([train_labels, train_labels_valence]).T
+            val_labels = np.stack([val_labels, val_labels_valence]).T
     else:
         raise ValueError('Unknown label type: ', str(label_type))
 
+    if label_key is not None and not return_label_key:
+        train_labels = encode_labels(train_labels, label_key)
+        val_labels = encode_labels(val_labels, label_key)
+
     debug = False
     if debug:
         plt.hist(np.sum(train_odors, axis=1), density=True)
@@ -466,22 +930,14 @@ def _generate_proto_threshold(
     if n_or_per_orn > 1:
         # mix_or_per_orn_mode = 'random'
         mix_or_per_orn_mode = 'circulant'
-        if mix_or_per_orn_mode == 'random':
-            # Randoml mix OR per ORN
-            mask = np.zeros((n_orn, n_orn))
-            mask[:n_or_per_orn] = 1./n_or_per_orn
-            for i in range(n_orn):
-                rng.shuffle(mask[:, i])  # shuffling in-place
-        else:
-            from scipy.linalg import circulant
-            tmp = np.zeros(n_orn)
-            tmp[:n_or_per_orn] = 1./n_or_per_orn
-            mask = circulant(tmp)
-
-        train_odors = np.dot(train_odors, mask)
-        val_odors = np.dot(val_odors, mask)
-        prototypes = np.dot(prototypes, mask)
-
+        mix_or = MixOR(n_orn, n_or_per_orn, mode=mix_or_per_orn_mode, rng=rng)
+        train_odors = mix_or(train_odors)
+        val_odors = mix_or(val_odors)
+        prototypes = mix_or(prototypes)
+
+    if return_label_key:
+        return (train_odors, train_labels, val_odors, val_labels, prototypes,
+                label_key)
     return train_odors, train_labels, val_odors, val_labels, prototypes
 
 
@@ -491,14 +947,112 @@ def _gen_folder_name(config, seed):
     return auto_folder_name
 
 
-def save_proto(config=None, seed=0, folder_name=None):
-    """Save dataset in numpy format."""
+def _get_manifest(config, seed):
+    """Return the manifest identifying the content of a dataset.
+
+    Paths do not affect the content and are left out. None-valued entries
+    are left out too, so adding a new option that defaults to None does not
+    invalidate existing datasets.
+    """
+    config_dict = {k: v for k, v in config.__dict__.items()
+                   if v is not None and k not in ['path', 'hallem_path']}
+    manifest = {'config': config_dict, 'seed': seed,
+                'generator_version': GENERATOR_VERSION}
+    content = json.dumps(manifest, sort_keys=True, default=str)
+    manifest['hash'] = hashlib.sha256(content.encode()).hexdigest()
+    return manifest
+
+
+def is_proto_fresh(config, seed=0, folder_name=None):
+    """Check if a saved dataset matches config and seed.
+
+    Returns:
+        fresh: bool, True if the dataset does not need to be regenerated
+        folder_path: str, path of the dataset
+    """
+    if folder_name is None:
+        folder_name = _gen_folder_name(config, seed)
+    folder_path = os.path.join(config.path, folder_name)
+
+    manifest_file = os.path.join(folder_path, 'manifest.json')
+    if not os.path.isfile(manifest_file):
+        return False, folder_path
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('hash') != _get_manifest(config, seed)['hash']:
+        return False, folder_path
+
+    if getattr(config, 'data_format', None) == 'hdf5':
+        fresh = os.path.isfile(os.path.join(folder_path, HDF5_FILE))
+    else:
+        names = ['train_x', 'train_y', 'val_x', 'val_y', 'prototype']
+        if getattr(config, 'train_shard_size', None):
+            n_shard = len(_get_shard_sizes(config))
+            names = ['val_x', 'val_y', 'prototype'] + [
+                _shard_name(name, i) for i in range(n_shard)
+                for name in ['train_x', 'train_y']]
+        fresh = all(os.path.isfile(os.path.join(folder_path, name + '.npy'))
+                    for name in names)
+    return fresh, folder_path
+
+
+def _save_hdf5(folder_path, arrays, compression=None):
+    """Save arrays into a single HDF5 file, chunked along rows.
+
+    Each chunk holds HDF5_CHUNK_ROWS complete rows, so reading a contiguous
+    range of samples only touches the chunks of these samples. The file is
+    written under a temporary name and then renamed.
+
+    Args:
+        folder_path: str, dataset directory
+        arrays: dict of name to np array
+        compression: None or str, h5py compression filter, e.g. 'gzip'
+    """
+    import h5py
+    file_path = os.path.join(folder_path, HDF5_FILE)
+    tmp_path = file_path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        for name, array in arrays.items():
+            chunks = (min(HDF5_CHUNK_ROWS, array.shape[0]),) + array.shape[1:]
+            f.create_dataset(name, data=array, chunks=chunks,
+                             compression=compression)
+    os.replace(tmp_path, file_path)
+
+
+def save_proto(config=None, seed=0, folder_name=None, force=False,
+               n_workers=1):
+    """Save dataset in numpy format, or in HDF5 if config.data_format is 'hdf5'.
+
+    A manifest.json hashing the config, seed and GENERATOR_VERSION is saved
+    along with the data. If it matches, the dataset is not regenerated.
+    If config.train_shard_size is set, see save_proto_sharded.
+
+    Args:
+        config: input_ProtoConfig
+        seed: int, random seed
+        folder_name: str, name of the dataset folder under config.path
+        force: bool, if True, regenerate even if the dataset is up to date
+        n_workers: int, number of worker processes of sharded generation
+
+    Returns:
+        folder_path: str, path of the dataset
+    """
 
     if config is None:
         config = input_ProtoConfig()
 
+    if getattr(config, 'train_shard_size', None):
+        return save_proto_sharded(config, seed, folder_name, force=force,
+                                  n_workers=n_workers)
+
+    fresh, folder_path = is_proto_fresh(config, seed, folder_name)
+    if fresh and not force:
+        print('Dataset up to date, skipping: ' + folder_path)
+        return folder_path
+
     # make and save data
-    train_x, train_y, val_x, val_y, prototypes = _generate_proto_threshold(
+    (train_x, train_y, val_x, val_y, prototypes,
+     label_key) = _generate_proto_threshold(
         n_orn=config.N_ORN,
         n_class=config.N_CLASS,
         percent_generalization=config.percent_generalization,
@@ -522,12 +1076,11 @@ def save_proto(config=None, seed=0, folder_name=None):
         special_odor_activation=config.special_odor_activation,
         n_or_per_orn=config.n_or_per_orn,
         orn_corr=config.orn_corr,
+        orn_sampler=getattr(config, 'orn_sampler', None),
+        orn_sampler_kwargs=_get_sampler_kwargs(config),
+        return_label_key=True,
         seed=seed)
 
-    if folder_name is None:
-        folder_name = _gen_folder_name(config, seed)
-
-    folder_path = os.path.join(config.path, folder_name)
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
     else:
@@ -538,14 +1091,256 @@ def save_proto(config=None, seed=0, folder_name=None):
             val_x.astype(np.float32), val_y.astype(np.int32),
             prototypes.astype(np.float32)]
     varnames = ['train_x', 'train_y', 'val_x', 'val_y', 'prototype']
-    for result, name in zip(vars, varnames):
-        np.save(os.path.join(folder_path, name), result)
+    if label_key is not None:
+        vars.append(label_key.astype(np.int32))
+        varnames.append('label_key')
+    if getattr(config, 'data_format', None) == 'hdf5':
+        _save_hdf5(folder_path, dict(zip(varnames, vars)),
+                   compression=getattr(config, 'hdf5_compression', None))
+    else:
+        for result, name in zip(vars, varnames):
+            np.save(os.path.join(folder_path, name), result)
 
     #save parameters
     tools.save_config(config, folder_path)
+    # Saved last, so that an interrupted save is not considered fresh
+    with open(os.path.join(folder_path, 'manifest.json'), 'w') as f:
+        json.dump(_get_manifest(config, seed), f, default=str)
     return folder_path
 
 
+def _get_threshold(prototypes, odors, percent_generalization):
+    """Distance to the nearest prototype at percent_generalization."""
+    ind = _get_labels(prototypes, odors, 100)
+    dist = np.linalg.norm(np.asarray(odors, dtype=np.float64)
+                          - prototypes[ind], axis=1)
+    return np.percentile(dist, percent_generalization)
+
+
+def _shard_name(name, index):
+    return '{:s}_{:05d}'.format(name, index)
+
+
+def _save_atomic(folder_path, name, array):
+    """Save array to name.npy, so that the file is complete if it exists."""
+    file_path = os.path.join(folder_path, name + '.npy')
+    with open(file_path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def _label_odors(spec, odors):
+    """Label transformed odors of a sharded dataset."""
+    odors_forlabels = _normalize(odors) if spec['normalize'] else odors
+    labels = _get_labels(spec['prototypes'], odors_forlabels,
+                         spec['percent_generalization'],
+                         threshold=spec['threshold'])
+    labels = spec['labelmap'][labels]
+    if spec['mix_or'] is not None:
+        odors = spec['mix_or'](odors)
+    return odors, labels
+
+
+def _save_shard(spec, index, seed_seq, n_sample, folder_path):
+    """Generate, label and save one training shard."""
+    rng = np.random.RandomState(np.random.MT19937(seed_seq))
+    odors = spec['transform'](spec['sampler'](n_sample, rng), rng)
+    odors, labels = _label_odors(spec, odors.astype(np.float32))
+    _save_atomic(folder_path, _shard_name('train_y', index),
+                 labels.astype(np.int32))
+    _save_atomic(folder_path, _shard_name('train_x', index),
+                 odors.astype(np.float32))
+    return index
+
+
+def _get_shard_sizes(config):
+    n_shard = int(np.ceil(config.n_train / config.train_shard_size))
+    sizes = [config.train_shard_size] * n_shard
+    sizes[-1] = config.n_train - config.train_shard_size * (n_shard - 1)
+    return sizes
+
+
+def save_proto_sharded(config, seed=0, folder_name=None, force=False,
+                       n_workers=1):
+    """Save a dataset whose training set is generated in shards.
+
+    Prototypes, the validation set and the default-class threshold (from the
+    validation odors) are drawn once. Each shard of config.train_shard_size
+    training odors is then sampled from its own generator, spawned from
+    np.random.SeedSequence(seed), so shards do not depend on each other or
+    on n_workers. Shards are labeled in parallel and saved as
+    train_x_00000.npy, train_y_00000.npy, ... as they complete. Rerunning an
+    interrupted build only generates the missing shards.
+
+    Only sparse labels without distort_input, shuffle_label or multi-head
+    odors are supported.
+
+    Args:
+        config: input_ProtoConfig with train_shard_size set
+        seed: int, random seed
+        folder_name: str, name of the dataset folder under config.path
+        force: bool, if True, regenerate even if the dataset is up to date
+        n_workers: int, number of worker processes labeling shards
+
+    Returns:
+        folder_path: str, path of the dataset
+    """
+    unsupported = {
+        'label_type': config.label_type != 'sparse',
+        'distort_input': config.distort_input,
+        'shuffle_label': config.shuffle_label,
+        'data_format': getattr(config, 'data_format', None) is not None,
+    }
+    for key, val in unsupported.items():
+        if val:
+            raise NotImplementedError(
+                'Sharded generation does not support ' + key)
+
+    fresh, folder_path = is_proto_fresh(config, seed, folder_name)
+    if fresh and not force:
+        print('Dataset up to date, skipping: ' + folder_path)
+        return folder_path
+
+    # Shards of an interrupted build are kept if they are for this config
+    manifest = _get_manifest(config, seed)
+    build_file = os.path.join(folder_path, 'build.json')
+    resume = False
+    if not force and os.path.isfile(build_file):
+        with open(build_file, 'r') as f:
+            resume = json.load(f).get('hash') == manifest['hash']
+    if not resume:
+        if os.path.exists(folder_path):
+            shutil.rmtree(folder_path)
+        os.makedirs(folder_path)
+        with open(build_file, 'w') as f:
+            json.dump(manifest, f, default=str)
+
+    rng = np.random.RandomState(seed)
+    n_orn = config.N_ORN
+    n_proto = config.n_trueclass if config.relabel else config.N_CLASS
+    has_default = config.percent_generalization < 100
+    if has_default:
+        n_proto -= 1
+    sampler = get_input_sampler(
+        getattr(config, 'orn_sampler', None), n_orn, rng,
+        corr=config.orn_corr, **_get_sampler_kwargs(config))
+    transform = get_orn_transforms(config, rng)
+    prototypes = transform(sampler(n_proto, rng), rng)
+    if config.vary_concentration:
+        prototypes = _normalize(prototypes)
+    if config.n_or_per_orn > 1:
+        mix_or = MixOR(n_orn, config.n_or_per_orn, mode='circulant', rng=rng)
+    else:
+        mix_or = None
+
+    n_label = n_proto + int(has_default)
+    if config.relabel:
+        labelmap = np.tile(np.arange(config.N_CLASS),
+                           int(np.ceil(n_label / config.N_CLASS)))[:n_label]
+    else:
+        labelmap = np.arange(n_label)
+
+    spec = {'sampler': sampler, 'transform': transform,
+            'normalize': config.vary_concentration, 'prototypes': prototypes,
+            'percent_generalization': config.percent_generalization,
+            'threshold': None, 'labelmap': labelmap, 'mix_or': mix_or}
+
+    val_odors = transform(sampler(config.n_val, rng), rng).astype(np.float32)
+    if has_default:
+        val_forlabels = (_normalize(val_odors) if config.vary_concentration
+                         else val_odors)
+        spec['threshold'] = _get_threshold(
+            prototypes, val_forlabels, config.percent_generalization)
+    val_x, val_y = _label_odors(spec, val_odors)
+
+    for result, name in zip([val_x.astype(np.float32), val_y.astype(np.int32),
+                             prototypes.astype(np.float32)],
+                            ['val_x', 'val_y', 'prototype']):
+        _save_atomic(folder_path, name, result)
+
+    sizes = _get_shard_sizes(config)
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(spec, i, seed_seqs[i], sizes[i], folder_path)
+            for i in range(len(sizes))
+            if not all(os.path.isfile(os.path.join(
+                folder_path, _shard_name(name, i) + '.npy'))
+                for name in ['train_x', 'train_y'])]
+    print('Generating {:d}/{:d} shards'.format(len(jobs), len(sizes)))
+    if n_workers > 1 and len(jobs) > 1:
+        tools.run_parallel(_save_shard, jobs, n_workers)
+    else:
+        for job in jobs:
+            _save_shard(*job)
+
+    tools.save_config(config, folder_path)
+    # Saved last, so that an interrupted save is not considered fresh
+    with open(os.path.join(folder_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, default=str)
+    return folder_path
+
+
+class ShardedArray(object):
+    """Read-only concatenation of arrays along the first axis.
+
+    Rows are read from the shards on indexing, nothing is copied upfront.
+    Supports integer, slice and integer array indexing of rows.
+
+    Args:
+        shards: list of array-likes, e.g. memory-maps, with the same
+            trailing shape
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.offsets = np.cumsum([0] + [len(s) for s in shards])
+        self.shape = (int(self.offsets[-1]),) + tuple(shards[0].shape[1:])
+        self.dtype = shards[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        array = np.concatenate([np.asarray(s) for s in self.shards])
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            return rows[(slice(None),) + key[1:]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            parts = []
+            for i, shard in enumerate(self.shards):
+                lo = max(start, self.offsets[i])
+                hi = min(stop, self.offsets[i + 1])
+                if lo < hi:
+                    parts.append(np.asarray(
+                        shard[lo - self.offsets[i]:hi - self.offsets[i]]))
+            if not parts:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return np.concatenate(parts)
+        if np.ndim(key) == 0:
+            key = int(key)
+            if key < 0:
+                key += len(self)
+            i = np.searchsorted(self.offsets, key, side='right') - 1
+            return self.shards[i][key - self.offsets[i]]
+
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.where(key)[0]
+        key = np.where(key < 0, key + len(self), key)
+        shard_ind = np.searchsorted(self.offsets, key, side='right') - 1
+        out = np.empty((len(key),) + self.shape[1:], dtype=self.dtype)
+        for i in np.unique(shard_ind):
+            select = shard_ind == i
+            out[select] = self.shards[i][key[select] - self.offsets[i]]
+        return out
+
+
 def save_proto_all():
     """Generate all datasets."""
     config = input_ProtoConfig()
@@ -597,8 +1392,26 @@ def save_autoencode(config=None, seed=0, folder_name=None):
     return folder_path
 
 
-def load_data(data_dir):
-    """Load dataset."""
+def load_data(data_dir, splits=('train', 'val'), mmap_mode=None,
+              encode=True):
+    """Load dataset.
+
+    Args:
+        data_dir: str, dataset directory
+        splits: tuple of 'train' and/or 'val', the splits to load
+        mmap_mode: None or 'r'. If 'r', return read-only memory-maps that
+            are read from disk lazily, and shared through the page cache
+            by processes loading the same dataset. For HDF5 datasets,
+            return h5py datasets, which are read lazily as well. For sharded
+            datasets, return a ShardedArray of memory-maps
+        encode: bool. If True, labels of datasets saved with a label key are
+            converted to targets, see encode_labels. If False, class ids are
+            returned, and targets can be materialized for each batch with
+            load_label_key
+
+    Returns:
+        x, y of each split, e.g. train_x, train_y, val_x, val_y by default
+    """
     if not os.path.exists(data_dir):
         # datasets are usually stored like path/datasets/proto/name
         paths = ['.'] + os.path.normpath(data_dir).split(os.path.sep)[-3:]
@@ -606,11 +1419,41 @@ def load_data(data_dir):
 
     def _load_proto(path):
         """Load dataset from numpy format."""
-        names = ['train_x', 'train_y', 'val_x', 'val_y']
-        return [np.load(os.path.join(path, name + '.npy')) for name in names]
-
-    train_x, train_y, val_x, val_y = _load_proto(data_dir)
-    return train_x, train_y, val_x, val_y
+        names = [split + suffix for split in splits for suffix in ['_x', '_y']]
+        if os.path.isfile(os.path.join(path, HDF5_FILE)):
+            import h5py
+            # The file stays open as long as the datasets are referenced
+            f = h5py.File(os.path.join(path, HDF5_FILE), 'r')
+            if mmap_mode is None:
+                data = [f[name][()] for name in names]
+                f.close()
+                return data
+            return [f[name] for name in names]
+        data = []
+        for name in names:
+            file_path = os.path.join(path, name + '.npy')
+            if os.path.isfile(file_path):
+                data.append(np.load(file_path, mmap_mode=mmap_mode))
+                continue
+            # Sharded split
+            shards = []
+            while os.path.isfile(os.path.join(
+                    path, _shard_name(name, len(shards)) + '.npy')):
+                shards.append(np.load(os.path.join(
+                    path, _shard_name(name, len(shards)) + '.npy'),
+                    mmap_mode='r'))
+            if not shards:
+                raise FileNotFoundError(file_path)
+            data.append(ShardedArray(shards) if mmap_mode is not None
+                        else np.concatenate(shards))
+        return data
+
+    data = _load_proto(data_dir)
+    label_key = load_label_key(data_dir) if encode else None
+    if label_key is not None:
+        data[1::2] = [encode_labels(np.asarray(y), label_key)
+                      for y in data[1::2]]
+    return data
 
 
 if __name__ == '__main__':
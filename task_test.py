@@ -0,0 +1,203 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from sklearn.metrics.pairwise import euclidean_distances
+
+import task
+from configs import input_ProtoConfig
+
+
+def _get_labels_dense(prototypes, odors, percent_generalization, weights=None):
+    """Reference labeling with the full distance matrix."""
+    dist = euclidean_distances(prototypes, odors)
+    if percent_generalization < 100:
+        highest_match = np.min(dist, axis=0)
+        threshold = np.percentile(highest_match, percent_generalization)
+        default_class = (1e-6 + threshold) * np.ones((1, dist.shape[1]))
+        dist = np.vstack((default_class, dist))
+    if weights is not None:
+        dist = weights.reshape(-1, 1) * dist
+    return np.argmin(dist, axis=0)
+
+
+class TestTask(unittest.TestCase):
+
+    def test_get_labels_blocked(self):
+        rng = np.random.RandomState(0)
+        prototypes = rng.uniform(0, 1, (300, 50))
+        odors = rng.uniform(0, 1, (5000, 50)).astype(np.float32)
+        odors[:10] = prototypes[:10]  # exact matches
+        for percent_generalization in [100, 70]:
+            n_label = 300 + (percent_generalization < 100)
+            for weights in [None, rng.uniform(0.8, 1.2, n_label)]:
+                labels = task._get_labels(
+                    prototypes, odors, percent_generalization,
+                    weights=weights, block_size=777)
+                labels_dense = _get_labels_dense(
+                    prototypes, odors, percent_generalization, weights)
+                np.testing.assert_array_equal(labels, labels_dense)
+
+    def test_save_proto_cache(self):
+        config = input_ProtoConfig()
+        config.n_train = 1000
+        config.n_val = 100
+        with tempfile.TemporaryDirectory() as path:
+            config.path = path
+            self.assertFalse(task.is_proto_fresh(config, 0, 'tmp')[0])
+            folder_path = task.save_proto(config, seed=0, folder_name='tmp')
+            self.assertTrue(task.is_proto_fresh(config, 0, 'tmp')[0])
+            self.assertFalse(task.is_proto_fresh(config, 1, 'tmp')[0])
+
+            fname = os.path.join(folder_path, 'train_x.npy')
+            mtime = os.path.getmtime(fname)
+            task.save_proto(config, seed=0, folder_name='tmp')
+            self.assertEqual(mtime, os.path.getmtime(fname))
+
+            config.N_CLASS = 50
+            self.assertFalse(task.is_proto_fresh(config, 0, 'tmp')[0])
+
+    def test_load_data_splits(self):
+        config = input_ProtoConfig()
+        config.n_train = 1000
+        config.n_val = 100
+        with tempfile.TemporaryDirectory() as path:
+            config.path = path
+            folder_path = task.save_proto(config, seed=0, folder_name='tmp')
+            train_x, train_y, val_x, val_y = task.load_data(folder_path)
+            val_x_mmap, val_y_mmap = task.load_data(
+                folder_path, splits=('val',), mmap_mode='r')
+            self.assertIsInstance(val_x_mmap, np.memmap)
+            self.assertFalse(val_x_mmap.flags.writeable)
+            np.testing.assert_array_equal(val_x, val_x_mmap)
+            np.testing.assert_array_equal(val_y, val_y_mmap)
+            del val_x_mmap, val_y_mmap
+
+            config.data_format = 'hdf5'
+            config.hdf5_compression = 'gzip'
+            folder_path = task.save_proto(config, seed=0, folder_name='h5')
+            self.assertTrue(task.is_proto_fresh(config, 0, 'h5')[0])
+            data = task.load_data(folder_path)
+            for x, x_h5 in zip([train_x, train_y, val_x, val_y], data):
+                np.testing.assert_array_equal(x, x_h5)
+
+            train_x_h5, train_y_h5 = task.load_data(
+                folder_path, splits=('train',), mmap_mode='r')
+            import torchtask
+            batches = list(torchtask.iterate_chunks(
+                train_x_h5, train_y_h5, batch_size=64, chunk_size=300))
+            x = np.concatenate([b[0] for b in batches])
+            y = np.concatenate([b[1] for b in batches])
+            self.assertEqual(x.shape, train_x.shape)
+            order = np.lexsort(x.T)
+            np.testing.assert_array_equal(x[order],
+                                          train_x[np.lexsort(train_x.T)])
+            np.testing.assert_array_equal(y[order],
+                                          train_y[np.lexsort(train_x.T)])
+            train_x_h5.file.close()
+
+    def test_save_proto_sharded(self):
+        config = input_ProtoConfig()
+        config.n_train = 1000
+        config.n_val = 500
+        config.percent_generalization = 70
+        config.train_shard_size = 300
+        with tempfile.TemporaryDirectory() as path:
+            config.path = path
+            folder_path = task.save_proto(config, seed=0, folder_name='tmp')
+            train_x, train_y, val_x, val_y = task.load_data(folder_path)
+            self.assertEqual(train_x.shape, (1000, config.N_ORN))
+            self.assertAlmostEqual(np.mean(val_y == 0), 0.3, places=2)
+
+            # Resume an interrupted build
+            os.remove(os.path.join(folder_path, 'train_x_00002.npy'))
+            os.remove(os.path.join(folder_path, 'manifest.json'))
+            self.assertFalse(task.is_proto_fresh(config, 0, 'tmp')[0])
+            task.save_proto(config, seed=0, folder_name='tmp')
+            train_x_mmap, train_y_mmap = task.load_data(
+                folder_path, splits=('train',), mmap_mode='r')
+            self.assertIsInstance(train_x_mmap, task.ShardedArray)
+            np.testing.assert_array_equal(train_x, train_x_mmap[:])
+            np.testing.assert_array_equal(train_y[[0, 299, 300, 999]],
+                                          train_y_mmap[[0, 299, 300, -1]])
+            np.testing.assert_array_equal(train_x[250:650],
+                                          train_x_mmap[250:650])
+            del train_x_mmap, train_y_mmap
+
+    def test_label_key(self):
+        np.testing.assert_array_equal(
+            task._relabel(np.array([0, 5, 3]), np.array([4]), 6, 3)[0],
+            [0, 2, 0])
+
+        config = input_ProtoConfig()
+        config.n_train = 1000
+        config.n_val = 100
+        config.label_type = 'one_hot'
+        with tempfile.TemporaryDirectory() as path:
+            config.path = path
+            folder_path = task.save_proto(config, seed=0, folder_name='tmp')
+            train_x, train_y, val_x, val_y = task.load_data(folder_path)
+            self.assertEqual(train_y.shape, (1000, config.N_CLASS))
+            _, labels = task.load_data(folder_path, splits=('train',),
+                                       encode=False)
+            self.assertEqual(labels.shape, (1000,))
+            self.assertEqual(labels.dtype, np.int32)
+            label_key = task.load_label_key(folder_path)
+            np.testing.assert_array_equal(
+                task.encode_labels(labels, label_key), train_y)
+            np.testing.assert_array_equal(np.argmax(train_y, axis=1), labels)
+
+    def test_orn_transforms(self):
+        x = np.random.RandomState(0).uniform(0, 1, (1000, 50))
+        probs = np.random.RandomState(1).uniform(0, 1, 50)
+
+        # Same samples as masking one ORN at a time
+        rng = np.random.RandomState(2)
+        mask = np.zeros_like(x)
+        for i in range(50):
+            mask[:, i] = rng.uniform(0, 1, 1000) < probs[i]
+        np.testing.assert_array_equal(
+            task.MaskColumn(probs)(x, rng=2), x * mask)
+
+        rng = np.random.RandomState(3)
+        list_of_numbers = list(range(1, 12)) + list(range(38, 50))
+        n_orn_active = rng.choice(list_of_numbers, size=1000, replace=True)
+        out = task.MaskRow(0.5)(x, rng=3)
+        np.testing.assert_array_equal((out > 0).sum(axis=1), n_orn_active)
+
+        transform = task.Compose([task.MaskRow(0.5), task.MaskColumn(probs),
+                                  task.SpreadActivity(0.5),
+                                  task.MixOR(50, 3)])
+        np.testing.assert_array_equal(transform(x, rng=4), transform(x, rng=4))
+        try:
+            import torch
+        except ImportError:
+            return
+        out = transform(torch.from_numpy(x).float(), rng=4)
+        self.assertEqual(out.shape, x.shape)
+
+    def test_input_samplers(self):
+        rng = np.random.RandomState(0)
+        for name in ['mvn', 'equicorr', 'lowrank', 'block']:
+            sampler = task.get_input_sampler(name, 20, rng, corr=0.5,
+                                             rank=1, n_block=2)
+            x = sampler(20000, rng)
+            self.assertTrue(np.all((x >= 0) & (x <= 1)))
+            corr = np.corrcoef(x, rowvar=False)
+            if name == 'lowrank':
+                corr = np.abs(corr)  # loadings of opposite signs
+            elif name == 'block':
+                corr = corr[:10, :10]
+            corr = corr[np.triu_indices(len(corr), k=1)]
+            np.testing.assert_allclose(corr, 0.5, atol=0.05)
+
+        x = task.get_input_sampler('hallem', 50, rng,
+                                   hallem_path=input_ProtoConfig().hallem_path)(
+            1000, rng)
+        self.assertEqual(x.shape, (1000, 50))
+        self.assertTrue(np.all((x >= 0) & (x <= 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
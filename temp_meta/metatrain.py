@@ -9,6 +9,7 @@ import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchmeta.modules import MetaModule
 
 rootpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -18,7 +19,7 @@ import temp_meta.metamodel
 import configs
 import tools
 from mamldataset import DataGenerator
-from torchtrain import logging
+from torchtrain import logging, _cpu_peak_memory
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -199,6 +200,257 @@ def run_per_batch_tmp(model, loss, split_size, data_x, data_t, update_lr,
            val_acc_av.div_(l), val_loss_av.div_(l)
 
 
+def _grouped_layer(layer, x):
+    """Apply a Layer to groups of samples at once.
+
+    Batch norm statistics are computed within each group, so the output is
+    the same as applying the layer to each group separately.
+
+    Args:
+        layer: temp_meta.metamodel.Layer
+        x: tensor (n_group, n_sample, n_feature)
+    """
+    for module in layer.block.children():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm) and (
+                module.training or module.running_mean is None):
+            mean = x.mean(dim=1, keepdim=True)
+            var = x.var(dim=1, unbiased=False, keepdim=True)
+            x = (x - mean) / torch.sqrt(var + module.eps)
+            if module.affine:
+                x = x * module.weight + module.bias
+        elif isinstance(module, nn.modules.batchnorm._BatchNorm):
+            x = module(x.reshape(-1, x.shape[-1])).view(x.shape)
+        else:
+            x = module(x)
+    return x
+
+
+def run_batched(model, split_size, data_x, data_t, update_lr,
+                num_inner_updates=1, max_update_lr=1.0,
+                inner_mode='second_order', truncate_steps=1):
+    """Meta-train step on all tasks of a meta-batch at once.
+
+    Only the readout weight is adapted, so the ORN-PN-KC trunk is computed
+    once for the train and val samples of all tasks, and the inner updates
+    act on a stack of per-task readout weights (tasks, class, KC). With one
+    second-order inner update, losses, accuracies and meta-gradients are the
+    same as run_per_batch.
+
+    Inner loop modes trade exactness of the meta-gradient for memory:
+        'second_order': backpropagate through all inner updates, memory
+            grows with num_inner_updates
+        'first_order': inner gradients are treated as constants (FOMAML),
+            memory does not grow with num_inner_updates
+        'truncated': backpropagate through the last truncate_steps inner
+            updates only, earlier updates are first-order
+        'implicit': the inner problem is solved exactly in closed form, as
+            a least-squares readout regularized towards the initial readout
+            with strength 1 / update_lr. Gradients through the solve are
+            the implicit meta-gradients, num_inner_updates is unused. The
+            solve is (split_size x split_size) per task, independent of N_KC
+
+    Args:
+        model: temp_meta.metamodel.Model
+        split_size: int, number of train samples of each task
+        data_x: tensor (n_task, 2 * split_size, n_orn)
+        data_t: one-hot tensor (n_task, 2 * split_size, n_class)
+        update_lr: tensor, inner learning rate
+        num_inner_updates: int, number of inner gradient steps
+        max_update_lr: float, maximum inner learning rate
+        inner_mode: str, 'second_order', 'first_order', 'truncated' or
+            'implicit'
+        truncate_steps: int, number of last inner updates backpropagated
+            through in 'truncated' mode
+
+    Returns:
+        pre_acc, pre_loss, post_acc, post_loss, val_acc, val_loss, averaged
+            over tasks
+    """
+    if inner_mode not in ['second_order', 'first_order', 'truncated',
+                          'implicit']:
+        raise ValueError('Unknown inner mode: ' + str(inner_mode))
+
+    n_task = data_x.shape[0]
+    # Train and val samples of each task are separate batch norm groups
+    act0 = data_x.reshape(n_task * 2, split_size, -1)
+    if model.config.N_ORN_DUPLICATION > 1:
+        act0 = act0.repeat(1, 1, model.config.N_ORN_DUPLICATION)
+    act1 = _grouped_layer(model.layer1, act0)
+    act2 = _grouped_layer(model.layer2, act1)
+    act2 = act2.view(n_task, 2 * split_size, -1)
+    train_act, val_act = torch.split(act2, split_size, dim=1)
+    train_t, val_t = torch.split(
+        torch.max(data_t, dim=-1)[1], split_size, dim=1)
+
+    bias = model.layer3.bias
+    weight = model.layer3.weight.expand(n_task, -1, -1)
+
+    def _readout(act, weight):
+        return torch.baddbmm(bias, act, weight.transpose(1, 2))
+
+    def _task_loss(y, t):
+        loss = F.cross_entropy(y.reshape(-1, y.shape[-1]), t.reshape(-1),
+                               reduction='none')
+        return loss.view(t.shape).mean(dim=1)
+
+    def _accuracy(y, t):
+        return torch.mean(torch.max(y, dim=-1)[1].eq(t).float())
+
+    clamped_lr = torch.clamp_max(update_lr, max_update_lr)
+    if inner_mode == 'implicit':
+        train_y = _readout(train_act, weight)
+        pre_loss = _task_loss(train_y, train_t).mean()
+        with torch.no_grad():
+            pre_acc = _accuracy(train_y, train_t)
+
+        # min_W |A W^T + b - Y|^2 / 2n + |W - W0|^2 / (2 lr), solved in
+        # sample space: W^T = W0^T + A^T (A A^T + n / lr I)^-1 (Y - A W0^T - b)
+        residual = F.one_hot(train_t, train_y.shape[-1]).float() - train_y
+        gram = torch.bmm(train_act, train_act.transpose(1, 2))
+        eye = torch.eye(split_size, device=gram.device, dtype=gram.dtype)
+        gram = gram + (split_size / clamped_lr) * eye
+        delta = torch.bmm(train_act.transpose(1, 2),
+                          torch.linalg.solve(gram, residual))
+        weight = weight + delta.transpose(1, 2)
+        num_inner_updates = 0
+
+    for i_inner_update in range(num_inner_updates):
+        train_y = _readout(train_act, weight)
+        task_loss = _task_loss(train_y, train_t)
+        if i_inner_update == 0:
+            pre_loss = task_loss.mean()
+            with torch.no_grad():
+                pre_acc = _accuracy(train_y, train_t)
+
+        if inner_mode == 'second_order':
+            create_graph = True
+        elif inner_mode == 'first_order':
+            create_graph = False
+        else:
+            create_graph = (num_inner_updates - i_inner_update
+                            <= truncate_steps)
+        # Tasks only depend on their own weight, so the gradient of the
+        # summed loss is the stack of per-task gradients
+        grad = torch.autograd.grad(task_loss.sum(), weight,
+                                   create_graph=create_graph)[0]
+        weight = weight - clamped_lr * grad
+
+    with torch.no_grad():
+        post_y = _readout(train_act, weight)
+        post_loss = _task_loss(post_y, train_t).mean()
+        post_acc = _accuracy(post_y, train_t)
+
+    val_y = _readout(val_act, weight)
+    val_loss = _task_loss(val_y, val_t).mean()
+    with torch.no_grad():
+        val_acc = _accuracy(val_y, val_t)
+
+    return pre_acc, pre_loss, post_acc, post_loss, val_acc, val_loss
+
+
+def _get_inner_mode(config):
+    """Inner loop mode and truncation of a config, see run_batched."""
+    inner_mode = getattr(config, 'meta_inner_mode', None)
+    if inner_mode is None:
+        inner_mode = 'first_order' if config.meta_stop_grad else 'second_order'
+    elif config.meta_stop_grad and inner_mode != 'first_order':
+        raise ValueError('meta_stop_grad requires meta_inner_mode '
+                         'first_order, got ' + str(inner_mode))
+    return inner_mode, getattr(config, 'meta_truncate_steps', 1)
+
+
+def benchmark_inner_modes(config: configs.MetaConfig, n_iter=20,
+                          modes=('second_order', 'first_order', 'truncated',
+                                 'implicit'), data=None):
+    """Measure time and peak memory of a meta-update for each inner mode.
+
+    Args:
+        config: MetaConfig
+        n_iter: int, number of timed meta-updates per mode
+        modes: inner modes, see run_batched
+        data: None or tuple of tensors (data_x, data_t), see run_batched.
+            If None, a meta-batch of config.data_dir is used
+
+    Returns:
+        results: dict, mode to (seconds per meta-update, peak bytes). Peak
+            memory is measured on cuda with torch.cuda, and on cpu with
+            torch.profiler in one extra, untimed, meta-update
+    """
+    model = temp_meta.metamodel.Model(config=config)
+    model.to(device=device)
+    num_samples_per_class = config.meta_num_samples_per_class
+    num_class = config.meta_labels_per_class * config.N_CLASS
+    if data is None:
+        data_generator = DataGenerator(
+            dataset=config.data_dir,
+            batch_size=num_samples_per_class * num_class * 2,
+            meta_batch_size=config.meta_batch_size,
+            num_samples_per_class=num_samples_per_class,
+            num_class=num_class,
+            dim_output=config.N_CLASS,
+        )
+        x_np, t_np = data_generator.generate('train')
+        data = torch.from_numpy(x_np), torch.from_numpy(t_np)
+    x, t = data[0].to(device), data[1].to(device)
+    split_size = x.shape[1] // 2
+    update_lr = (torch.ones(1) * config.meta_update_lr).to(device)
+
+    results = dict()
+    for mode in modes:
+        def _step():
+            model.zero_grad()
+            val_loss = run_batched(
+                model, split_size, x, t, update_lr,
+                num_inner_updates=config.meta_num_updates,
+                max_update_lr=config.output_max_lr, inner_mode=mode,
+                truncate_steps=getattr(config, 'meta_truncate_steps', 1))[-1]
+            val_loss.backward()
+
+        _step()  # warm-up
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start_time = time.time()
+        for _ in range(n_iter):
+            _step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            peak_memory = torch.cuda.max_memory_allocated()
+        step_time = (time.time() - start_time) / n_iter
+        if device != 'cuda':
+            peak_memory = _cpu_peak_memory(_step)
+        results[mode] = (step_time, peak_memory)
+        print('{:s}: {:0.4f}s per meta-update, peak memory {:0.1f}MB'.format(
+            mode, step_time, peak_memory / 2**20))
+    return results
+
+
+def benchmark_main(n_kcs=(2500, 10000), num_inner_updates=(1, 5)):
+    """Benchmark inner modes on random tasks, at sizes of the paper models.
+
+    Run with python -m temp_meta.metatrain benchmark
+    """
+    results = dict()
+    for n_kc in n_kcs:
+        for n_update in num_inner_updates:
+            # Dataset entries, e.g. N_ORN, are merged as in train
+            config = configs.input_ProtoConfig()
+            config.update(configs.MetaConfig())
+            config.N_KC = n_kc
+            config.meta_num_updates = n_update
+            config.meta_truncate_steps = 1
+            split_size = config.meta_num_samples_per_class * config.N_CLASS
+            data_x = torch.rand(config.meta_batch_size, 2 * split_size,
+                                config.N_ORN)
+            labels = torch.randint(config.N_CLASS,
+                                   (config.meta_batch_size, 2 * split_size))
+            data_t = F.one_hot(labels, config.N_CLASS).float()
+            print('N_KC {:d}, {:d} inner updates'.format(n_kc, n_update))
+            results[(n_kc, n_update)] = benchmark_inner_modes(
+                config, n_iter=5, data=(data_x, data_t))
+    return results
+
+
 def train(config: configs.MetaConfig):
     dataset_config = tools.load_config(config.data_dir)
     dataset_config.update(config)
@@ -238,32 +490,39 @@ def train(config: configs.MetaConfig):
     )
 
     PRINT_INTERVAL = config.meta_print_interval
-    loss = nn.CrossEntropyLoss()
+    inner_mode, truncate_steps = _get_inner_mode(config)
 
     # Make logger
     log = defaultdict(list)
     
+    # Meta-batches are generated in the background during training
+    train_batches = data_generator.prefetch(
+        'train', n_batch=config.metatrain_iterations, device=device)
+
     start_time = time.time()
-    for itr in range(config.metatrain_iterations):
+    for itr, (train_x_torch, train_t_torch) in enumerate(train_batches):
         model.zero_grad()
 
-        train_x_np, train_y_np = data_generator.generate('train')
         if config.scramble_labels:
-            [np.random.shuffle(x) for x in train_y_np]
-        train_x_torch = torch.from_numpy(train_x_np).float().to(device)
-        train_t_torch = torch.from_numpy(train_y_np).long().to(device)
+            # Shuffle targets across samples of each task
+            perm = torch.argsort(torch.rand(train_t_torch.shape[:2],
+                                            device=device), dim=1)
+            train_t_torch = torch.gather(
+                train_t_torch, 1, perm.unsqueeze(-1).expand_as(train_t_torch))
         
         metatrain_train_pre_acc, metatrain_train_pre_loss, \
         metatrain_train_post_acc, metatrain_train_post_loss, \
         metatrain_val_acc, metatrain_val_loss = \
-            run_per_batch(model, 
-                          loss, 
-                          num_class * num_samples_per_class, 
-                          train_x_torch,
-                          train_t_torch,
-                          update_lr=meta_update_lr,
-                          max_update_lr=config.output_max_lr
-                          )
+            run_batched(model,
+                        num_class * num_samples_per_class,
+                        train_x_torch,
+                        train_t_torch,
+                        update_lr=meta_update_lr,
+                        num_inner_updates=config.meta_num_updates,
+                        max_update_lr=config.output_max_lr,
+                        inner_mode=inner_mode,
+                        truncate_steps=truncate_steps
+                        )
 
         metatrain_val_loss.backward()
         meta_optimizer.step()
@@ -292,19 +551,21 @@ def train(config: configs.MetaConfig):
                 print('meta_update_lr: {}'.format(meta_update_lr))
 
             test_x_np, test_y_np = data_generator.generate('val')
-            test_x_torch = torch.from_numpy(test_x_np).float().to(device)
-            test_t_torch = torch.from_numpy(test_y_np).long().to(device)
+            test_x_torch = torch.from_numpy(test_x_np).to(device)
+            test_t_torch = torch.from_numpy(test_y_np).to(device)
             metaval_train_pre_acc, metaval_train_pre_loss, \
             metaval_train_post_acc, metaval_train_post_loss, \
             metaval_val_acc, metaval_val_loss = \
-                run_per_batch(model,
-                              loss,
-                              num_class * num_samples_per_class,
-                              test_x_torch,
-                              test_t_torch,
-                              update_lr=meta_update_lr,
-                              max_update_lr=config.output_max_lr
-                              )
+                run_batched(model,
+                            num_class * num_samples_per_class,
+                            test_x_torch,
+                            test_t_torch,
+                            update_lr=meta_update_lr,
+                            num_inner_updates=config.meta_num_updates,
+                            max_update_lr=config.output_max_lr,
+                            inner_mode=inner_mode,
+                            truncate_steps=truncate_steps
+                            )
 
             print('Meta-val')
             print('train_pre loss: {}, acc: {}'.format(
@@ -373,4 +634,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ['benchmark']:
+        benchmark_main()
+    else:
+        main()
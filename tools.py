@@ -2,7 +2,9 @@
 
 import os
 import json
+import time
 import pickle
+import struct
 from pathlib import Path
 from copy import deepcopy
 import numpy as np
@@ -260,13 +262,87 @@ def _vary_config_control(base_config, config_ranges):
     return configs, config_diffs
 
 
+def _limit_threads(n_threads):
+    """Cap the BLAS/OpenMP thread pools of a worker process."""
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=n_threads)
+
+
+def _timed_call(func, args):
+    start_time, start_cpu_time = time.time(), time.process_time()
+    result = func(*args)
+    return (result, time.time() - start_time,
+            time.process_time() - start_cpu_time)
+
+
+def _init_worker(n_threads, initializer, initargs):
+    _limit_threads(n_threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_parallel(func, jobs, n_workers, n_threads=1, initializer=None,
+                 initargs=(), costs=None):
+    """Run func(*job) for every job in a pool of worker processes.
+
+    Args:
+        func: picklable function
+        jobs: list of argument tuples
+        n_workers: int, number of worker processes
+        n_threads: int, BLAS threads allowed in each worker
+        initializer: None or picklable function, run once in each worker
+            after the thread pools are capped
+        initargs: tuple, arguments of initializer
+        costs: None or list of estimated costs of jobs. If given, jobs are
+            submitted from the most to the least costly, so that long jobs
+            do not start last
+
+    Returns:
+        results: list of results, in the order of jobs
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    order = range(len(jobs))
+    if costs is not None:
+        order = sorted(order, key=lambda i: costs[i], reverse=True)
+
+    results = [None] * len(jobs)
+    times = [0.] * len(jobs)
+    cpu_times = [0.] * len(jobs)
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=_init_worker,
+                             initargs=(n_threads, initializer, initargs)
+                             ) as executor:
+        futures = {executor.submit(_timed_call, func, jobs[i]): i
+                   for i in order}
+        for n_done, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            results[i], times[i], cpu_times[i] = future.result()
+            print('Finished job {:d}/{:d} in {:0.1f}s'.format(
+                n_done + 1, len(jobs), times[i]))
+
+    wall_time = time.time() - start_time
+    busy_time = sum(times)
+    print('{:d} jobs finished in {:0.1f}s on {:d} workers, '
+          '{:0.1f}s of work, utilization {:0.0%}'.format(
+              len(jobs), wall_time, n_workers, busy_time,
+              busy_time / max(wall_time * n_workers, 1e-9)))
+    # CPU time of all threads of the workers, over the cores they may use
+    print('CPU utilization {:0.0%} of {:d} cores'.format(
+        sum(cpu_times) / max(wall_time * n_workers * n_threads, 1e-9),
+        n_workers * n_threads))
+    return results
+
+
 def _islikemodeldir(d):
     """Check if directory looks like a model directory."""
     try:
         files = os.listdir(d)
     except NotADirectoryError:
         return False
-    fs = ['model.ckpt', 'model.pkl', 'model.pt', 'log.pkl', 'log.npz']
+    fs = ['model.ckpt', 'model.pkl', 'model.pt', 'log.pkl', 'log.npz',
+          LOG_FILE]
     for f in fs:
         if f in files:
             return True
@@ -398,16 +474,142 @@ def get_model_name(model_path):
     return model_name
 
 
+HISTORY_FILE = 'history.h5'
+# Prefix of the state dicts of torch models in a WeightHistory
+STATE_PREFIX = 'state/'
+
+
+class WeightHistory(object):
+    """Append-only store of the weights of a model across epochs.
+
+    Every array is a HDF5 dataset with a leading epoch axis, in history.h5
+    of the model directory. Datasets are chunked one epoch at a time and not
+    compressed, so any epoch, or any slice of it, is read without reading
+    other epochs. The file is only open while appending or loading, so it
+    can be read between epochs of a running training.
+
+    Args:
+        modeldir: str, model directory
+    """
+
+    def __init__(self, modeldir):
+        self.fname = os.path.join(modeldir, HISTORY_FILE)
+
+    def exists(self):
+        return os.path.isfile(self.fname)
+
+    def _open(self, mode='r'):
+        import h5py
+        return h5py.File(self.fname, mode)
+
+    def append(self, obj, epoch):
+        """Append arrays of obj at epoch.
+
+        Arrays stored again for the last epoch are written to its row, so
+        several calls can store different arrays of the same epoch. Epochs
+        after epoch, e.g. from a run resumed from an earlier checkpoint, are
+        dropped. Rows of arrays missing at some epochs are zero.
+
+        Args:
+            obj: dictionary of numpy arrays
+            epoch: int
+
+        Raises:
+            ValueError: if an array changed shape, nothing is written
+        """
+        obj = {key: np.asarray(val) for key, val in obj.items()}
+        os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+        with self._open('a') as f:
+            for key, val in obj.items():
+                if key in f and f[key].shape[1:] != val.shape:
+                    raise ValueError(
+                        'Shape of {:s} changed from {} to {}'.format(
+                            key, f[key].shape[1:], val.shape))
+
+            if 'epoch' not in f:
+                f.create_dataset('epoch', shape=(0,), maxshape=(None,),
+                                 dtype=np.int64)
+            epochs = f['epoch'][()]
+            row = int(np.sum(epochs <= epoch))
+            if row < len(epochs):
+                self._truncate(f, row)
+            if row > 0 and epochs[row - 1] == epoch:
+                row -= 1
+            else:
+                f['epoch'].resize(row + 1, axis=0)
+                f['epoch'][row] = epoch
+
+            for key, val in obj.items():
+                if key not in f:
+                    f.create_dataset(key, shape=(0,) + val.shape,
+                                     maxshape=(None,) + val.shape,
+                                     chunks=(1,) + val.shape if val.size
+                                     else None,
+                                     dtype=val.dtype)
+                dataset = f[key]
+                if dataset.shape[0] <= row:
+                    dataset.resize(row + 1, axis=0)
+                dataset[row] = val
+
+    @staticmethod
+    def _truncate(f, n_row):
+        import h5py
+
+        def _resize(name, obj):
+            if isinstance(obj, h5py.Dataset) and obj.shape[0] > n_row:
+                obj.resize(n_row, axis=0)
+        f.visititems(_resize)
+
+    @property
+    def epochs(self):
+        """Epochs stored, np array."""
+        with self._open() as f:
+            return f['epoch'][()]
+
+    def keys(self):
+        """Names of the stored arrays."""
+        import h5py
+        keys = []
+        with self._open() as f:
+            f.visititems(lambda name, obj: keys.append(name)
+                         if isinstance(obj, h5py.Dataset)
+                         and name != 'epoch' else None)
+        return keys
+
+    def load(self, var, epoch=None, index=()):
+        """Load array var.
+
+        Args:
+            var: str, name of the array
+            epoch: None or int. If None, all epochs are loaded
+            index: tuple, slice of the array to load, e.g. (slice(None), 0)
+
+        Returns:
+            np array, with a leading epoch axis if epoch is None
+        """
+        if not isinstance(index, tuple):
+            index = (index,)
+        with self._open() as f:
+            if epoch is None:
+                return f[var][(slice(None),) + index]
+            rows = np.flatnonzero(f['epoch'][()] == epoch)
+            if len(rows) == 0:
+                raise KeyError('Epoch {} is not in {}'.format(epoch, self.fname))
+            return f[var][(rows[-1],) + index]
+
+
 def save_pickle(modeldir, obj, epoch=None):
     """Save model weights in numpy.
 
     Args:
         modeldir: str, model directory
         obj: dictionary of numpy arrays
-        epoch: int or None, epoch of training
+        epoch: int or None, epoch of training. If not None, weights are
+            appended to the WeightHistory of modeldir
     """
     if epoch is not None:
-        modeldir = os.path.join(modeldir, 'epoch', str(epoch).zfill(4))
+        WeightHistory(modeldir).append(obj, epoch)
+        return
     os.makedirs(modeldir, exist_ok=True)
     fname = os.path.join(modeldir, 'model.npz')
     np.savez_compressed(fname, **obj)
@@ -424,8 +626,101 @@ def load_pickle(modeldir):
     return var_dict
 
 
+def _epoch_history(dir):
+    """WeightHistory of model directory, if dir is its epoch directory."""
+    dir = os.path.normpath(dir)
+    if os.path.basename(dir) == 'epoch':
+        history = WeightHistory(os.path.dirname(dir))
+        if history.exists():
+            return history
+    return None
+
+
+def get_epochs(modeldir):
+    """Epochs at which the weights of a model were saved.
+
+    Args:
+        modeldir: str, model directory
+
+    Returns:
+        epochs: list of int, from the WeightHistory of the model, or from
+            its epoch/XXXX folders for runs saved before WeightHistory
+    """
+    history = WeightHistory(modeldir)
+    if history.exists():
+        return [int(epoch) for epoch in history.epochs]
+    epoch_path = os.path.join(modeldir, 'epoch')
+    if not os.path.isdir(epoch_path):
+        return []
+    return sorted(int(name) for name in os.listdir(epoch_path)
+                  if name.isdigit())
+
+
+def load_epoch_pickle(modeldir, epoch):
+    """Load model weights of the epoch-th saved epoch.
+
+    Args:
+        modeldir: str, model directory
+        epoch: int, index of the saved epoch, e.g. -1 for the last one
+
+    Returns:
+        var_dict: dictionary of numpy arrays
+    """
+    history = WeightHistory(modeldir)
+    if history.exists():
+        epoch = history.epochs[epoch]
+        return {var: history.load(var, epoch) for var in history.keys()
+                if not var.startswith(STATE_PREFIX)}
+    # Runs saved before WeightHistory, see migrate_epoch_folders
+    return load_pickle(get_modeldirs(os.path.join(modeldir, 'epoch'))[epoch])
+
+
+def migrate_epoch_folders(modeldir, remove=False):
+    """Move the epoch/XXXX folders of a model to its WeightHistory.
+
+    Weights of model.npz are stored under their names, and the state dict
+    of model.pt under state/ names, as saved by torchmodel.CustomModule.
+
+    Args:
+        modeldir: str, model directory
+        remove: bool, if True, remove the epoch folders once migrated
+    """
+    import shutil
+
+    epoch_path = os.path.join(modeldir, 'epoch')
+    if not os.path.isdir(epoch_path):
+        return
+    history = WeightHistory(modeldir)
+    if history.exists():
+        raise ValueError('WeightHistory already exists in ' + modeldir)
+    epoch_dirs = sorted(n for n in os.listdir(epoch_path) if n.isdigit())
+    for name in epoch_dirs:
+        d = os.path.join(epoch_path, name)
+        obj = dict()
+        if (os.path.isfile(os.path.join(d, 'model.npz')) or
+                os.path.isfile(os.path.join(d, 'model.pkl'))):
+            obj.update(load_pickle(d))
+        fname = os.path.join(d, 'model.pt')
+        if os.path.isfile(fname):
+            import torch
+            state_dict = torch.load(fname, map_location='cpu')
+            obj.update({STATE_PREFIX + k: v.numpy()
+                        for k, v in state_dict.items()})
+        history.append(obj, int(name))
+    print('Migrated {:d} epochs of {:s}'.format(len(epoch_dirs), modeldir))
+    if remove:
+        shutil.rmtree(epoch_path)
+
+
 def load_pickles(dir, var):
-    """Load pickle by epoch in sorted order."""
+    """Load pickle by epoch in sorted order.
+
+    If dir is the epoch directory of a model with a WeightHistory, var is
+    loaded from the history.
+    """
+    history = _epoch_history(dir)
+    if history is not None:
+        return list(history.load(var))
     out = []
     dirs = get_modeldirs(dir)
     for i, d in enumerate(dirs):
@@ -438,19 +733,128 @@ def load_pickles(dir, var):
     return out
 
 
+LOG_FILE = 'log.rec'
+# Byte length of each pickled record of LOG_FILE
+_LOG_HEADER = struct.Struct('<Q')
+# Log file name to (file size, key to (list length or None, last value))
+# of what this process last wrote to it
+_log_writers = dict()
+
+
+def _same_value(a, b):
+    if a is b:
+        return True
+    try:
+        return bool(np.array_equal(a, b))
+    except Exception:
+        return False
+
+
+def _write_log_records(fname, records, mode):
+    """Write length-prefixed pickled records, return file size."""
+    with open(fname, mode) as f:
+        for record in records:
+            data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(_LOG_HEADER.pack(len(data)) + data)
+        return f.tell()
+
+
 def save_log(modeldir, log):
-    np.savez_compressed(os.path.join(modeldir, 'log.npz'), **log)
+    """Save log, a dictionary of lists or arrays, in LOG_FILE.
+
+    Lists are treated as append-only: when the log was last saved by this
+    process, only the entries added to its lists since, and the other
+    values that changed, are appended to the file as one record. Otherwise,
+    e.g. in a new process or if a key was removed, the file is rewritten
+    atomically. The cost of saving an epoch does not grow with the number
+    of epochs.
+    """
+    fname = os.path.join(modeldir, LOG_FILE)
+    written = _log_writers.get(fname)
+    if written is not None:
+        size, entries = written
+        if (not os.path.isfile(fname) or os.path.getsize(fname) != size or
+                any(key not in log for key in entries)):
+            written = None
+
+    set_values, extend_values = dict(), dict()
+    if written is None:
+        entries = dict()
+        set_values = {key: list(val) if isinstance(val, list) else val
+                      for key, val in log.items()}
+    else:
+        for key, val in log.items():
+            n, last = entries.get(key, (None, None))
+            if not isinstance(val, list):
+                if key not in entries or not _same_value(val, last):
+                    set_values[key] = val
+            elif (n is not None and n <= len(val) and
+                  (n == 0 or _same_value(val[n - 1], last))):
+                if len(val) > n:
+                    extend_values[key] = val[n:]
+            else:
+                set_values[key] = list(val)
+
+    for key, val in log.items():
+        if isinstance(val, list):
+            entries[key] = (len(val), val[-1] if val else None)
+        else:
+            entries[key] = (None, val)
+
+    record = {'set': set_values, 'extend': extend_values}
+    if written is None:
+        tmp_fname = fname + '.tmp'
+        _write_log_records(tmp_fname, [record], 'wb')
+        os.replace(tmp_fname, fname)
+        size = os.path.getsize(fname)
+    elif set_values or extend_values:
+        size = _write_log_records(fname, [record], 'ab')
+    _log_writers[fname] = (size, entries)
+
+
+def _read_log_records(fname):
+    """Read records of LOG_FILE, ignoring a truncated last record.
+
+    Returns:
+        log: dictionary of np arrays
+    """
+    with open(fname, 'rb') as f:
+        data = f.read()
+    log = dict()
+    pos = 0
+    while pos + _LOG_HEADER.size <= len(data):
+        n, = _LOG_HEADER.unpack_from(data, pos)
+        start = pos + _LOG_HEADER.size
+        if start + n > len(data):
+            break  # Record being written, or cut by a crash
+        try:
+            record = pickle.loads(data[start:start + n])
+        except Exception:
+            break
+        pos = start + n
+        for key, val in record['set'].items():
+            log[key] = list(val) if isinstance(val, list) else val
+        for key, val in record['extend'].items():
+            log.setdefault(key, []).extend(val)
+    return {key: np.asarray(val) for key, val in log.items()}
 
 
 def load_log(modeldir):
+    """Load log of a model, as a dictionary of np arrays.
+
+    The log can be loaded while the model is training.
+    """
+    file_rec = os.path.join(modeldir, LOG_FILE)
     file_np = os.path.join(modeldir, 'log.npz')
     file_pkl = os.path.join(modeldir, 'log.pkl')
-    if os.path.isfile(file_np):
+    if os.path.isfile(file_rec):
+        log = _read_log_records(file_rec)
+    elif os.path.isfile(file_np):
         log = np.load(file_np)
     else:
         with open(file_pkl, 'rb') as f:
             log = pickle.load(f)
-        save_log(modeldir, log)  # resave with npz
+        save_log(modeldir, log)  # resave with LOG_FILE
     return log
 
 
@@ -557,8 +961,13 @@ def load_all_results(path, select_dict=None, exclude_dict=None,
         config = load_config(d)
 
         n_actual_epoch = len(log['val_acc'])
-        
-        if exclude_early_models and n_actual_epoch < config.max_epoch:
+
+        # Runs ended by a stopping rule, or validated less often than every
+        # epoch, are complete, see torchtrain.EarlyStopping
+        completed = ('stop_reason' in log and
+                     log['stop_reason'][0] != 'interrupted')
+        if (exclude_early_models and n_actual_epoch < config.max_epoch
+                and not completed):
             continue
 
         # Add logger values
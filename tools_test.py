@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import tools
+
+
+class TestTools(unittest.TestCase):
+
+    def test_weight_history(self):
+        with tempfile.TemporaryDirectory() as modeldir:
+            history = tools.WeightHistory(modeldir)
+            ws = [np.random.rand(5, 3) for _ in range(4)]
+            for ep, w in enumerate(ws[:3]):
+                tools.save_pickle(modeldir, {'w_glo': w}, epoch=ep)
+                tools.save_pickle(modeldir, {'b_glo': w[0]}, epoch=ep)
+            # Resuming from epoch 1 drops epoch 2
+            tools.save_pickle(modeldir, {'w_glo': ws[3]}, epoch=1)
+
+            np.testing.assert_array_equal(history.epochs, [0, 1])
+            self.assertEqual(tools.get_epochs(modeldir), [0, 1])
+            self.assertEqual(set(history.keys()), {'w_glo', 'b_glo'})
+            np.testing.assert_array_equal(history.load('w_glo', 1), ws[3])
+            np.testing.assert_array_equal(
+                history.load('w_glo', 0, index=(slice(None), 1)), ws[0][:, 1])
+            wglos = tools.load_pickles(os.path.join(modeldir, 'epoch'), 'w_glo')
+            np.testing.assert_array_equal(wglos, [ws[0], ws[3]])
+            np.testing.assert_array_equal(
+                tools.load_epoch_pickle(modeldir, -1)['w_glo'], ws[3])
+            with self.assertRaises(ValueError):
+                history.append({'w_glo': np.zeros(3)}, 2)
+
+    def test_migrate_epoch_folders(self):
+        with tempfile.TemporaryDirectory() as modeldir:
+            ws = [np.random.rand(5, 3) for _ in range(3)]
+            for ep, w in enumerate(ws):
+                epoch_dir = os.path.join(modeldir, 'epoch', str(ep).zfill(4))
+                tools.save_pickle(epoch_dir, {'w_glo': w})
+            epoch_path = os.path.join(modeldir, 'epoch')
+            self.assertEqual(tools.get_epochs(modeldir), [0, 1, 2])
+
+            tools.migrate_epoch_folders(modeldir, remove=True)
+            self.assertFalse(os.path.exists(epoch_path))
+            self.assertEqual(tools.get_epochs(modeldir), [0, 1, 2])
+            np.testing.assert_array_equal(
+                tools.load_pickles(epoch_path, 'w_glo'), ws)
+
+    def test_save_log(self):
+        with tempfile.TemporaryDirectory() as modeldir:
+            log = {'log_bins': np.linspace(0, 1, 5), 'val_acc': []}
+            for ep in range(3):
+                log['val_acc'].append(ep / 10)
+                log['kc_hist'] = log.get('kc_hist', []) + [np.full(4, ep)]
+                log['stop_epoch'] = [ep]
+                tools.save_log(modeldir, log)
+                loaded = tools.load_log(modeldir)
+                self.assertEqual(set(loaded.keys()), set(log.keys()))
+                for key, val in log.items():
+                    np.testing.assert_array_equal(loaded[key], val)
+
+            # Same view as the previous log.npz format
+            np.savez_compressed(os.path.join(modeldir, 'log.npz'), **log)
+            log_npz = np.load(os.path.join(modeldir, 'log.npz'))
+            for key in log_npz.keys():
+                np.testing.assert_array_equal(loaded[key], log_npz[key])
+                self.assertEqual(loaded[key].dtype, log_npz[key].dtype)
+
+            # A record cut by a crash is ignored
+            fname = os.path.join(modeldir, tools.LOG_FILE)
+            size = os.path.getsize(fname)
+            log['val_acc'].append(0.5)
+            tools.save_log(modeldir, log)
+            with open(fname, 'r+b') as f:
+                f.truncate(size + 10)
+            np.testing.assert_array_equal(
+                tools.load_log(modeldir)['val_acc'], [0, 0.1, 0.2])
+
+            # The file changed since, so the log is rewritten
+            tools.save_log(modeldir, log)
+            np.testing.assert_array_equal(
+                tools.load_log(modeldir)['val_acc'], log['val_acc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
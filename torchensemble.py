@@ -0,0 +1,649 @@
+"""Train several models of the same architecture together.
+
+Sweeps over learning rates or random initializations train many small
+models that differ only in their parameters. An Ensemble stacks the
+parameters of M such models and runs them in one forward pass of batched
+matmuls, so M models cost a few large kernels instead of M small ones.
+"""
+
+import copy
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+import torchtrain
+from torchmodel import get_model, FullModel, SparseLayer, OlsenNorm
+from standard.analysis_weight import ThresholdEstimator
+import tools
+
+device = torchtrain.device
+
+# Config entries that may differ between members of an ensemble: learning
+# rates, initial values, ORN noise and early stopping
+MEMBER_KEYS = ('lr', 'pn2kc_lr', 'model_name', 'save_path', 'kc_bias',
+               'initial_orn2pn', 'initial_pn2kc', 'ORN_NOISE_STD',
+               'target_acc', 'early_stop_patience', 'early_stop_min_delta',
+               'early_stop_weight_tol', 'eval_max_interval', 'eval_stable_tol')
+# Checkpoint of an ensemble, saved in the save_path of its first member
+ENSEMBLE_CHECKPOINT = 'ensemble_checkpoint.pt'
+
+
+def _ensemble_key(config):
+    return tuple(sorted((key, repr(val)) for key, val
+                        in config.__dict__.items() if key not in MEMBER_KEYS))
+
+
+def group_ensembles(configs, max_size=None):
+    """Group configs that can be trained together.
+
+    Configs can be trained together if they only differ in MEMBER_KEYS.
+    Configs differing in any other entry, e.g. N_KC or a normalization in a
+    sweep over architectures, end up in separate groups, down to one config
+    per group.
+
+    Args:
+        configs: list of configs
+        max_size: None or int, maximum number of configs per group
+
+    Returns:
+        groups: list of lists of configs, in the order of configs
+    """
+    groups = dict()
+    for config in configs:
+        groups.setdefault(_ensemble_key(config), []).append(config)
+    groups = list(groups.values())
+    if max_size is not None:
+        groups = [group[i:i+max_size] for group in groups
+                  for i in range(0, len(group), max_size)]
+    return groups
+
+
+def _stacked_norm(norm, prefix, params, buffers, x, training):
+    """Normalization norm of each member applied to x (M, batch_size, F)."""
+    if isinstance(norm, nn.BatchNorm1d):
+        n_model, batch_size, n_feature = x.shape
+        momentum = 0. if norm.momentum is None else norm.momentum
+        if training and norm.track_running_stats:
+            num_batches_tracked = buffers[prefix + 'num_batches_tracked']
+            num_batches_tracked.add_(1)
+            if norm.momentum is None:
+                momentum = 1. / float(num_batches_tracked[0])
+        running_stats = [buffers.get(prefix + 'running_mean'),
+                         buffers.get(prefix + 'running_var')]
+        # batch_norm updates copies of the running statistics, autograd may
+        # keep them while the buffers are restored, see Ensemble.freeze
+        new_stats = [None if val is None else val.flatten().clone()
+                     for val in running_stats]
+        weight = params.get(prefix + 'weight')
+        bias = params.get(prefix + 'bias')
+        # Features of all members side by side
+        out = F.batch_norm(
+            x.transpose(0, 1).reshape(batch_size, n_model * n_feature),
+            new_stats[0], new_stats[1],
+            None if weight is None else weight.view(-1),
+            None if bias is None else bias.view(-1),
+            training or not norm.track_running_stats, momentum, norm.eps)
+        for val, new_val in zip(running_stats, new_stats):
+            if val is not None:
+                val.copy_(new_val.view(val.shape))
+        return out.view(batch_size, n_model, n_feature).transpose(0, 1)
+    if isinstance(norm, nn.LayerNorm):
+        out = F.layer_norm(x, norm.normalized_shape, eps=norm.eps)
+        if norm.elementwise_affine:
+            out = (out * params[prefix + 'weight'].unsqueeze(1) +
+                   params[prefix + 'bias'].unsqueeze(1))
+        return out
+    if isinstance(norm, OlsenNorm):
+        return norm.normalize(x, params[prefix + 'r_max'],
+                              params[prefix + 'rho'], params[prefix + 'm'])
+    # Normalizations without parameters
+    return norm(x)
+
+
+def _stacked_layer(layer, prefix, params, buffers, x):
+    """Layer of each member applied to x (M, batch_size, in_features).
+
+    Same as Layer.forward and SparseLayer.forward for every member.
+    """
+    weight = params[prefix + 'weight']
+    bias = params.get(prefix + 'bias')
+    if isinstance(layer, SparseLayer):
+        indices = buffers[prefix + 'indices']  # (M, out_features, n_inputs)
+        weight = layer.get_sparse_weight(weight, buffers[prefix + 'mask'])
+        if layer.weight_dropout:
+            weight = layer.w_dropout(weight)
+        n_model, batch_size, _ = x.shape
+        inputs = x.gather(2, indices.view(n_model, 1, -1).expand(
+            -1, batch_size, -1))
+        inputs = inputs.view((n_model, batch_size) + indices.shape[1:])
+        pre_act = torch.sum(inputs * weight.unsqueeze(1), dim=-1)
+        if bias is not None:
+            pre_act = pre_act + bias.unsqueeze(1)
+    else:
+        weight = layer.get_effective_weight(weight)
+        if layer.feedforward_inh:
+            weight = weight - layer.feedforward_inh_coeff * torch.mean(
+                weight, dim=(1, 2), keepdim=True)
+        if layer.weight_dropout:
+            weight = layer.w_dropout(weight)
+        pre_act = _stacked_linear(x, weight, bias)
+
+    training = layer.training
+    pre_act_normalized = _stacked_norm(layer.pre_norm, prefix + 'pre_norm.',
+                                       params, buffers, pre_act, training)
+    output = layer.activation(pre_act_normalized)
+
+    if layer.recurrent_inh:
+        for i in range(layer.recurrent_inh_step):
+            rec_inh = torch.mean(output, dim=-1, keepdim=True)
+            rec_inh = rec_inh * layer.recurrent_inh_coeff
+            output = layer.activation(pre_act_normalized - rec_inh)
+
+    output_normalized = _stacked_norm(layer.post_norm, prefix + 'post_norm.',
+                                      params, buffers, output, training)
+    return layer.dropout(output_normalized)
+
+
+def _stacked_linear(x, weight, bias=None):
+    """F.linear of each member, x (M, batch_size, in), weight (M, out, in)."""
+    if bias is None:
+        return torch.bmm(x, weight.transpose(1, 2))
+    return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+
+
+class Ensemble(object):
+    """Full models of configs evaluated together.
+
+    Parameters and buffers of the members are stacked along a first
+    dimension of size M, and every layer runs as one batched matmul over
+    the members. Calling the ensemble returns the results of all members,
+    stacked in the same way. member(i) returns member i as a regular model,
+    e.g. to log or save it.
+
+    Args:
+        configs: list of M configs of full models that only differ in
+            MEMBER_KEYS
+    """
+
+    def __init__(self, configs):
+        self.configs = configs
+        self.models = [get_model(config).to(device) for config in configs]
+        if not isinstance(self.models[0], FullModel):
+            raise ValueError('Ensembles only support full models, got ' +
+                             str(configs[0].model))
+        # Structure and train/eval mode of all members
+        self.base = self.models[0]
+
+        self.params = dict()
+        for name, param in self.base.named_parameters():
+            stacked = torch.stack([dict(model.named_parameters())[name].detach()
+                                   for model in self.models])
+            self.params[name] = stacked.requires_grad_(param.requires_grad)
+        self.buffers = {
+            name: torch.stack([dict(model.named_buffers())[name]
+                               for model in self.models])
+            for name, _ in self.base.named_buffers()}
+
+        noise_std = [config.ORN_NOISE_STD for config in configs]
+        self.noise_std = None
+        if max(noise_std) > 0:
+            self.noise_std = torch.tensor(noise_std, device=device).view(
+                -1, 1, 1)
+        # Buffers of stopped members, restored after each forward
+        self.frozen_buffers = dict()
+
+    def __len__(self):
+        return len(self.models)
+
+    def __call__(self, x, target):
+        results = self._forward(x, target)
+        with torch.no_grad():
+            for i, buffers in self.frozen_buffers.items():
+                for name, val in buffers.items():
+                    self.buffers[name][i] = val
+        return results
+
+    def _forward(self, x, target):
+        """Same as FullModel.forward for every member, without readout."""
+        base, params, buffers = self.base, self.params, self.buffers
+        config = base.config
+        n_model = len(self)
+        if config.receptor_layer:
+            act0 = _stacked_layer(base.layer0, 'layer0.', params, buffers,
+                                  x.expand(n_model, -1, -1))
+        else:
+            act0 = x
+            if config.N_ORN_DUPLICATION > 1:
+                act0 = act0.repeat(1, config.N_ORN_DUPLICATION)
+            act0 = act0.expand(n_model, -1, -1)
+
+        if self.noise_std is not None:
+            act0 = act0 + torch.randn(act0.shape, device=act0.device,
+                                      dtype=act0.dtype) * self.noise_std
+
+        act1 = _stacked_layer(base.layer1, 'layer1.', params, buffers, act0)
+        act2 = _stacked_layer(base.layer2, 'layer2.', params, buffers, act1)
+        y = _stacked_linear(act2, params['layer3.weight'],
+                            params['layer3.bias'])
+
+        def _loss_acc(y, target):
+            n_class = y.shape[-1]
+            target = target.expand(n_model, -1)
+            loss = F.cross_entropy(y.reshape(-1, n_class), target.reshape(-1),
+                                   reduction='none').view(n_model, -1)
+            with torch.no_grad():
+                _, pred = torch.max(y, -1)
+                acc = (pred == target).float().mean(1)
+            return loss.mean(1), acc
+
+        if base.multihead:
+            loss, acc = _loss_acc(y, target[:, 0])
+            y_2 = _stacked_linear(act2, params['layer3_2.weight'],
+                                  params['layer3_2.bias'])
+            loss_2, acc2 = _loss_acc(y_2, target[:, 1])
+            return {'loss': loss + loss_2, 'acc': (acc + acc2) / 2,
+                    'loss_1': loss, 'acc1': acc,
+                    'loss_2': loss_2, 'acc2': acc2}
+        loss, acc = _loss_acc(y, target)
+        return {'loss': loss, 'acc': acc}
+
+    def train(self):
+        self.base.train()
+
+    def eval(self):
+        self.base.eval()
+
+    def freeze(self, i):
+        """Keep the buffers of member i, e.g. running statistics, as they are.
+
+        Parameters are frozen by the optimizer, see EnsembleAdam.freeze.
+        """
+        self.frozen_buffers[i] = {name: val[i].clone()
+                                  for name, val in self.buffers.items()}
+
+    def member(self, i):
+        """Model i with its current parameters and buffers."""
+        state_dict = {name: val[i] for name, val in self.params.items()}
+        state_dict.update({name: val[i] for name, val in self.buffers.items()})
+        model = self.models[i]
+        with torch.no_grad():
+            model.load_state_dict(state_dict)
+        return model
+
+
+class EnsembleAdam(object):
+    """Adam on stacked parameters, with one learning rate per member.
+
+    Same update as torch.optim.Adam with default arguments.
+
+    Args:
+        params: dict of stacked parameters, name to tensor (M, ...)
+        lrs: dict of name to learning rates (M,), or list of M learning
+            rates used for all parameters
+    """
+
+    def __init__(self, params, lrs, betas=(0.9, 0.999), eps=1e-8):
+        self.params = {name: param for name, param in params.items()
+                       if param.requires_grad}
+        if not isinstance(lrs, dict):
+            lrs = {name: lrs for name in self.params}
+        self.lrs = dict()
+        for name, param in self.params.items():
+            lr = torch.tensor(lrs[name], dtype=param.dtype, device=param.device)
+            self.lrs[name] = lr.view((-1,) + (1,) * (param.dim() - 1))
+        self.betas = betas
+        self.eps = eps
+        self.n_step = 0
+        self.exp_avg = {name: torch.zeros_like(param)
+                        for name, param in self.params.items()}
+        self.exp_avg_sq = {name: torch.zeros_like(param)
+                           for name, param in self.params.items()}
+
+    def zero_grad(self):
+        for param in self.params.values():
+            param.grad = None
+
+    def freeze(self, i):
+        """Stop updating the parameters of member i."""
+        for lr in self.lrs.values():
+            lr[i] = 0
+
+    def state_dict(self):
+        return {'n_step': self.n_step, 'lrs': self.lrs,
+                'exp_avg': self.exp_avg, 'exp_avg_sq': self.exp_avg_sq}
+
+    def load_state_dict(self, state_dict):
+        self.n_step = state_dict['n_step']
+        for key in ['lrs', 'exp_avg', 'exp_avg_sq']:
+            for name, val in getattr(self, key).items():
+                val.copy_(state_dict[key][name])
+
+    @torch.no_grad()
+    def step(self):
+        self.n_step += 1
+        beta1, beta2 = self.betas
+        bias_correction1 = 1 - beta1 ** self.n_step
+        bias_correction2 = 1 - beta2 ** self.n_step
+        for name, param in self.params.items():
+            if param.grad is None:
+                continue
+            exp_avg, exp_avg_sq = self.exp_avg[name], self.exp_avg_sq[name]
+            exp_avg.mul_(beta1).add_(param.grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(param.grad, param.grad,
+                                            value=1 - beta2)
+            denom = (exp_avg_sq.sqrt() / np.sqrt(bias_correction2)).add_(
+                self.eps)
+            param.sub_(self.lrs[name] / bias_correction1 * exp_avg / denom)
+
+
+def _get_lrs(ensemble):
+    """Learning rate of each member for each parameter."""
+    lrs = dict()
+    for name in ensemble.params:
+        if name in ['layer2.weight', 'layer2.bias']:
+            lrs[name] = [getattr(config, 'pn2kc_lr', config.lr)
+                         for config in ensemble.configs]
+        else:
+            lrs[name] = [config.lr for config in ensemble.configs]
+    return lrs
+
+
+def train_ensemble(configs, reload=True):
+    """Train models of configs together, see Ensemble.
+
+    Members are trained on the same batches. Each member's config, log and
+    weights are saved in its save_path as torchtrain.train does. Each
+    member is validated and stopped early by its own EarlyStopping, a
+    stopped member is no longer updated nor logged.
+
+    Every config.checkpoint_every epochs, and at the end of training, the
+    state of training is saved in ENSEMBLE_CHECKPOINT of the first member.
+
+    Args:
+        configs: list of configs of full models that only differ in
+            MEMBER_KEYS
+        reload: bool, if True and the first member holds a checkpoint of
+            the same ensemble and configs, see torchtrain.config_hash,
+            training resumes from it
+    """
+    configs = [torchtrain._merge_dataset_config(config) for config in configs]
+    if len(group_ensembles(configs)) > 1:
+        raise ValueError('Configs of an ensemble can only differ in ' +
+                         str(MEMBER_KEYS))
+    config = configs[0]
+    if (getattr(config, 'sparse_pn2kc_layer', False) and
+            config.kc_prune_weak_weights):
+        raise ValueError('Ensembles cannot sparsify pruned PN-KC layers')
+    if getattr(config, 'async_logging', False):
+        raise ValueError('Ensembles do not support async_logging')
+    print('Training ensemble of {:d} models'.format(len(configs)))
+    for item in config.__dict__.items():
+        print(item)
+
+    for member_config in configs:
+        os.makedirs(member_config.save_path, exist_ok=True)
+        tools.save_config(member_config, save_path=member_config.save_path)
+
+    ensemble = Ensemble(configs)
+    optimizer = EnsembleAdam(ensemble.params, _get_lrs(ensemble))
+    save_paths = [c.save_path for c in configs]
+    train_batches, val_data, val_target, n_train, stream = torchtrain._get_data(
+        config, save_paths=save_paths)
+
+    n_member = len(ensemble)
+    logs = [defaultdict(list) for _ in range(n_member)]
+    for log in logs:
+        log['log_bins'] = np.linspace(-20, 5, 201)
+        log['activity_bins'] = np.linspace(0, 1, 201)
+    estimators = [ThresholdEstimator() for _ in range(n_member)]
+    stoppers = [torchtrain.EarlyStopping(c) for c in configs]
+    # Epoch at which each member stopped, None while it trains
+    stop_epochs = [None] * n_member
+
+    start_epoch = 0
+    loss_train = np.zeros(n_member)
+    acc_train = np.full(n_member, np.nan)
+    total_time, start_time = 0, time.time()
+    finish_training = False
+
+    checkpoint = None
+    if reload:
+        checkpoint = torchtrain.load_checkpoint(config.save_path,
+                                                name=ENSEMBLE_CHECKPOINT)
+    config_hashes = [torchtrain.config_hash(c) for c in configs]
+    if checkpoint is not None and (
+            checkpoint['save_paths'] != save_paths or
+            checkpoint.get('config_hashes') != config_hashes):
+        print('Warning: ignoring checkpoint of another ensemble or of '
+              'different configs, training from scratch')
+        checkpoint = None
+    if checkpoint is not None:
+        print('Resuming from epoch {:d}'.format(checkpoint['epoch']))
+        with torch.no_grad():
+            for name, val in ensemble.params.items():
+                val.copy_(checkpoint['params'][name])
+            for name, val in ensemble.buffers.items():
+                val.copy_(checkpoint['buffers'][name])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if stream is not None:
+            stream.load_state_dict(checkpoint['stream'])
+        start_epoch = checkpoint['epoch']
+        loss_train = checkpoint['loss_train']
+        acc_train = checkpoint['acc_train']
+        logs = [defaultdict(list, log) for log in checkpoint['logs']]
+        for estimator, params in zip(estimators,
+                                     checkpoint['estimator_params']):
+            estimator.params = params
+        for stopper, state in zip(stoppers, checkpoint['stoppers']):
+            stopper.load_state_dict(state)
+        stop_epochs = checkpoint['stop_epochs']
+        for i, stop_epoch in enumerate(stop_epochs):
+            if stop_epoch is not None:
+                ensemble.freeze(i)
+        torchtrain._set_rng_state(checkpoint['rng'])
+
+    def _checkpoint(epoch):
+        torchtrain.save_checkpoint(config.save_path, {
+            'save_paths': save_paths,
+            'config_hashes': config_hashes,
+            'epoch': epoch,
+            'params': ensemble.params,
+            'buffers': ensemble.buffers,
+            'optimizer': optimizer.state_dict(),
+            'stream': None if stream is None else stream.state_dict(),
+            'loss_train': loss_train,
+            'acc_train': acc_train,
+            'logs': [dict(log) for log in logs],
+            'estimator_params': [e.params for e in estimators],
+            'stoppers': [stopper.state_dict() for stopper in stoppers],
+            'stop_epochs': stop_epochs,
+            'rng': torchtrain._get_rng_state(),
+        }, name=ENSEMBLE_CHECKPOINT)
+
+    def _all_stopped():
+        return all(stop_epoch is not None for stop_epoch in stop_epochs)
+
+    checkpoint_every = getattr(config, 'checkpoint_every', 0)
+    # Epoch to resume from if training ends before max_epoch
+    next_epoch = start_epoch
+    for ep in range(start_epoch, config.max_epoch):
+        if _all_stopped():
+            # Resumed from the checkpoint of a stopped ensemble
+            break
+
+        if checkpoint_every > 0 and ep > start_epoch and (
+                ep % checkpoint_every == 0):
+            _checkpoint(ep)
+
+        print('[*' + '*'*50 + '*]')
+        print('Epoch {:d}'.format(ep))
+        for i, (log, member_config) in enumerate(zip(logs, configs)):
+            if stop_epochs[i] is not None:
+                continue
+            model = ensemble.member(i)
+            if config.save_every_epoch:
+                model.save_pickle(ep)
+                model.save(ep)
+            if not stoppers[i].should_validate(ep):
+                continue
+
+            # Members are validated one at a time, to bound memory
+            with torch.no_grad():
+                model.eval()
+                model.readout(outputs=['kc'])
+                res_val = model(val_data, val_target)
+                model.readout(False)
+            loss_val = res_val['loss'].item()
+            acc_val = res_val['acc'].item()
+
+            print('Model {:s}'.format(str(member_config.model_name)))
+            print('Train/Validation loss {:0.2f}/{:0.2f}'.format(
+                loss_train[i], loss_val))
+            print('Train/Validation accuracy {:0.2f}/{:0.2f}'.format(
+                acc_train[i], acc_val))
+            log['epoch'].append(ep)
+            log['train_loss'].append(loss_train[i])
+            log['val_loss'].append(loss_val)
+            log['train_acc'].append(acc_train[i])
+            log['val_acc'].append(acc_val)
+
+            logs[i] = torchtrain.logging(log, model, member_config, res_val,
+                                         estimator=estimators[i])
+
+            weight = None
+            if stoppers[i].weight_tol is not None and config.model == 'full':
+                weight = model.layer2.effective_weight
+            if stoppers[i].update(ep, loss_val, acc_val, weight) is not None:
+                # Parameters and buffers of the member stay as they are at
+                # this epoch
+                stop_epochs[i] = ep
+                ensemble.freeze(i)
+                optimizer.freeze(i)
+
+        if _all_stopped():
+            break
+
+        if ep > 0:
+            time_spent = time.time() - start_time
+            total_time += time_spent
+            print('Time taken {:0.1f}s'.format(total_time))
+        start_time = time.time()
+
+        try:
+            ensemble.train()
+            train_start_time = time.time()
+            loss_sum = torch.zeros(n_member, device=device)
+            acc_sum = torch.zeros(n_member, device=device)
+            n_batch = 0
+            for x, target in train_batches():
+                res = ensemble(x, target)
+                optimizer.zero_grad()
+                # Members do not share parameters, so summed losses give
+                # each member its own gradients
+                res['loss'].sum().backward()
+                optimizer.step()
+                loss_sum += res['loss'].detach()
+                acc_sum += res['acc']
+                n_batch += 1
+
+            loss_train = (loss_sum / n_batch).cpu().numpy()
+            acc_train = (acc_sum / n_batch).cpu().numpy()
+            train_throughput = n_train / (time.time() - train_start_time)
+            for log, stop_epoch in zip(logs, stop_epochs):
+                if stop_epoch is None:
+                    log['train_samples_per_sec'].append(train_throughput)
+            print('Training examples/second {:d} per model, {:d} total'.format(
+                int(train_throughput), int(train_throughput * n_member)))
+            next_epoch = ep + 1
+
+        except KeyboardInterrupt:
+            print('Training interrupted by users')
+            finish_training = True
+
+        if finish_training:
+            break
+        sys.stdout.flush()
+
+    if checkpoint_every > 0 and not finish_training:
+        # Training can be extended by resuming with a larger max_epoch
+        _checkpoint(next_epoch)
+
+    print('Training finished')
+
+    # Why and when each member stopped, as in torchtrain.train
+    for i, (log, member_config) in enumerate(zip(logs, configs)):
+        if stop_epochs[i] is not None:
+            stop_reason, stop_epoch = stoppers[i].stop_reason, stop_epochs[i]
+        elif finish_training:
+            stop_reason, stop_epoch = 'interrupted', next_epoch
+        else:
+            stop_reason, stop_epoch = 'max_epoch', next_epoch
+        log['stop_reason'] = [stop_reason]
+        log['stop_epoch'] = [stop_epoch]
+        tools.save_log(member_config.save_path, log)
+
+    if 'save_log_only' in dir(config) and config.save_log_only is True:
+        pass
+    else:
+        for i in range(n_member):
+            model = ensemble.member(i)
+            model.save_pickle()
+            model.save()
+
+
+def benchmark_ensemble(config, sizes=(1, 4, 16), batch_size=256, n_step=50):
+    """Compare training steps of ensembles with separate models.
+
+    Returns:
+        results: dict, ensemble size to (ensemble, separate) aggregate
+            training samples per second
+    """
+    x = torch.rand(batch_size, config.N_ORN, device=device)
+    target = torch.randint(config.N_CLASS, (batch_size,), device=device)
+
+    def _time(step):
+        step()  # warm-up
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(n_step):
+            step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        return time.time() - start_time
+
+    results = dict()
+    for size in sizes:
+        configs = [copy.deepcopy(config) for _ in range(size)]
+        ensemble = Ensemble(configs)
+        ensemble.train()
+        optimizer = EnsembleAdam(ensemble.params, [config.lr] * size)
+
+        def ensemble_step():
+            optimizer.zero_grad()
+            ensemble(x, target)['loss'].sum().backward()
+            optimizer.step()
+
+        models = ensemble.models
+        optimizers = [torch.optim.Adam(model.parameters(), lr=config.lr)
+                      for model in models]
+
+        def separate_step():
+            for model, model_optimizer in zip(models, optimizers):
+                model.train()
+                model_optimizer.zero_grad()
+                model(x, target)['loss'].backward()
+                model_optimizer.step()
+
+        n_sample = size * batch_size * n_step
+        results[size] = (n_sample / _time(ensemble_step),
+                         n_sample / _time(separate_step))
+        print('{:d} models: ensemble {:d}, separate {:d} samples/second'.format(
+            size, int(results[size][0]), int(results[size][1])))
+    return results
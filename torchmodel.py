@@ -95,10 +95,18 @@ class OlsenNorm(nn.Module):
         nn.init.constant_(self.m, 0.99)
 
     def forward(self, input):
-        r_max = torch.clamp(self.r_max, self.num_features / 10.,
+        return self.normalize(input, self.r_max, self.rho, self.m)
+
+    def normalize(self, input, r_max, rho, m):
+        """Normalize input with parameters r_max, rho and m.
+
+        Parameters may be stacked for several models, e.g. (n_model, 1,
+        num_features) for input (n_model, batch_size, num_features).
+        """
+        r_max = torch.clamp(r_max, self.num_features / 10.,
                             self.num_features)
-        rho = torch.clamp(self.rho, 0., 3.)
-        m = torch.clamp(self.m, 0.05, 2.)
+        rho = torch.clamp(rho, 0., 3.)
+        m = torch.clamp(m, 0.05, 2.)
 
         input_sum = torch.sum(input, dim=-1, keepdim=True) + 1e-6
         input_exponentiated = input ** self.exponent
@@ -253,10 +261,16 @@ class Layer(nn.Module):
 
     @property
     def effective_weight(self):
+        return self.get_effective_weight(self.weight)
+
+    def get_effective_weight(self, weight):
+        """Effective weight of weight (out_features, in_features).
+
+        weight may also be stacked for several models, (n_model,
+        out_features, in_features).
+        """
         if self.sign_constraint:
-            weight = torch.abs(self.weight)
-        else:
-            weight = self.weight
+            weight = torch.abs(weight)
 
         if self.prune_weak_weights:
             not_pruned = (weight > self.prune_threshold)
@@ -264,12 +278,12 @@ class Layer(nn.Module):
 
         if self.weight_norm:
             # Renormalize weights
-            sums = torch.sum(weight, dim=1, keepdim=True)
+            sums = torch.sum(weight, dim=-1, keepdim=True)
             weight = torch.div(weight, sums)
 
         return weight
 
-    def forward(self, input):
+    def _linear(self, input):
         # Random perturbation of weights
         # pre_act = F.linear(input, self.effective_weight, self.bias)
         # weight = self.w_dropout(self.effective_weight)
@@ -282,7 +296,10 @@ class Layer(nn.Module):
         if self.weight_dropout:
             weight = self.w_dropout(weight)
 
-        pre_act = F.linear(input, weight, self.bias)  # (batch_size, neurons)
+        return F.linear(input, weight, self.bias)  # (batch_size, neurons)
+
+    def forward(self, input):
+        pre_act = self._linear(input)
         pre_act_normalized = self.pre_norm(pre_act)
 
         output = self.activation(pre_act_normalized)
@@ -305,18 +322,180 @@ class Layer(nn.Module):
         )
 
 
+def get_active_columns(active):
+    """Columns of the active entries in each row, padded to the same length.
+
+    Args:
+        active: bool tensor (n_row, n_col)
+
+    Returns:
+        columns: long tensor (n_row, n_active), n_active is the maximum
+            number of active entries in a row
+        mask: float tensor (n_row, n_active), 0 for padded entries
+    """
+    n_active = max(int(active.sum(dim=1).max()), 1)
+    mask, columns = torch.topk(active.float(), n_active, dim=1)
+    return columns, mask
+
+
+class SparseLayer(Layer):
+    """Layer storing only the connections onto each output unit.
+
+    Output unit i receives inputs indices[i] with weights weight[i], so
+    weight has shape (out_features, n_inputs) instead of (out_features,
+    in_features). Pre-activations are computed by gathering the inputs and
+    summing, which is cheaper than the dense matmul of Layer when n_inputs
+    is small, see benchmark_sparse_layer. Units with fewer inputs are padded
+    with entries masked to 0.
+
+    Sign constraint, pruning and weight normalization apply to the stored
+    weights as in Layer, effective_weight returns the dense weight.
+
+    Args:
+        in_features, out_features: int
+        indices: long tensor or np array (out_features, n_inputs)
+        mask: None or tensor (out_features, n_inputs), 0 for padded entries
+        kwargs: other arguments of Layer, except feedforward_inh that
+            connects all inputs
+    """
+
+    def __init__(self, in_features, out_features, indices, mask=None,
+                 **kwargs):
+        if kwargs.get('feedforward_inh', False):
+            raise ValueError('feedforward_inh is not supported by SparseLayer')
+        super(SparseLayer, self).__init__(in_features, out_features, **kwargs)
+        indices = torch.as_tensor(indices).long()
+        if mask is None:
+            mask = torch.ones(indices.shape)
+        self.register_buffer('indices', indices)
+        self.register_buffer('mask', torch.as_tensor(mask).float())
+        self.n_inputs = indices.shape[1]
+        self.weight = nn.Parameter(torch.Tensor(out_features, self.n_inputs))
+        self.reset_parameters()
+
+    @property
+    def sparse_weight(self):
+        """Effective weights of the stored connections."""
+        return self.get_sparse_weight(self.weight, self.mask)
+
+    def get_sparse_weight(self, weight, mask):
+        """Effective weights of the stored connections weight and mask.
+
+        weight and mask may also be stacked for several models.
+        """
+        if self.sign_constraint:
+            weight = torch.abs(weight)
+        weight = weight * mask
+
+        if self.prune_weak_weights:
+            not_pruned = (weight > self.prune_threshold)
+            weight = weight * not_pruned
+
+        if self.weight_norm:
+            sums = torch.sum(weight, dim=-1, keepdim=True)
+            weight = torch.div(weight, sums)
+
+        return weight
+
+    @property
+    def effective_weight(self):
+        weight = torch.zeros(self.out_features, self.in_features,
+                             dtype=self.weight.dtype,
+                             device=self.weight.device)
+        return weight.scatter_add(1, self.indices, self.sparse_weight)
+
+    def _linear(self, input):
+        weight = self.sparse_weight
+        if self.weight_dropout:
+            weight = self.w_dropout(weight)
+
+        # (batch_size, out_features, n_inputs)
+        pre_act = torch.sum(input[:, self.indices] * weight, dim=-1)
+        if self.bias is not None:
+            pre_act = pre_act + self.bias
+        return pre_act
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, n_inputs={}, bias={}'.format(
+            self.in_features, self.out_features, self.n_inputs,
+            self.bias is not None
+        )
+
+
+def benchmark_sparse_layer(n_inputs=(1, 3, 7, 15, 30, 50),
+                           n_kcs=(2500, 10000, 40000), n_pn=50,
+                           batch_size=256, n_step=50, device=None):
+    """Compare training steps of Layer and SparseLayer.
+
+    Both layers have the same random connectivity, n_inputs PNs per KC.
+
+    Returns:
+        results: dict, (n_input, N_KC) to (dense, sparse) seconds per step
+    """
+    import time
+
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    def _time(layer, x):
+        layer.to(device)
+        optimizer = torch.optim.SGD(layer.parameters(), lr=1e-3)
+        for i in range(n_step + 1):
+            if i == 1:
+                # First step is warm-up
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                start_time = time.time()
+            optimizer.zero_grad()
+            layer(x).sum().backward()
+            optimizer.step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        return (time.time() - start_time) / n_step
+
+    kwargs = {'sign_constraint': True, 'weight_initializer': 'uniform'}
+    results = dict()
+    for n_kc in n_kcs:
+        x = torch.rand(batch_size, n_pn, device=device)
+        for n_input in n_inputs:
+            mask = torch.from_numpy(get_sparse_mask(n_pn, n_kc, n_input).T)
+            indices, _ = get_active_columns(mask > 0)
+            dense_time = _time(Layer(n_pn, n_kc, **kwargs), x)
+            sparse_time = _time(
+                SparseLayer(n_pn, n_kc, indices, **kwargs), x)
+            results[(n_input, n_kc)] = (dense_time, sparse_time)
+            print('N_KC {:d}, {:d} inputs: dense {:0.2f}ms, '
+                  'sparse {:0.2f}ms per step'.format(
+                      n_kc, n_input, dense_time * 1000, sparse_time * 1000))
+    return results
+
+
 class CustomModule(nn.Module):
     def __init__(self):
         super().__init__()
 
         self._readout = False
+        self._readout_outputs = None
         # Record original weights for lesioning
         self._original_weights = {}
 
     def save(self, epoch=None):
+        """Save state dict.
+
+        States of epochs are appended to the tools.WeightHistory of the model
+        under state/ names. A state whose shapes changed, e.g. after
+        sparsify_pn2kc, is saved in its epoch folder instead.
+        """
         save_path = self.config.save_path
         if epoch is not None:
-            save_path = os.path.join(save_path, 'epoch', str(epoch).zfill(4))
+            state = {tools.STATE_PREFIX + key: val.detach().cpu().numpy()
+                     for key, val in self.state_dict().items()}
+            try:
+                tools.WeightHistory(save_path).append(state, epoch)
+                return
+            except ValueError:
+                save_path = os.path.join(save_path, 'epoch',
+                                         str(epoch).zfill(4))
         os.makedirs(save_path, exist_ok=True)
         fname = os.path.join(save_path, 'model.pt')
         torch.save(self.state_dict(), fname)
@@ -329,15 +508,40 @@ class CustomModule(nn.Module):
             save_path = os.path.join(*paths)
 
         if epoch is not None:
-            save_path = os.path.join(save_path, 'epoch', str(epoch).zfill(4))
+            epoch_path = os.path.join(save_path, 'epoch', str(epoch).zfill(4))
+            history = tools.WeightHistory(save_path)
+            if (not os.path.isfile(os.path.join(epoch_path, 'model.pt')) and
+                    history.exists()):
+                keys = [key for key in history.keys()
+                        if key.startswith(tools.STATE_PREFIX)]
+                self.load_state_dict({
+                    key[len(tools.STATE_PREFIX):]: torch.as_tensor(
+                        history.load(key, epoch)) for key in keys})
+                return
+            save_path = epoch_path
         fname = os.path.join(save_path, 'model.pt')
         if not torch.cuda.is_available():
             self.load_state_dict(torch.load(fname, map_location=torch.device('cpu')))
         else:
             self.load_state_dict(torch.load(fname))
 
-    def readout(self, is_readout=True):
+    def readout(self, is_readout=True, outputs=None):
+        """Return auxiliary outputs, e.g. layer activity, in results.
+
+        Auxiliary outputs are not returned by default, so that training
+        does not keep them alive.
+
+        Args:
+            is_readout: bool
+            outputs: None or list of str, names of the auxiliary outputs,
+                e.g. ['kc', 'glo']. All of them if None
+        """
         self._readout = is_readout
+        self._readout_outputs = outputs
+
+    def _is_readout(self, name):
+        return self._readout and (self._readout_outputs is None
+                                  or name in self._readout_outputs)
 
     def lesion_units(self, name, units, verbose=False, arg='outbound'):
         """Lesion units given by units.
@@ -365,7 +569,10 @@ class CustomModule(nn.Module):
 
         layer.weight.copy_(original_weight)
 
-        if arg == 'outbound':
+        if arg == 'outbound' and isinstance(layer, SparseLayer):
+            lesioned = np.isin(layer.indices.cpu().numpy(), units)
+            layer.weight.data[torch.from_numpy(lesioned)] = 0
+        elif arg == 'outbound':
             layer.weight.data[:, units] = 0
         elif arg == 'inbound':
             layer.weight.data[units, :] = 0
@@ -425,28 +632,29 @@ class FullModel(CustomModule):
             init.eye_(self.layer1.weight.data)
             self.layer1.weight.requires_grad=False
 
-        self.layer2 = Layer(config.N_PN, config.N_KC,
-                            weight_initializer=config.initializer_pn2kc,
-                            weight_initial_value=config.initial_pn2kc,
-                            bias_initial_value=config.kc_bias,
-                            sign_constraint=config.sign_constraint_pn2kc,
-                            pre_norm=config.kc_norm_pre,
-                            post_norm=config.kc_norm_post,
-                            dropout=config.kc_dropout,
-                            dropout_rate=config.kc_dropout_rate,
-                            prune_weak_weights=config.kc_prune_weak_weights,
-                            prune_threshold=config.kc_prune_threshold,
-                            feedforward_inh=config.kc_ffinh,
-                            feedforward_inh_coeff=config.kc_ffinh_coeff,
-                            recurrent_inh=config.kc_recinh,
-                            recurrent_inh_coeff=config.kc_recinh_coeff,
-                            recurrent_inh_step=config.kc_recinh_step,
-                            )
+        sparse_layer = getattr(config, 'sparse_pn2kc_layer', False)
+        if sparse_layer and (config.sparse_pn2kc or
+                             config.correlated_sparse_mask):
+            if config.sparse_pn2kc:
+                layer2_w = get_sparse_mask(config.N_PN, config.N_KC,
+                                           config.kc_inputs)
+            else:
+                layer2_w = get_correlated_sparse_mask(
+                    config.N_PN, config.N_KC, config.kc_inputs)
+            layer2_w = torch.from_numpy(layer2_w.T)
+            indices, _ = get_active_columns(layer2_w > 0)
+            self.layer2 = self._make_layer2(indices)
+            if not config.train_pn2kc:
+                with torch.no_grad():
+                    self.layer2.weight.copy_(layer2_w.gather(1, indices))
+                self.layer2.weight.requires_grad = False
+        else:
+            self.layer2 = self._make_layer2()
 
         if not config.train_kc_bias:
             self.layer2.bias.requires_grad = False
 
-        if not config.train_pn2kc:
+        if not config.train_pn2kc and not isinstance(self.layer2, SparseLayer):
             if config.sparse_pn2kc:
                 layer2_w = get_sparse_mask(config.N_PN, config.N_KC,
                                            config.kc_inputs)
@@ -475,6 +683,91 @@ class FullModel(CustomModule):
             self.layer3_2 = nn.Linear(config.N_KC, config.n_class_valence)
             self.loss_2 = nn.CrossEntropyLoss()
 
+    def _make_layer2(self, indices=None, mask=None):
+        """PN-KC layer, a SparseLayer if indices is not None."""
+        config = self.config
+        kwargs = dict(weight_initializer=config.initializer_pn2kc,
+                      weight_initial_value=config.initial_pn2kc,
+                      bias_initial_value=config.kc_bias,
+                      sign_constraint=config.sign_constraint_pn2kc,
+                      pre_norm=config.kc_norm_pre,
+                      post_norm=config.kc_norm_post,
+                      dropout=config.kc_dropout,
+                      dropout_rate=config.kc_dropout_rate,
+                      prune_weak_weights=config.kc_prune_weak_weights,
+                      prune_threshold=config.kc_prune_threshold,
+                      feedforward_inh=config.kc_ffinh,
+                      feedforward_inh_coeff=config.kc_ffinh_coeff,
+                      recurrent_inh=config.kc_recinh,
+                      recurrent_inh_coeff=config.kc_recinh_coeff,
+                      recurrent_inh_step=config.kc_recinh_step,
+                      )
+        if indices is None:
+            return Layer(config.N_PN, config.N_KC, **kwargs)
+        return SparseLayer(config.N_PN, config.N_KC, indices, mask=mask,
+                           **kwargs)
+
+    def sparsify_pn2kc(self, max_inputs=None):
+        """Replace layer2 by a SparseLayer with its remaining connections.
+
+        Connections with zero effective weight, e.g. pruned ones, are
+        dropped. Optimizers must be updated with the new parameters, see
+        torchtrain._sparsify_pn2kc.
+
+        Args:
+            max_inputs: None or int, only sparsify if every KC has at most
+                max_inputs connections
+
+        Returns:
+            columns: None if not sparsified, else long tensor (N_KC,
+                n_inputs), columns of the previous layer2.weight kept by
+                each KC, to carry over per-weight state
+        """
+        layer = self.layer2
+        with torch.no_grad():
+            if isinstance(layer, SparseLayer):
+                weight = layer.sparse_weight
+            else:
+                weight = layer.effective_weight
+            columns, mask = get_active_columns(weight != 0)
+        n_inputs = columns.shape[1]
+        if max_inputs is not None and n_inputs > max_inputs:
+            return None
+        if isinstance(layer, SparseLayer):
+            if n_inputs == layer.n_inputs:
+                return None
+            indices = layer.indices.gather(1, columns)
+        else:
+            indices = columns
+
+        sparse_layer = self._make_layer2(indices, mask)
+        state_dict = layer.state_dict()
+        state_dict['weight'] = layer.weight.detach().gather(1, columns)
+        state_dict['indices'] = indices
+        state_dict['mask'] = mask
+        sparse_layer.load_state_dict(state_dict)
+        sparse_layer.to(layer.weight.device)
+        sparse_layer.train(layer.training)
+        sparse_layer.weight.requires_grad = layer.weight.requires_grad
+        sparse_layer.bias.requires_grad = layer.bias.requires_grad
+        self.layer2 = sparse_layer
+        return columns
+
+    def load_state_dict(self, state_dict, strict=True):
+        if 'layer2.indices' in state_dict:
+            # Connectivity of a sparse layer2 is part of its state
+            indices = state_dict['layer2.indices']
+            layer = self.layer2
+            if (not isinstance(layer, SparseLayer) or
+                    layer.indices.shape != indices.shape):
+                sparse_layer = self._make_layer2(indices,
+                                                 state_dict['layer2.mask'])
+                sparse_layer.to(layer.weight.device)
+                sparse_layer.weight.requires_grad = layer.weight.requires_grad
+                sparse_layer.bias.requires_grad = layer.bias.requires_grad
+                self.layer2 = sparse_layer
+        return super().load_state_dict(state_dict, strict)
+
     def forward(self, x, target):
         # Process ORNs
         if self.config.receptor_layer:
@@ -485,7 +778,7 @@ class FullModel(CustomModule):
                 act0 = act0.repeat(1, self.config.N_ORN_DUPLICATION)
 
         if self.config.ORN_NOISE_STD > 0:
-            act0 += torch.randn_like(act0) * self.config.ORN_NOISE_STD
+            act0 = act0 + torch.randn_like(act0) * self.config.ORN_NOISE_STD
 
         act1 = self.layer1(act0)
         act2 = self.layer2(act1)
@@ -499,22 +792,24 @@ class FullModel(CustomModule):
             loss_2 = self.loss_2(y_2, target2)
             with torch.no_grad():
                 _, pred = torch.max(y, 1)
-                acc = (pred == target1).sum().item() / target1.size(0)
+                acc = (pred == target1).float().mean()
 
                 _, pred_2 = torch.max(y_2, 1)
-                acc2 = (pred_2 == target2).sum().item() / target2.size(0)
+                acc2 = (pred_2 == target2).float().mean()
             results = {'loss': loss + loss_2, 'acc': (acc + acc2) / 2,
                        'loss_1': loss, 'acc1': acc,
-                       'loss_2': loss_2, 'acc2': acc2, 'kc': act2}
+                       'loss_2': loss_2, 'acc2': acc2}
         else:
             # Regular network
             loss = self.loss(y, target)
             with torch.no_grad():
                 _, pred = torch.max(y, 1)
-                acc = (pred == target).sum().item() / target.size(0)
-            results = {'loss': loss, 'acc': acc, 'kc': act2}
+                acc = (pred == target).float().mean()
+            results = {'loss': loss, 'acc': acc}
 
-        if self._readout:
+        if self._is_readout('kc'):
+            results['kc'] = act2
+        if self._is_readout('glo'):
             results['glo'] = act1
 
         return results
@@ -593,10 +888,10 @@ class SingleLayerModel(CustomModule):
         loss = self.loss(y, target)
         with torch.no_grad():
             _, pred = torch.max(y, 1)
-            acc = (pred == target).sum().item() / target.size(0)
+            acc = (pred == target).float().mean()
         results = {'loss': loss, 'acc': acc}
 
-        if self._readout:
+        if self._is_readout('y'):
             results['y'] = y
 
         return results
@@ -670,7 +965,7 @@ class RNNModel(CustomModule):
         act1[:, :act0.shape[1]] = act0
 
         results = dict()
-        if self._readout:
+        if self._is_readout('rnn_outputs'):
             results['rnn_outputs'] = [act1.cpu().numpy()]
 
         act_sum = 0.
@@ -688,7 +983,7 @@ class RNNModel(CustomModule):
                 # act1 = act1 * (1 - torch.heaviside(act_sum, torch.tensor(0.)))
                 act1 = act1 * (act_sum < 0.001)
 
-            if self._readout:
+            if self._is_readout('rnn_outputs'):
                 results['rnn_outputs'].append(act1.cpu().numpy())
 
         # TODO: temp
@@ -700,7 +995,7 @@ class RNNModel(CustomModule):
         loss = self.loss(y, target)
         with torch.no_grad():
             _, pred = torch.max(y, 1)
-            acc = (pred == target).sum().item() / target.size(0)
+            acc = (pred == target).float().mean()
         results.update({'loss': loss, 'acc': acc})
 
         return results
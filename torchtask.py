@@ -0,0 +1,337 @@
+"""Data sources for torch training."""
+
+import os
+
+import numpy as np
+import torch
+
+import task
+
+
+def iterate_batches(data, target, batch_size):
+    """Iterate over a resident dataset in a random order for one epoch."""
+    n_sample = data.shape[0]
+    random_idx = np.random.permutation(n_sample)
+    idx = 0
+    while idx < n_sample:
+        batch_indices = random_idx[idx:idx+batch_size]
+        idx += batch_size
+        yield data[batch_indices], target[batch_indices]
+
+
+def iterate_shared(data, target, batch_size):
+    """Iterate over a memory-mapped dataset in a random order for one epoch.
+
+    Batches are gathered from data without loading it, so processes
+    training on the same memory-mapped dataset share it through the page
+    cache. Samples are sorted within each batch, for faster reads.
+
+    Args:
+        data: array-like (n_sample, ...), e.g. a memory-map
+        target: array-like (n_sample, ...)
+        batch_size: int
+
+    Yields:
+        np arrays of data and target of each batch
+    """
+    n_sample = data.shape[0]
+    random_idx = np.random.permutation(n_sample)
+    for idx in range(0, n_sample, batch_size):
+        batch_indices = np.sort(random_idx[idx:idx+batch_size])
+        yield (np.asarray(data[batch_indices]),
+               np.asarray(target[batch_indices]))
+
+
+class EpochIterator(object):
+    """Iterate over a resident dataset in a random order, without copies.
+
+    Once per epoch, data and target are permuted on their device into
+    preallocated buffers, and batches are contiguous views of the buffers.
+    Compared to iterate_batches, no batch tensor is allocated per step.
+    Views are only valid until the next epoch starts.
+
+    Args:
+        data: tensor (n_sample, ...)
+        target: tensor (n_sample, ...)
+        batch_size: int
+    """
+
+    def __init__(self, data, target, batch_size):
+        self.data = data
+        self.target = target
+        self.batch_size = batch_size
+        self.n_sample = data.shape[0]
+        self._data_buffer = torch.empty_like(data)
+        self._target_buffer = torch.empty_like(target)
+
+    def _permute(self):
+        perm = torch.randperm(self.n_sample, device=self.data.device)
+        torch.index_select(self.data, 0, perm, out=self._data_buffer)
+        torch.index_select(self.target, 0, perm, out=self._target_buffer)
+
+    def __iter__(self):
+        """Yield data and target views of each batch, for one epoch."""
+        self._permute()
+        for idx in range(0, self.n_sample, self.batch_size):
+            yield (self._data_buffer[idx:idx+self.batch_size],
+                   self._target_buffer[idx:idx+self.batch_size])
+
+    def chunks(self, n_step):
+        """Yield views of n_step batches at once, for one epoch.
+
+        Chunks have shape (n_step, batch_size, ...). Remaining full batches
+        form a last chunk with fewer steps, followed by a chunk of one
+        partial batch if n_sample is not a multiple of batch_size.
+        """
+        self._permute()
+        batch_size = self.batch_size
+        n_batch = self.n_sample // batch_size
+        for start in range(0, n_batch, n_step):
+            stop = min(start + n_step, n_batch)
+            rows = slice(start * batch_size, stop * batch_size)
+            shape = (stop - start, batch_size)
+            yield (self._data_buffer[rows].view(
+                       shape + self.data.shape[1:]),
+                   self._target_buffer[rows].view(
+                       shape + self.target.shape[1:]))
+        if n_batch * batch_size < self.n_sample:
+            rows = slice(n_batch * batch_size, self.n_sample)
+            yield (self._data_buffer[rows].unsqueeze(0),
+                   self._target_buffer[rows].unsqueeze(0))
+
+
+def benchmark_epoch_iterators(data, target, batch_size, step=None,
+                              n_epoch=3, n_step=8):
+    """Compare samples/sec of iterate_batches and EpochIterator.
+
+    Args:
+        data, target: tensors of a resident dataset
+        batch_size: int
+        step: None or function step(x, target) run on every batch, e.g. a
+            training step. If None, only the iteration is timed
+        n_epoch: int, number of epochs timed for each iterator
+        n_step: int, number of batches per chunk for EpochIterator.chunks
+
+    Returns:
+        results: dict, iterator name to samples/sec
+    """
+    import time
+
+    if step is None:
+        def step(x, target):
+            pass
+
+    def _iterate_chunks():
+        for x_chunk, target_chunk in iterator.chunks(n_step):
+            for x, target in zip(x_chunk, target_chunk):
+                yield x, target
+
+    iterator = EpochIterator(data, target, batch_size)
+    epoch_iterators = {
+        'iterate_batches': lambda: iterate_batches(data, target, batch_size),
+        'EpochIterator': lambda: iter(iterator),
+        'EpochIterator.chunks': _iterate_chunks,
+    }
+    results = dict()
+    for name, epoch_iterator in epoch_iterators.items():
+        if data.is_cuda:
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(n_epoch):
+            for x, t in epoch_iterator():
+                step(x, t)
+        if data.is_cuda:
+            torch.cuda.synchronize()
+        results[name] = n_epoch * data.shape[0] / (time.time() - start_time)
+        print('{:s}: {:d} samples/sec'.format(name, int(results[name])))
+    return results
+
+
+def iterate_chunks(data, target, batch_size, chunk_size=None, rng=None):
+    """Iterate over an on-disk dataset in a random order for one epoch.
+
+    Data is read one contiguous chunk of rows at a time, chunks are visited
+    in a random order, and samples are shuffled within each chunk. Only one
+    chunk is in memory at a time, so data can be larger than RAM.
+
+    Args:
+        data: array-like (n_sample, ...), e.g. a memory-map or a h5py dataset
+        target: array-like (n_sample, ...)
+        batch_size: int
+        chunk_size: int, number of rows read at once. Defaults to
+            64 batches, rounded up to whole HDF5 chunks if data is chunked
+        rng: None or RandomState
+
+    Yields:
+        np arrays of data and target of each batch
+    """
+    if rng is None:
+        rng = np.random
+    n_sample = data.shape[0]
+    if chunk_size is None:
+        chunk_size = 64 * batch_size
+        storage_chunks = getattr(data, 'chunks', None)
+        if storage_chunks:
+            chunk_size = (int(np.ceil(chunk_size / storage_chunks[0]))
+                          * storage_chunks[0])
+    starts = np.arange(0, n_sample, chunk_size)
+    for start in rng.permutation(starts):
+        data_chunk = np.asarray(data[start:start+chunk_size])
+        target_chunk = np.asarray(target[start:start+chunk_size])
+        random_idx = rng.permutation(data_chunk.shape[0])
+        for idx in range(0, len(random_idx), batch_size):
+            batch_indices = random_idx[idx:idx+batch_size]
+            yield data_chunk[batch_indices], target_chunk[batch_indices]
+
+
+class OdorStream(object):
+    """Odors sampled on the fly and labeled by their nearest prototype.
+
+    Only the prototypes and the label map are kept. Every training batch is
+    a fresh sample of odors drawn on the training device, and labeled by
+    its nearest prototype. The validation set is sampled once and cached,
+    so validation accuracy stays comparable across epochs.
+
+    Mirrors task._generate_proto_threshold for label_type 'sparse', with
+    percent_generalization, relabel, orn_corr, orn_sampler,
+    vary_concentration, n_or_per_orn, and the ORN transforms of
+    task.get_orn_transforms applied to every batch.
+
+    Args:
+        config: input_ProtoConfig, or any config with the same dataset entries
+        seed: int, random seed
+        device: str, device where odors are sampled
+    """
+
+    def __init__(self, config, seed=0, device='cpu'):
+        unsupported = {
+            'label_type': config.label_type != 'sparse',
+            'distort_input': config.distort_input,
+            'shuffle_label': config.shuffle_label,
+        }
+        for key, val in unsupported.items():
+            if val:
+                raise NotImplementedError(
+                    'OdorStream does not support ' + key)
+
+        self.config = config
+        self.device = device
+        self.n_orn = config.N_ORN
+        self.rng = np.random.RandomState(seed)
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+
+        sampler_name = getattr(config, 'orn_sampler', None)
+        if sampler_name is None:
+            sampler_name = 'uniform' if config.orn_corr is None else 'mvn'
+        self.sampler = task.get_input_sampler(
+            sampler_name, self.n_orn, self.rng, corr=config.orn_corr,
+            **task._get_sampler_kwargs(config))
+        if sampler_name in ('mvn', 'equicorr'):
+            # Correlation of the gaussian copula, sampled on device
+            self.rho = task._copula_corr(config.orn_corr)
+        else:
+            self.rho = None
+        # Structured samplers run in numpy and are moved to the device
+        self.sample_on_device = sampler_name in ('uniform', 'mvn', 'equicorr')
+
+        n_proto = config.n_trueclass if config.relabel else config.N_CLASS
+        self.has_default = config.percent_generalization < 100
+        if self.has_default:
+            n_proto -= 1
+        prototypes = self.sampler(n_proto, self.rng)
+        self.transform = task.get_orn_transforms(config, self.rng)
+        prototypes = self.transform(prototypes, self.rng)
+        if config.n_or_per_orn > 1:
+            self.mix_or = task.MixOR(self.n_orn, config.n_or_per_orn)
+        else:
+            self.mix_or = None
+        if config.vary_concentration:
+            prototypes = task._normalize(prototypes)
+        self.prototypes = torch.from_numpy(prototypes).float().to(device)
+        self.prototypes_sq = (self.prototypes ** 2).sum(dim=1)
+
+        n_label = n_proto + int(self.has_default)
+        if config.relabel:
+            labelmap = np.tile(np.arange(config.N_CLASS),
+                               int(np.ceil(n_label / config.N_CLASS)))
+            labelmap = labelmap[:n_label]
+        else:
+            labelmap = np.arange(n_label)
+        self.labelmap = torch.from_numpy(labelmap).long().to(device)
+
+        self.threshold = None
+        if self.has_default:
+            # Fix the default-class threshold from a calibration sample
+            x = self._sample_odors(config.n_val)
+            highest_match = self._nearest(x)[1]
+            self.threshold = torch.quantile(
+                highest_match, config.percent_generalization / 100.) + 1e-6
+
+        self.val_data, self.val_target = self.sample(config.n_val)
+
+    def _sample_odors(self, n):
+        """Sample n odors, (n, n_orn) tensor."""
+        shape = (n, self.n_orn)
+        if not self.sample_on_device:
+            x = torch.from_numpy(self.sampler(n, self.rng)).float()
+            x = x.to(self.device)
+        elif self.rho is None:
+            x = torch.rand(shape, generator=self.generator,
+                           device=self.device)
+        else:
+            # Equicorrelated gaussian from a shared latent factor
+            z = torch.randn(shape, generator=self.generator,
+                            device=self.device)
+            z0 = torch.randn((n, 1), generator=self.generator,
+                             device=self.device)
+            z = np.sqrt(1 - self.rho) * z + np.sqrt(self.rho) * z0
+            x = 0.5 * (1 + torch.erf(z / np.sqrt(2)))
+        return self.transform(x, self.rng)
+
+    def _nearest(self, x):
+        """Index of and distance to the nearest prototype."""
+        if self.config.vary_concentration:
+            # Odors without activity stay at zero, as in task._normalize
+            norm = torch.norm(x, dim=1, keepdim=True)
+            x = x / torch.clamp(norm, min=1e-12)
+        sq = (self.prototypes_sq.unsqueeze(0)
+              + (x ** 2).sum(dim=1, keepdim=True)
+              - 2 * torch.mm(x, self.prototypes.t()))
+        dist, ind = torch.min(sq, dim=1)
+        return ind, torch.sqrt(torch.clamp(dist, min=0))
+
+    def sample(self, n):
+        """Sample n odors and their labels."""
+        x = self._sample_odors(n)
+        ind, dist = self._nearest(x)
+        if self.has_default:
+            ind = torch.where(self.threshold <= dist, torch.zeros_like(ind),
+                              ind + 1)
+        if self.mix_or is not None:
+            x = self.mix_or(x)
+        return x, self.labelmap[ind]
+
+    def iterate_batches(self, n_sample, batch_size):
+        """Iterate over n_sample fresh odors for one epoch."""
+        idx = 0
+        while idx < n_sample:
+            n = min(batch_size, n_sample - idx)
+            idx += batch_size
+            yield self.sample(n)
+
+    def state_dict(self):
+        """Random state, to resume sampling from a checkpoint."""
+        return {'rng': self.rng.get_state(),
+                'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state_dict):
+        self.rng.set_state(state_dict['rng'])
+        self.generator.set_state(state_dict['generator'])
+
+    def save(self, save_path):
+        """Save prototypes and label map."""
+        np.save(os.path.join(save_path, 'prototype'),
+                self.prototypes.cpu().numpy())
+        np.save(os.path.join(save_path, 'labelmap'),
+                self.labelmap.cpu().numpy().astype(np.int32))
@@ -3,6 +3,8 @@ import sys
 from collections import defaultdict
 import pickle
 import json
+import hashlib
+import random
 import time
 
 import numpy as np
@@ -10,20 +12,24 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 
 import task
+import torchtask
 from torchmodel import get_model
-from configs import FullConfig, SingleLayerConfig
+from configs import FullConfig, SingleLayerConfig, input_ProtoConfig
 import tools
 from standard.analysis_pn2kc_training import _compute_sparsity
+from standard.analysis_weight import ThresholdEstimator
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+# Warm-starts the inferred KC threshold from the previous epoch, reset for
+# each trained model
+_threshold_estimator = ThresholdEstimator()
 
-def _log_full_model_train_pn2kc(log, model, config, res=None):
-    w_glo = model.w_glo
-    w_glo[w_glo < 1e-9] = 1e-9  # finite range for log
-    if res is not None:
-        kcs = res['kc'].cpu().numpy()  # (n_odor, n_neuron)
 
+def _log_full_model_train_pn2kc(log, w_glo, config, kcs=None,
+                                estimator=None):
+    w_glo[w_glo < 1e-9] = 1e-9  # finite range for log
+    if kcs is not None:
         coding_level = (kcs > 0).mean()
         coding_level_per_kc = kcs.mean(axis=0)
         coding_level_per_odor = kcs.mean(axis=1)
@@ -52,7 +58,8 @@ def _log_full_model_train_pn2kc(log, model, config, res=None):
             w_glo, dynamic_thres=False, thres=config.kc_prune_threshold)
     else:
         sparsity_inferred, thres_inferred = _compute_sparsity(
-            w_glo, dynamic_thres=True)
+            w_glo, dynamic_thres=True,
+            estimator=estimator or _threshold_estimator)
     K_inferred = sparsity_inferred[sparsity_inferred > 0].mean()
     bad_KC_inferred = np.sum(
         sparsity_inferred == 0) / sparsity_inferred.size
@@ -79,13 +86,35 @@ def _log_full_model_train_pn2kc(log, model, config, res=None):
     return log
 
 
-def logging(log, model, config, res=None):
+def _snapshot(model, config, res=None):
+    """Copy the weights and activity needed by logging to numpy.
+
+    Weights are copied, on cpu model.w_glo shares memory with the model.
+    """
+    snapshot = dict()
+    if config.model == 'full':
+        snapshot['w_orn'] = np.array(model.w_orn)
+        if config.receptor_layer:
+            snapshot['w_or'] = np.array(model.w_or)
+        if config.train_pn2kc:
+            snapshot['w_glo'] = np.array(model.w_glo)
+            if res is not None:
+                snapshot['kc'] = res['kc'].cpu().numpy()  # (n_odor, n_neuron)
+    return snapshot
+
+
+def _log_metrics(log, snapshot, config, estimator=None):
+    """Append metrics computed from a snapshot to log.
+
+    estimator is the ThresholdEstimator of the model, default is the one of
+    the model trained by this module.
+    """
     if config.model == 'full':
         if config.receptor_layer:
             # Compute effective w_orn
-            w_orn = np.dot(model.w_or, model.w_orn)
+            w_orn = np.dot(snapshot['w_or'], snapshot['w_orn'])
         else:
-            w_orn = model.w_orn
+            w_orn = snapshot['w_orn']
         glo_score, _ = tools.compute_glo_score(w_orn, config.N_ORN)
         log['glo_score'].append(glo_score)
         print('Glo score ' + str(glo_score))
@@ -95,17 +124,421 @@ def logging(log, model, config, res=None):
         print('Sim score ' + str(sim_score))
 
         if config.train_pn2kc:
-            log = _log_full_model_train_pn2kc(log, model, config, res)
+            log = _log_full_model_train_pn2kc(
+                log, snapshot['w_glo'], config, snapshot.get('kc'),
+                estimator=estimator)
+    return log
+
 
+def logging(log, model, config, res=None, estimator=None):
+    log = _log_metrics(log, _snapshot(model, config, res), config,
+                       estimator=estimator)
     tools.save_log(config.save_path, log)
     return log
 
 
-def train(config, reload=False, save_everytrainloss=False):
-    # Merge model config with config from dataset
-    dataset_config = tools.load_config(config.data_dir)
+def _logging_worker(config, snapshots, results, metrics=None,
+                    estimator_params=None):
+    """Compute, merge and save metrics of snapshots until None is received.
+
+    On 'flush', the metrics computed so far and the threshold estimator
+    parameters are sent back. All metrics, including those of previous
+    epochs, are sent back at the end.
+    """
+    if metrics is None:
+        metrics = defaultdict(list)
+    _threshold_estimator.params = estimator_params
+    while True:
+        item = snapshots.get()
+        if item is None:
+            break
+        if isinstance(item, str) and item == 'flush':
+            results.put((dict(metrics), _threshold_estimator.params))
+            continue
+        train_log, snapshot = item
+        # Same key order as logging on the training log itself
+        log = defaultdict(list, train_log)
+        log.update(metrics)
+        log = _log_metrics(log, snapshot, config)
+        metrics = {k: v for k, v in log.items() if k not in train_log}
+        tools.save_log(config.save_path, log)
+    results.put(dict(metrics))
+
+
+class AsyncLogger(object):
+    """Compute and save logged metrics in a worker process.
+
+    The weights and activity needed by logging are copied to numpy, then
+    metrics are computed and the log is saved by the worker while training
+    continues. At most max_pending snapshots wait for the worker, further
+    calls block until it catches up. Once the metrics returned by close are
+    merged into the training log, the log is the same as with logging.
+
+    Args:
+        config: config of the trained model
+        max_pending: int, maximum number of snapshots in the queue
+        metrics: None or dict, metrics of previous epochs, see flush
+        estimator_params: None or parameters of the threshold estimator
+    """
+
+    def __init__(self, config, max_pending=2, metrics=None,
+                 estimator_params=None):
+        import multiprocessing
+        self._snapshots = multiprocessing.Queue(maxsize=max_pending)
+        self._results = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_logging_worker,
+            args=(config, self._snapshots, self._results, metrics,
+                  estimator_params), daemon=True)
+        self._process.start()
+
+    def _check_alive(self):
+        if not self._process.is_alive():
+            raise RuntimeError('Logging worker exited with code {}'.format(
+                self._process.exitcode))
+
+    def log(self, log, model, config, res=None):
+        """Queue the metrics of this epoch, see logging."""
+        import queue
+        # Copy lists, the queue pickles items later in a background thread
+        train_log = {k: list(v) if isinstance(v, list) else v
+                     for k, v in log.items()}
+        item = (train_log, _snapshot(model, config, res))
+        while True:
+            try:
+                self._snapshots.put(item, timeout=1)
+                return
+            except queue.Full:
+                self._check_alive()
+
+    def _get_result(self):
+        import queue
+        while True:
+            try:
+                return self._results.get(timeout=1)
+            except queue.Empty:
+                self._check_alive()
+
+    def flush(self):
+        """Wait for all queued metrics, e.g. to checkpoint them.
+
+        Returns:
+            metrics: dict, metrics computed by the worker so far
+            estimator_params: parameters of the threshold estimator
+        """
+        self._snapshots.put('flush')
+        return self._get_result()
+
+    def close(self):
+        """Wait for all queued metrics, and return them.
+
+        Returns:
+            metrics: dict, all metrics computed by the worker, to be merged
+                into the training log
+        """
+        self._snapshots.put(None)
+        metrics = self._get_result()
+        self._process.join()
+        return metrics
+
+
+class EarlyStopping(object):
+    """Stopping rules and validation cadence of training.
+
+    Rules are checked at every validation, and disabled if None:
+        target_acc: stop once validation accuracy reaches it
+        early_stop_patience: stop when validation loss has not improved by
+            early_stop_min_delta for this many epochs
+        early_stop_weight_tol: stop when the relative change of PN-KC
+            weights per epoch since the last validation is below it
+
+    Validation runs every epoch at first. The interval doubles, up to
+    eval_max_interval, when validation loss changes by less than
+    eval_stable_tol (relative) between validations, and returns to 1
+    otherwise.
+
+    Args:
+        config: config with the entries above, missing ones are disabled
+    """
+
+    def __init__(self, config):
+        self.target_acc = getattr(config, 'target_acc', None)
+        self.patience = getattr(config, 'early_stop_patience', None)
+        self.min_delta = getattr(config, 'early_stop_min_delta', 0.)
+        self.weight_tol = getattr(config, 'early_stop_weight_tol', None)
+        self.max_interval = getattr(config, 'eval_max_interval', 1)
+        self.stable_tol = getattr(config, 'eval_stable_tol', 0.)
+
+        self.best_loss = np.inf
+        self.best_epoch = 0
+        self.last_loss = None
+        self.last_epoch = None
+        self.last_weight = None
+        self.interval = 1
+        self.next_epoch = 0
+        self.stop_reason = None
+
+    def should_validate(self, epoch):
+        return epoch >= self.next_epoch
+
+    def update(self, epoch, loss, acc, weight=None):
+        """Update with the validation of epoch, return stop reason or None.
+
+        Args:
+            epoch: int
+            loss, acc: float, validation loss and accuracy
+            weight: None or tensor, PN-KC weights
+        """
+        if self.target_acc is not None and acc >= self.target_acc:
+            self.stop_reason = 'target_acc'
+
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss, self.best_epoch = loss, epoch
+        elif (self.patience is not None and
+              epoch - self.best_epoch >= self.patience):
+            self.stop_reason = self.stop_reason or 'patience'
+
+        if self.weight_tol is not None and weight is not None:
+            weight = weight.detach().clone()
+            if self.last_weight is not None and epoch > self.last_epoch:
+                change = (torch.norm(weight - self.last_weight) /
+                          torch.norm(self.last_weight).clamp(min=1e-12))
+                change = change.item() / (epoch - self.last_epoch)
+                if change < self.weight_tol:
+                    self.stop_reason = self.stop_reason or 'weight_tol'
+            self.last_weight = weight
+
+        if (self.last_loss is not None and abs(loss - self.last_loss) <=
+                self.stable_tol * abs(self.last_loss)):
+            self.interval = min(2 * self.interval, self.max_interval)
+        else:
+            self.interval = 1
+        self.last_loss, self.last_epoch = loss, epoch
+        self.next_epoch = epoch + self.interval
+
+        if self.stop_reason is not None:
+            print('Training stopped at epoch {:d}: {:s}'.format(
+                epoch, self.stop_reason))
+        return self.stop_reason
+
+    def state_dict(self):
+        return dict(self.__dict__)
+
+    def load_state_dict(self, state_dict):
+        self.__dict__.update(state_dict)
+
+
+def _get_rng_state():
+    state = {'torch': torch.get_rng_state(),
+             'numpy': np.random.get_state(),
+             'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# Config entries that can change when resuming from a checkpoint
+RESUME_KEYS = ('max_epoch', 'checkpoint_every', 'async_logging', 'save_path')
+
+
+def config_hash(config):
+    """Hash of the config entries a checkpoint depends on.
+
+    Entries in RESUME_KEYS are ignored, e.g. a run can be extended by
+    resuming with a larger max_epoch.
+    """
+    config_dict = {key: val for key, val in config.__dict__.items()
+                   if key not in RESUME_KEYS}
+    config_str = json.dumps(config_dict, sort_keys=True, default=str)
+    return hashlib.sha1(config_str.encode()).hexdigest()
+
+
+def save_checkpoint(save_path, checkpoint, name='checkpoint.pt'):
+    """Save a training checkpoint atomically.
+
+    The checkpoint is written to a temporary file that then replaces
+    name, checkpoint.pt by default, so a run killed while saving keeps its
+    previous checkpoint.
+    """
+    fname = os.path.join(save_path, name)
+    torch.save(checkpoint, fname + '.tmp')
+    os.replace(fname + '.tmp', fname)
+
+
+def load_checkpoint(save_path, name='checkpoint.pt'):
+    """Load the training checkpoint of save_path, None if there is none."""
+    fname = os.path.join(save_path, name)
+    if not os.path.isfile(fname):
+        return None
+    try:
+        return torch.load(fname, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only argument
+        return torch.load(fname, map_location='cpu')
+
+
+def _load_label_key(data_dir):
+    """Load the label key of a dataset on device, see task.encode_labels."""
+    label_key = task.load_label_key(data_dir)
+    if label_key is not None:
+        label_key = torch.from_numpy(label_key).long().to(device)
+    return label_key
+
+
+def _sparsify_pn2kc(model, optimizer, config):
+    """Convert pruned PN-KC connections to a SparseLayer during training.
+
+    The optimizer is updated in place with the new layer2 parameters, and
+    the state of the kept weights, e.g. Adam moments, is carried over.
+    """
+    old_params = dict(model.layer2.named_parameters())
+    columns = model.sparsify_pn2kc(
+        max_inputs=getattr(config, 'sparse_pn2kc_max_inputs', None))
+    if columns is None:
+        return
+    print('PN-KC connections sparsified, {:d} inputs per KC'.format(
+        columns.shape[1]))
+
+    new_params = dict(model.layer2.named_parameters())
+    replace = {old_params[name]: new_params[name] for name in old_params}
+    for group in optimizer.param_groups:
+        group['params'] = [replace.get(p, p) for p in group['params']]
+    for old_param, new_param in replace.items():
+        if old_param not in optimizer.state:
+            continue
+        state = optimizer.state.pop(old_param)
+        for key, val in state.items():
+            if (old_param is old_params['weight'] and
+                    torch.is_tensor(val) and val.shape == old_param.shape):
+                state[key] = val.gather(1, columns)
+        optimizer.state[new_param] = state
+
+
+def _merge_dataset_config(config):
+    """Merge model config with config from dataset."""
+    if getattr(config, 'stream_data', False):
+        # Dataset entries are set on config directly
+        dataset_config = input_ProtoConfig()
+    else:
+        dataset_config = tools.load_config(config.data_dir)
     dataset_config.update(config)
-    config = dataset_config
+    return dataset_config
+
+
+def _get_data(config, save_paths=None):
+    """Load the dataset of config on device.
+
+    Args:
+        config: config merged with the dataset config
+        save_paths: None or list of str, where a streamed dataset is saved.
+            Default is [config.save_path]
+
+    Returns:
+        train_batches: function returning an iterator over the (x, target)
+            batches of one epoch
+        val_data, val_target: tensors
+        n_train: int, number of training samples per epoch
+        stream: None or the OdorStream of streamed datasets
+    """
+    batch_size = config.batch_size
+    stream = None
+    if config.stream_data:
+        stream = torchtask.OdorStream(config, seed=config.stream_seed,
+                                      device=device)
+        if save_paths is None:
+            save_paths = [config.save_path]
+        for save_path in save_paths:
+            stream.save(save_path)
+        val_data, val_target = stream.val_data, stream.val_target
+        n_train = config.n_train
+
+        def train_batches():
+            return stream.iterate_batches(n_train, batch_size)
+    elif getattr(config, 'shared_data', False) and device == 'cpu':
+        train_x, train_y = task.load_data(config.data_dir, splits=('train',),
+                                          mmap_mode='r', encode=False)
+        val_x, val_y = task.load_data(config.data_dir, splits=('val',),
+                                      encode=False)
+        n_train = train_x.shape[0]
+        label_key = _load_label_key(config.data_dir)
+
+        val_data = torch.from_numpy(val_x).float().to(device)
+        val_target = torch.from_numpy(val_y).long().to(device)
+        val_target = task.encode_labels(val_target, label_key)
+
+        def train_batches():
+            for x, y in torchtask.iterate_shared(train_x, train_y, batch_size):
+                target = torch.from_numpy(y).long()
+                yield (torch.from_numpy(x).float(),
+                       task.encode_labels(target, label_key))
+    elif getattr(config, 'train_from_disk', False):
+        train_x, train_y = task.load_data(config.data_dir, splits=('train',),
+                                          mmap_mode='r', encode=False)
+        val_x, val_y = task.load_data(config.data_dir, splits=('val',),
+                                      encode=False)
+        n_train = train_x.shape[0]
+        label_key = _load_label_key(config.data_dir)
+
+        val_data = torch.from_numpy(val_x).float().to(device)
+        val_target = torch.from_numpy(val_y).long().to(device)
+        val_target = task.encode_labels(val_target, label_key)
+
+        def train_batches():
+            for x, y in torchtask.iterate_chunks(train_x, train_y, batch_size):
+                target = torch.from_numpy(y).long().to(device)
+                yield (torch.from_numpy(x).float().to(device),
+                       task.encode_labels(target, label_key))
+    else:
+        # Load dataset, targets are materialized for each batch
+        train_x, train_y, val_x, val_y = task.load_data(config.data_dir,
+                                                        encode=False)
+        n_train = train_x.shape[0]
+        label_key = _load_label_key(config.data_dir)
+
+        train_data = torch.from_numpy(train_x).float().to(device)
+        train_target = torch.from_numpy(train_y).long().to(device)
+
+        # Build validation dataset
+        val_data = torch.from_numpy(val_x).float().to(device)
+        val_target = torch.from_numpy(val_y).long().to(device)
+        val_target = task.encode_labels(val_target, label_key)
+
+        epoch_iterator = torchtask.EpochIterator(train_data, train_target,
+                                                 batch_size)
+
+        def train_batches():
+            for x, target in epoch_iterator:
+                yield x, task.encode_labels(target, label_key)
+
+    return train_batches, val_data, val_target, n_train, stream
+
+
+def train(config, reload=True, save_everytrainloss=False):
+    """Train a model.
+
+    Every config.checkpoint_every epochs, and at the end of training, the
+    state of training is saved in checkpoint.pt, see save_checkpoint.
+
+    At each validation, the log records train_loss and train_acc as means
+    over the batches of the previous epoch. Logs of older runs hold the
+    values of its last batch instead.
+
+    Args:
+        config: model config
+        reload: bool, if True and config.save_path holds a checkpoint of
+            the same config, see config_hash, training resumes from it. On
+            cpu, the resumed log is identical to the log of an
+            uninterrupted run, except for timings
+    """
+    config = _merge_dataset_config(config)
     for item in config.__dict__.items():
         print(item)
 
@@ -114,14 +547,20 @@ def train(config, reload=False, save_everytrainloss=False):
     # Save config
     tools.save_config(config, save_path=config.save_path)
 
-    # Load dataset
-    train_x, train_y, val_x, val_y = task.load_data(config.data_dir)
-
-    batch_size = config.batch_size
-
     model = get_model(config)
     model.to(device)
 
+    checkpoint = load_checkpoint(config.save_path) if reload else None
+    if (checkpoint is not None and
+            checkpoint.get('config_hash') != config_hash(config)):
+        print('Warning: ignoring checkpoint of a different config, '
+              'training from scratch')
+        checkpoint = None
+    if checkpoint is not None:
+        print('Resuming from epoch {:d}'.format(checkpoint['epoch']))
+        # Before building the optimizer, layer2 may have been sparsified
+        model.load_state_dict(checkpoint['model'])
+
     # TEMPORARY
     if 'pn2kc_lr' in dir(config):
         my_list = ['layer2.weight', 'layer2.bias']
@@ -137,12 +576,7 @@ def train(config, reload=False, save_everytrainloss=False):
     else:
         optimizer = torch.optim.Adam(model.parameters(), lr=config.lr)
 
-    train_data = torch.from_numpy(train_x).float().to(device)
-    train_target = torch.from_numpy(train_y).long().to(device)
-
-    # Build validation dataset
-    val_data = torch.from_numpy(val_x).float().to(device)
-    val_target = torch.from_numpy(val_y).long().to(device)
+    train_batches, val_data, val_target, n_train, stream = _get_data(config)
 
     # Make custom logger
     log = defaultdict(list)
@@ -152,59 +586,145 @@ def train(config, reload=False, save_everytrainloss=False):
     start_epoch = 0
 
     loss_train = 0
-    res = {'acc': np.nan}
+    acc_train = np.nan
     total_time, start_time = 0, time.time()
 
+    global _threshold_estimator
+    _threshold_estimator = ThresholdEstimator()
+
     log['log_bins'] = np.linspace(-20, 5, 201)
     log['activity_bins'] = np.linspace(0, 1, 201)
 
+    stopper = EarlyStopping(config)
+    use_async_logging = getattr(config, 'async_logging', False)
+    metrics = None
+    if checkpoint is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if stream is not None:
+            stream.load_state_dict(checkpoint['stream'])
+        start_epoch = checkpoint['epoch']
+        loss_train = checkpoint['loss_train']
+        acc_train = checkpoint['acc_train']
+        log = defaultdict(list, checkpoint['log'])
+        metrics = checkpoint['metrics']
+        if not use_async_logging:
+            log.update(metrics)
+        _threshold_estimator.params = checkpoint['estimator_params']
+        stopper.load_state_dict(checkpoint['stopper'])
+        _set_rng_state(checkpoint['rng'])
+
+    if use_async_logging:
+        logger = AsyncLogger(config, metrics=metrics,
+                             estimator_params=_threshold_estimator.params)
+    else:
+        logger = None
+
+    def _checkpoint(epoch):
+        if logger is None:
+            metrics, estimator_params = dict(), _threshold_estimator.params
+        else:
+            metrics, estimator_params = logger.flush()
+        save_checkpoint(config.save_path, {
+            'config_hash': config_hash(config),
+            'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'stream': None if stream is None else stream.state_dict(),
+            'loss_train': loss_train,
+            'acc_train': acc_train,
+            'log': dict(log),
+            'metrics': metrics,
+            'estimator_params': estimator_params,
+            'stopper': stopper.state_dict(),
+            'rng': _get_rng_state(),
+        })
+
+    checkpoint_every = getattr(config, 'checkpoint_every', 0)
+    # Epoch to resume from if training ends before max_epoch
+    next_epoch = start_epoch
     for ep in range(start_epoch, config.max_epoch):
+        if stopper.stop_reason is not None:
+            # Resumed from the checkpoint of a stopped run
+            break
+
+        if checkpoint_every > 0 and ep > start_epoch and (
+                ep % checkpoint_every == 0):
+            _checkpoint(ep)
+
         if config.save_every_epoch:
             model.save_pickle(ep)
             model.save(ep)
 
-        # validation
-        with torch.no_grad():
-            model.eval()
-            res_val = model(val_data, val_target)
-        loss_val = res_val['loss'].item()
-
-        print('[*' + '*'*50 + '*]')
-        print('Epoch {:d}'.format(ep))
-        print('Train/Validation loss {:0.2f}/{:0.2f}'.format(
-            loss_train, loss_val))
-        print('Train/Validation accuracy {:0.2f}/{:0.2f}'.format(
-            res['acc'], res_val['acc']))
-        log['epoch'].append(ep)
-        log['train_loss'].append(loss_train)
-        log['val_loss'].append(loss_val)
-        log['train_acc'].append(res['acc'])
-        log['val_acc'].append(res_val['acc'])
-
-        log = logging(log, model, config, res_val)
+        if stopper.should_validate(ep):
+            # validation, KC activity is only needed for logging
+            with torch.no_grad():
+                model.eval()
+                model.readout(outputs=['kc'])
+                res_val = model(val_data, val_target)
+                model.readout(False)
+            loss_val = res_val['loss'].item()
+            acc_val = res_val['acc'].item()
+
+            print('[*' + '*'*50 + '*]')
+            print('Epoch {:d}'.format(ep))
+            print('Train/Validation loss {:0.2f}/{:0.2f}'.format(
+                loss_train, loss_val))
+            print('Train/Validation accuracy {:0.2f}/{:0.2f}'.format(
+                acc_train, acc_val))
+            log['epoch'].append(ep)
+            # Means over the batches of the previous epoch. Logs saved
+            # before these were accumulated hold the last batch instead
+            log['train_loss'].append(loss_train)
+            log['val_loss'].append(loss_val)
+            log['train_acc'].append(acc_train)
+            log['val_acc'].append(acc_val)
+
+            if logger is None:
+                log = logging(log, model, config, res_val)
+            else:
+                logger.log(log, model, config, res_val)
+
+            weight = None
+            if stopper.weight_tol is not None and config.model == 'full':
+                weight = model.layer2.effective_weight
+            if stopper.update(ep, loss_val, acc_val, weight) is not None:
+                break
 
         if ep > 0:
             time_spent = time.time() - start_time
             total_time += time_spent
             print('Time taken {:0.1f}s'.format(total_time))
-            print('Examples/second {:d}'.format(int(train_x.shape[0]/time_spent)))
+            print('Examples/second {:d}'.format(int(n_train/time_spent)))
         start_time = time.time()
 
+        if (getattr(config, 'sparse_pn2kc_layer', False) and
+                config.kc_prune_weak_weights and config.train_pn2kc):
+            _sparsify_pn2kc(model, optimizer, config)
+
         try:
             model.train()
-            random_idx = np.random.permutation(config.n_train)
-            idx = 0
-            while idx < config.n_train:
-                batch_indices = random_idx[idx:idx+batch_size]
-                idx += batch_size
-
-                res = model(train_data[batch_indices],
-                            train_target[batch_indices])
+            train_start_time = time.time()
+            # Metrics are accumulated on device, and reduced once per epoch
+            loss_sum = torch.zeros((), device=device)
+            acc_sum = torch.zeros((), device=device)
+            n_batch = 0
+            for x, target in train_batches():
+                res = model(x, target)
                 optimizer.zero_grad()
                 res['loss'].backward()
                 optimizer.step()
-
-            loss_train = res['loss'].item()
+                loss_sum += res['loss'].detach()
+                acc_sum += res['acc']
+                n_batch += 1
+
+            loss_train = (loss_sum / n_batch).item()
+            acc_train = (acc_sum / n_batch).item()
+            # Training steps only, excluding validation and logging
+            train_throughput = n_train / (time.time() - train_start_time)
+            log['train_samples_per_sec'].append(train_throughput)
+            print('Training examples/second {:d}'.format(
+                int(train_throughput)))
+            next_epoch = ep + 1
 
         except KeyboardInterrupt:
             print('Training interrupted by users')
@@ -214,8 +734,25 @@ def train(config, reload=False, save_everytrainloss=False):
             break
         sys.stdout.flush()
 
+    if checkpoint_every > 0 and not finish_training:
+        # Training can be extended by resuming with a larger max_epoch
+        _checkpoint(next_epoch)
+
+    if logger is not None:
+        # Entries appended by training after the last validation, e.g.
+        # train_samples_per_sec, are only in the training log
+        log.update(logger.close())
     print('Training finished')
 
+    # Why and when training stopped
+    if finish_training:
+        stop_reason = 'interrupted'
+    else:
+        stop_reason = stopper.stop_reason or 'max_epoch'
+    log['stop_reason'] = [stop_reason]
+    log['stop_epoch'] = [next_epoch]
+    tools.save_log(config.save_path, log)
+
     if 'save_log_only' in dir(config) and config.save_log_only is True:
         pass
     else:
@@ -223,6 +760,80 @@ def train(config, reload=False, save_everytrainloss=False):
         model.save()
 
 
+def _cpu_peak_memory(step):
+    """Peak bytes allocated by torch on cpu while running step.
+
+    Allocations and frees recorded by torch.profiler are accumulated in
+    time order.
+    """
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU],
+                 profile_memory=True) as prof:
+        step()
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    current = peak = 0
+    for event in events:
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def benchmark_train_step(config, n_kcs=(2500, 40000), batch_size=256,
+                         n_step=50):
+    """Compare training steps with per-step and on-device metrics.
+
+    The per-step variant returns KC activity and reads loss and accuracy
+    with .item() on every step, as training did before metrics were
+    accumulated on device.
+
+    Returns:
+        results: dict, (N_KC, variant) to (seconds per step, peak bytes).
+            Peak memory is measured on cuda with torch.cuda, and on cpu
+            with torch.profiler in one extra, untimed, step
+    """
+    results = dict()
+    for n_kc in n_kcs:
+        config.N_KC = n_kc
+        model = get_model(config)
+        model.to(device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=config.lr)
+        x = torch.rand(batch_size, config.N_ORN, device=device)
+        target = torch.randint(config.N_CLASS, (batch_size,), device=device)
+        for variant in ['per_step', 'on_device']:
+            model.readout(variant == 'per_step', outputs=['kc'])
+            metric_sum = torch.zeros((), device=device)
+
+            def _step():
+                nonlocal metric_sum
+                res = model(x, target)
+                optimizer.zero_grad()
+                res['loss'].backward()
+                optimizer.step()
+                if variant == 'per_step':
+                    metric_sum += res['loss'].item() + res['acc'].item()
+                else:
+                    metric_sum += res['loss'].detach() + res['acc']
+
+            if device == 'cuda':
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start_time = time.time()
+            for _ in range(n_step):
+                _step()
+            metric_sum.item()
+            step_time = (time.time() - start_time) / n_step
+            if device == 'cuda':
+                peak_memory = torch.cuda.max_memory_allocated()
+            else:
+                peak_memory = _cpu_peak_memory(_step)
+            results[(n_kc, variant)] = (step_time, peak_memory)
+            print('N_KC {:d}, {:s}: {:0.2f}ms per step, peak memory '
+                  '{:0.1f}MB'.format(n_kc, variant, step_time * 1000,
+                                     peak_memory / 2**20))
+        model.readout(False)
+    return results
+
+
 def train_from_path(path):
     """Train from a path with a config file in it."""
     config = tools.load_config(path)
@@ -0,0 +1,287 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import task
+import tools
+from configs import input_ProtoConfig, FullConfig
+
+
+class TestTorchTrain(unittest.TestCase):
+
+    def test_resume_reproduces_log(self):
+        import torch
+        import torchtrain
+
+        data_config = input_ProtoConfig()
+        data_config.n_train = 1000
+        data_config.n_val = 100
+        with tempfile.TemporaryDirectory() as path:
+            data_config.path = path
+            data_dir = task.save_proto(data_config, seed=0, folder_name='data')
+
+            def _train(save_path, max_epoch):
+                config = FullConfig()
+                config.data_dir = data_dir
+                config.save_path = os.path.join(path, save_path)
+                config.N_KC = 100
+                config.max_epoch = max_epoch
+                config.checkpoint_every = 1
+                torchtrain.train(config)
+                return tools.load_log(config.save_path)
+
+            torch.manual_seed(0)
+            np.random.seed(0)
+            log = _train('full', 4)
+
+            torch.manual_seed(0)
+            np.random.seed(0)
+            _train('resumed', 2)
+            # Seeds are ignored when resuming
+            torch.manual_seed(1)
+            np.random.seed(1)
+            log_resumed = _train('resumed', 4)
+
+            self.assertEqual(set(log.keys()), set(log_resumed.keys()))
+            for key in log.keys():
+                if key == 'train_samples_per_sec':
+                    continue
+                np.testing.assert_array_equal(log[key], log_resumed[key],
+                                              err_msg=key)
+
+    def test_resume_ignores_other_config(self):
+        import torch
+        import torchtrain
+
+        data_config = input_ProtoConfig()
+        data_config.n_train = 1000
+        data_config.n_val = 100
+        with tempfile.TemporaryDirectory() as path:
+            data_config.path = path
+            data_dir = task.save_proto(data_config, seed=0, folder_name='data')
+
+            def _train(save_path, lr):
+                config = FullConfig()
+                config.data_dir = data_dir
+                config.save_path = os.path.join(path, save_path)
+                config.N_KC = 100
+                config.max_epoch = 2
+                config.lr = lr
+                torch.manual_seed(0)
+                np.random.seed(0)
+                torchtrain.train(config)
+                return tools.load_log(config.save_path)
+
+            _train('model', 1e-3)
+            # Finished run of another lr, trained again from scratch
+            log = _train('model', 1e-2)
+            log_new = _train('new', 1e-2)
+
+            self.assertEqual(set(log.keys()), set(log_new.keys()))
+            for key in log.keys():
+                if key == 'train_samples_per_sec':
+                    continue
+                np.testing.assert_array_equal(log[key], log_new[key],
+                                              err_msg=key)
+
+    def test_resume_finished_run_async_logging(self):
+        import torchtrain
+
+        data_config = input_ProtoConfig()
+        data_config.n_train = 1000
+        data_config.n_val = 100
+        with tempfile.TemporaryDirectory() as path:
+            data_config.path = path
+            data_dir = task.save_proto(data_config, seed=0, folder_name='data')
+
+            config = FullConfig()
+            config.data_dir = data_dir
+            config.save_path = os.path.join(path, 'model')
+            config.N_KC = 100
+            config.max_epoch = 3
+            config.checkpoint_every = 1
+            config.async_logging = True
+            torchtrain.train(config)
+            log = tools.load_log(config.save_path)
+
+            # Nothing left to train, the log is saved again as it was
+            torchtrain.train(config)
+            log_resumed = tools.load_log(config.save_path)
+
+            self.assertIn('glo_score', log)
+            self.assertEqual(set(log.keys()), set(log_resumed.keys()))
+            for key in log.keys():
+                np.testing.assert_array_equal(log[key], log_resumed[key],
+                                              err_msg=key)
+
+    def test_async_logging_matches_sync(self):
+        import torch
+        import torchtrain
+
+        data_config = input_ProtoConfig()
+        data_config.n_train = 1000
+        data_config.n_val = 100
+        with tempfile.TemporaryDirectory() as path:
+            data_config.path = path
+            data_dir = task.save_proto(data_config, seed=0, folder_name='data')
+
+            logs = dict()
+            for async_logging in [False, True]:
+                config = FullConfig()
+                config.data_dir = data_dir
+                config.save_path = os.path.join(path, str(async_logging))
+                config.N_KC = 100
+                config.max_epoch = 3
+                config.async_logging = async_logging
+                torch.manual_seed(0)
+                np.random.seed(0)
+                torchtrain.train(config)
+                logs[async_logging] = tools.load_log(config.save_path)
+
+            log, log_async = logs[False], logs[True]
+            self.assertIn('glo_score', log)
+            self.assertEqual(set(log.keys()), set(log_async.keys()))
+            for key in log.keys():
+                if key == 'train_samples_per_sec':
+                    self.assertEqual(len(log[key]), len(log_async[key]))
+                    continue
+                np.testing.assert_array_equal(log[key], log_async[key],
+                                              err_msg=key)
+
+    def test_ensemble_logs_stop(self):
+        import torchensemble
+        from torchmodel import get_model
+
+        data_config = input_ProtoConfig()
+        data_config.n_train = 1000
+        data_config.n_val = 100
+        with tempfile.TemporaryDirectory() as path:
+            data_config.path = path
+            data_dir = task.save_proto(data_config, seed=0, folder_name='data')
+
+            configs = []
+            for i, target_acc in enumerate([None, 0.]):
+                config = FullConfig()
+                config.data_dir = data_dir
+                config.save_path = os.path.join(path, str(i))
+                config.N_KC = 100
+                config.kc_norm_pre = 'batch_norm'
+                config.max_epoch = 3
+                config.save_every_epoch = True
+                config.target_acc = target_acc
+                configs.append(config)
+            torchensemble.train_ensemble(configs)
+
+            log = tools.load_log(configs[0].save_path)
+            self.assertEqual(log['stop_reason'][0], 'max_epoch')
+            self.assertEqual(log['stop_epoch'][0], 3)
+            log = tools.load_log(configs[1].save_path)
+            self.assertEqual(log['stop_reason'][0], 'target_acc')
+            self.assertEqual(log['stop_epoch'][0], 0)
+            np.testing.assert_array_equal(log['epoch'], [0])
+
+            # Parameters and running statistics of the stopped member are
+            # those it was validated with, unlike the trained member
+            models = [get_model(tools.load_config(c.save_path))
+                      for c in configs]
+            for model in models:
+                model.load()
+            self.assertGreater(
+                models[0].layer2.pre_norm.num_batches_tracked, 0)
+            state_dict = {key: val.clone()
+                          for key, val in models[1].state_dict().items()}
+            models[1].load(epoch=0)
+            for key, val in models[1].state_dict().items():
+                np.testing.assert_array_equal(val.numpy(),
+                                              state_dict[key].numpy(),
+                                              err_msg=key)
+
+    def test_ensemble_matches_models(self):
+        import copy
+        import torch
+        import torchensemble
+
+        for kc_norm_pre, sparse in [(None, False), ('batch_norm', False),
+                                    ('layer_norm', True), ('olsen', False)]:
+            config = input_ProtoConfig()
+            config.update(FullConfig())
+            config.N_KC = 100
+            config.kc_dropout = False
+            config.kc_norm_pre = kc_norm_pre
+            config.sparse_pn2kc_layer = sparse
+            msg = '{}, sparse {}'.format(kc_norm_pre, sparse)
+            configs = []
+            for kc_bias in [-1, 0.5]:
+                config = copy.deepcopy(config)
+                config.kc_bias = kc_bias
+                configs.append(config)
+
+            torch.manual_seed(0)
+            ensemble = torchensemble.Ensemble(configs)
+            ensemble.train()
+            x = torch.rand(16, config.N_ORN)
+            target = torch.randint(config.N_CLASS, (16,))
+            res = ensemble(x, target)
+            res['loss'].sum().backward()
+
+            for i, model in enumerate(ensemble.models):
+                model.train()
+                res_model = model(x, target)
+                res_model['loss'].backward()
+                self.assertAlmostEqual(res['loss'][i].item(),
+                                       res_model['loss'].item(), places=5,
+                                       msg=msg)
+                self.assertAlmostEqual(res['acc'][i].item(),
+                                       res_model['acc'].item(), msg=msg)
+                for name, param in model.named_parameters():
+                    if param.grad is None:
+                        self.assertIsNone(ensemble.params[name].grad)
+                        continue
+                    np.testing.assert_allclose(
+                        ensemble.params[name].grad[i].numpy(),
+                        param.grad.numpy(), rtol=1e-4, atol=1e-6,
+                        err_msg=msg + ' ' + name)
+                for name, buffer in model.named_buffers():
+                    np.testing.assert_allclose(
+                        ensemble.buffers[name][i].numpy(), buffer.numpy(),
+                        rtol=1e-5, atol=1e-7, err_msg=msg + ' ' + name)
+
+    def test_benchmark_train_step(self):
+        import torchtrain
+
+        config = input_ProtoConfig()
+        config.update(FullConfig())
+        results = torchtrain.benchmark_train_step(
+            config, n_kcs=(100,), batch_size=16, n_step=1)
+        for key, (step_time, peak_memory) in results.items():
+            self.assertGreater(step_time, 0, key)
+            self.assertGreater(peak_memory, 0, key)
+
+    def test_early_stopping(self):
+        import torchtrain
+
+        config = FullConfig()
+        config.early_stop_patience = 3
+        config.eval_max_interval = 4
+        stopper = torchtrain.EarlyStopping(config)
+        epochs = []
+        ep = 0
+        while stopper.stop_reason is None:
+            self.assertTrue(stopper.should_validate(ep))
+            epochs.append(ep)
+            stopper.update(ep, loss=1., acc=0.5)
+            ep = stopper.next_epoch
+        # Constant loss, validation interval doubles until patience ends
+        self.assertEqual(epochs, [0, 1, 3])
+        self.assertEqual(stopper.stop_reason, 'patience')
+
+        config.target_acc = 0.9
+        stopper = torchtrain.EarlyStopping(config)
+        self.assertIsNone(stopper.update(0, loss=1., acc=0.5))
+        self.assertEqual(stopper.update(1, loss=0.5, acc=0.95), 'target_acc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,7 @@ import tools
 from standard.analysis_pn2kc_training import _compute_sparsity
 
 
-def make_input(x, y, batch_size):
+def make_input(x, y, batch_size, label_key=None):
     data = tf.data.Dataset.from_tensor_slices((x, y))
     data = data.shuffle(int(1E6))
     # Making sure the shape is fully defined
@@ -23,6 +23,9 @@ def make_input(x, y, batch_size):
         data = data.batch(tf.cast(batch_size, tf.int64), drop_remainder=True)
     except TypeError:
         data = data.apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
+    if label_key is not None:
+        # Materialize targets of class ids for each batch only
+        data = data.map(lambda x_, y_: (x_, tf.gather(label_key, y_)))
     # data = data.batch(tf.cast(batch_size, tf.int64))
     data = data.repeat()
     train_iter = data.make_initializable_iterator()
@@ -52,7 +55,10 @@ def train(config, reload=False, save_everytrainloss=False):
     tools.save_config(config, save_path=config.save_path)
 
     # Load dataset
-    train_x, train_y, val_x, val_y = task.load_data(config.data_dir)
+    train_x, train_y, val_x, val_y = task.load_data(config.data_dir,
+                                                    encode=False)
+    label_key = task.load_label_key(config.data_dir)
+    val_y = task.encode_labels(val_y, label_key)
 
     batch_size = config.batch_size
     if 'n_batch' in dir(config):
@@ -81,7 +87,8 @@ def train(config, reload=False, save_everytrainloss=False):
     # Build train model
     train_x_ph = tf.placeholder(train_x.dtype, train_x.shape)
     train_y_ph = tf.placeholder(train_y.dtype, train_y.shape)
-    train_iter, next_element = make_input(train_x_ph, train_y_ph, batch_size)
+    train_iter, next_element = make_input(train_x_ph, train_y_ph, batch_size,
+                                          label_key=label_key)
     model = CurrentModel(next_element[0], next_element[1], config=config)
 
     # Build validation model